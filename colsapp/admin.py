@@ -14,3 +14,7 @@ admin.site.register(
 admin.site.register(
     MovieGenre, list_display=["name"], list_display_links=["name"],
 )
+
+admin.site.register(
+    IngestionCheckpoint, list_display=["source", "last_page", "finished"],
+)
@@ -0,0 +1,196 @@
+"""
+Incremental maintenance of UserGenreCount.
+
+A user's count for a genre is the no of (collection of the user, movie in
+the collection, genre of the movie) triples. A change of a collection/movie
+link adds or removes the triples of every genre of the movie, a change of a
+movie/genre link those of every collection of the movie, so every change is
+turned into (user, genre) deltas which are upserted in one statement.
+"""
+
+from collections import Counter
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+from .ids import new_id
+from .models import Movie, MovieCollection, UserGenreCount
+from .response_cache import response_cache, user_scope
+
+CollectionMovie = Movie.collections.through
+MovieGenreLink = Movie.genres.through
+
+
+def collection_movie_deltas(pairs, sign):
+    """
+    params:
+    pairs: (collection_id, movie_id) links which were added or removed,
+    sign: 1 for added links, -1 for removed ones
+    return: Counter of (user_id, genre_id) -> delta
+    """
+    deltas = Counter()
+    pairs = set(pairs)
+    if not pairs:
+        return deltas
+
+    users = dict(
+        MovieCollection.objects.filter(
+            id__in={collection_id for collection_id, _ in pairs}
+        ).values_list("id", "user_id")
+    )
+    genres = {}
+    for movie_id, genre_id in MovieGenreLink.objects.filter(
+        movie_id__in={movie_id for _, movie_id in pairs}
+    ).values_list("movie_id", "moviegenre_id"):
+        genres.setdefault(movie_id, []).append(genre_id)
+
+    for collection_id, movie_id in pairs:
+        user_id = users.get(collection_id)
+        for genre_id in genres.get(movie_id, ()):
+            deltas[(user_id, genre_id)] += sign
+    return deltas
+
+
+def movie_genre_deltas(pairs, sign):
+    """
+    params:
+    pairs: (movie_id, genre_id) links which were added or removed,
+    sign: 1 for added links, -1 for removed ones
+    return: Counter of (user_id, genre_id) -> delta
+    """
+    deltas = Counter()
+    pairs = set(pairs)
+    if not pairs:
+        return deltas
+
+    users = {}
+    for movie_id, user_id in CollectionMovie.objects.filter(
+        movie_id__in={movie_id for movie_id, _ in pairs}
+    ).values_list("movie_id", "moviecollection__user_id"):
+        users.setdefault(movie_id, []).append(user_id)
+
+    for movie_id, genre_id in pairs:
+        for user_id in users.get(movie_id, ()):
+            deltas[(user_id, genre_id)] += sign
+    return deltas
+
+
+def apply_deltas(deltas, batch_size=500):
+    """
+    upserts the deltas into UserGenreCount and drops rows reaching zero
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta and key[0]}
+    if not deltas:
+        return
+
+    opts = UserGenreCount._meta
+    fields = [
+        opts.get_field(name)
+        for name in ("id", "created", "modified", "active", "user", "genre")
+    ]
+    count_field = opts.get_field("movie_count")
+    table = connection.ops.quote_name(opts.db_table)
+    columns = ", ".join(
+        connection.ops.quote_name(field.column) for field in fields + [count_field]
+    )
+    count_column = connection.ops.quote_name(count_field.column)
+    modified_column = connection.ops.quote_name(opts.get_field("modified").column)
+    conflict = ", ".join(
+        connection.ops.quote_name(opts.get_field(name).column)
+        for name in ("user", "genre")
+    )
+
+    now = timezone.now()
+    rows = []
+    for (user_id, genre_id), delta in deltas.items():
+        values = (new_id(), now, now, True, user_id, genre_id)
+        rows.append(
+            [
+                field.get_db_prep_save(value, connection)
+                for field, value in zip(fields, values)
+            ]
+            + [delta]
+        )
+
+    placeholders = "(" + ", ".join(["%s"] * (len(fields) + 1)) + ")"
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            cursor.execute(
+                f"INSERT INTO {table} ({columns}) "
+                f"VALUES {', '.join([placeholders] * len(batch))} "
+                f"ON CONFLICT ({conflict}) DO UPDATE SET "
+                f"{count_column} = {table}.{count_column} + EXCLUDED.{count_column}, "
+                f"{modified_column} = EXCLUDED.{modified_column}",
+                [value for row in batch for value in row],
+            )
+
+    user_ids = {user_id for user_id, _ in deltas}
+    UserGenreCount.objects.filter(user_id__in=user_ids, movie_count__lte=0).delete()
+    # the fav_genres of their collection lists changed
+    response_cache.bump(*[user_scope(user_id) for user_id in user_ids])
+
+
+def compute_genre_counts(user_ids=None):
+    """
+    counts from scratch, used to rebuild and to check the materialized ones
+    return: dict of (user_id, genre_id) -> count
+    """
+    # one filter() call, a second one would join the collections again
+    lookups = {"movie__collections__isnull": False}
+    if user_ids is not None:
+        lookups["movie__collections__user_id__in"] = user_ids
+    queryset = MovieGenreLink.objects.filter(**lookups)
+    return {
+        (row["movie__collections__user_id"], row["moviegenre_id"]): row["total"]
+        for row in queryset.values(
+            "movie__collections__user_id", "moviegenre_id"
+        ).annotate(total=Count("id"))
+    }
+
+
+def stored_genre_counts(user_ids=None):
+    queryset = UserGenreCount.objects.filter(movie_count__gt=0)
+    if user_ids is not None:
+        queryset = queryset.filter(user_id__in=user_ids)
+    return {
+        (user_id, genre_id): movie_count
+        for user_id, genre_id, movie_count in queryset.values_list(
+            "user_id", "genre_id", "movie_count"
+        )
+    }
+
+
+def check_genre_counts(user_ids=None):
+    """
+    return: list of (user_id, genre_id, stored, expected) which differ
+    """
+    expected = compute_genre_counts(user_ids)
+    stored = stored_genre_counts(user_ids)
+    mismatches = []
+    for user_id, genre_id in set(expected) | set(stored):
+        key = (user_id, genre_id)
+        if stored.get(key, 0) != expected.get(key, 0):
+            mismatches.append(
+                (user_id, genre_id, stored.get(key, 0), expected.get(key, 0))
+            )
+    return mismatches
+
+
+def rebuild_genre_counts(user_ids=None, batch_size=1000):
+    """
+    replaces the stored counts with freshly computed ones
+    return: no of rows written
+    """
+    counts = compute_genre_counts(user_ids)
+    queryset = UserGenreCount.objects.all()
+    if user_ids is not None:
+        queryset = queryset.filter(user_id__in=user_ids)
+    queryset.delete()
+    UserGenreCount.objects.bulk_create(
+        [
+            UserGenreCount(user_id=user_id, genre_id=genre_id, movie_count=count)
+            for (user_id, genre_id), count in counts.items()
+        ],
+        batch_size=batch_size,
+    )
+    return len(counts)
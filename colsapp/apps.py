@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ColsappConfig(AppConfig):
     name = "colsapp"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,191 @@
+"""
+Views served directly by the ASGI application, see moviecollection/asgi.py.
+
+They bypass the django handler so upstream maya calls are awaited on the
+event loop instead of blocking a worker thread.
+"""
+import logging
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from rest_framework import exceptions
+from rest_framework.renderers import JSONRenderer
+from maya_api.async_client import AsyncMayaApiClient
+from maya_api.exceptions import (
+    ApiConnectionErrorException,
+    ApiTimeoutException,
+    CircuitOpenException,
+)
+from moviecollection.counters import request_counter
+from moviecollection.logs import reset_request_id, set_request_id
+from moviecollection.metrics import RequestMetrics, metrics_store
+from moviecollection.middleware import request_id_from
+from moviecollection.traffic import traffic_counter
+from .authentication import CachedTokenAuthentication
+from .maya_cache import maya_cache
+from .views import (
+    MAYA_UNAVAILABLE,
+    local_movie_page,
+    maya_cache_response,
+    prefetch_movie_pages,
+    rewrite_page_links,
+)
+
+logger = logging.getLogger(__name__)
+
+# route of views.home_page in the metrics, see middleware.request_route
+HOME_ROUTE = "GET:home"
+
+
+def _authenticate(authorization):
+    """
+    same checks as CachedTokenAuthentication on the sync views
+    return: user
+    """
+    request = SimpleNamespace(META={"HTTP_AUTHORIZATION": authorization})
+    auth = CachedTokenAuthentication()
+    result = auth.authenticate(request)
+    if result is None:
+        raise exceptions.NotAuthenticated()
+    return result[0]
+
+
+def _prepare_home_page(authorization):
+    # one thread hop for every blocking call made before the cache lookup
+    request_counter.incr()
+    return _authenticate(authorization)
+
+
+def _record_home_page(seconds, status_code, values, user_id):
+    # what MetricsMiddleware and RequestCountMiddleware record, in one hop
+    metrics_store.add_request(HOME_ROUTE, seconds, status_code, values)
+    traffic_counter.record(HOME_ROUTE, status_code, user_id)
+
+
+async def aload_movie_page(page, path):
+    """
+    async version of views.load_movie_page
+    """
+    client = AsyncMayaApiClient()
+    try:
+        data = await client.get_movie_list(page=page)
+
+    except ApiConnectionErrorException as e:
+        return dict(MAYA_UNAVAILABLE), False
+
+    except ApiTimeoutException as e:
+        return dict(MAYA_UNAVAILABLE), False
+
+    except CircuitOpenException as e:
+        # failing fast, maya is known to be down
+        return dict(MAYA_UNAVAILABLE), False
+
+    except Exception as e:
+        logger.error("maya movie list failed", exc_info=True)
+        return dict(MAYA_UNAVAILABLE), False
+
+    # API seems to be return is_success flag in case of failure
+    if "is_success" in data:
+        return data, False
+
+    rewrite_page_links(data, client._build_url("movies/"), path)
+    return data, True
+
+
+async def _send_json(send, data, status_code, headers=None):
+    body = JSONRenderer().render(data)
+    response_headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    response_headers.extend(headers or [])
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": response_headers,
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def home_page(scope, receive, send):
+    """
+    async version of views.home_page, tags its log records with the
+    X-Request-ID and records its metrics and traffic like the middleware
+    does for the sync views
+    """
+    headers = dict(scope["headers"])
+    request_id = request_id_from(headers.get(b"x-request-id", b"").decode("latin-1"))
+    response = {"status": 500}
+
+    async def send_with_request_id(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            message = dict(
+                message,
+                headers=[*message["headers"], (b"x-request-id", request_id.encode())],
+            )
+        await send(message)
+
+    metrics = RequestMetrics()
+    token = set_request_id(request_id)
+    metrics.start()
+    user_id = None
+    try:
+        user_id = await _home_page(scope, headers, send_with_request_id)
+    finally:
+        seconds = metrics.finish()
+        reset_request_id(token)
+        await sync_to_async(_record_home_page)(
+            seconds, response["status"], metrics.values, user_id
+        )
+
+
+async def _home_page(scope, headers, send):
+    """
+    return: id of the authenticated user, None if authentication failed
+    """
+    query_string = scope["query_string"].decode()
+    full_path = scope["path"]
+    if query_string:
+        full_path = f"{full_path}?{query_string}"
+    cache_key = f"movies_{full_path}"
+
+    try:
+        user = await sync_to_async(_prepare_home_page)(
+            headers.get(b"authorization", b"").decode("latin-1")
+        )
+    except exceptions.APIException as e:
+        await _send_json(
+            send,
+            {"detail": e.detail},
+            e.status_code,
+            headers=[(b"www-authenticate", b"Token")],
+        )
+        return None
+
+    page = parse_qs(query_string).get("page", [None])[-1]
+    entry, state = await maya_cache.aget_or_load(
+        cache_key, lambda: aload_movie_page(page, scope["path"])
+    )
+    if entry["ok"]:
+        # hands the pages to the prefetch threads, it does not block
+        prefetch_movie_pages(scope["path"], page, entry["data"])
+    else:
+        data = await sync_to_async(local_movie_page)(page, scope["path"])
+        if data is not None:
+            await _send_json(send, data, 200, headers=[(b"x-cache", b"LOCAL")])
+            return user.pk
+
+    data, response_status, response_headers = maya_cache_response(entry, state)
+    await _send_json(
+        send,
+        data,
+        response_status,
+        headers=[
+            (name.lower().encode(), value.encode())
+            for name, value in response_headers.items()
+        ],
+    )
+    return user.pk
@@ -0,0 +1,136 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from moviecollection.metrics import record_cache
+
+DEFAULT_AUTH_CACHE_SETTINGS = {
+    # entries and seconds of the process local lru, other processes see an
+    # invalidation once their entry expires
+    "LOCAL_SIZE": 10000,
+    "LOCAL_TTL": 5,
+    # seconds a snapshot lives in the shared cache
+    "TTL": 300,
+}
+
+# user fields kept in the snapshot, the others (password) load on access
+USER_FIELDS = (
+    "id",
+    "username",
+    "first_name",
+    "last_name",
+    "email",
+    "is_active",
+    "is_staff",
+    "is_superuser",
+    "date_joined",
+    "last_login",
+)
+
+
+class TokenCache:
+    """
+    token key -> snapshot of the token and its user, in a process local lru
+    in front of the shared cache. Keys are stored hashed.
+    """
+
+    def __init__(self, **options):
+        config = dict(DEFAULT_AUTH_CACHE_SETTINGS)
+        config.update(getattr(settings, "AUTH_TOKEN_CACHE", {}))
+        config.update(options)
+        self.local_size = config["LOCAL_SIZE"]
+        self.local_ttl = config["LOCAL_TTL"]
+        self.ttl = config["TTL"]
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(key):
+        return f"auth_token:{hashlib.sha256(key.encode()).hexdigest()}"
+
+    def get(self, key):
+        cache_key = self.cache_key(key)
+        with self._lock:
+            entry = self._local.get(cache_key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._local.move_to_end(cache_key)
+                record_cache("auth_token_local", True)
+                return entry[1]
+
+        snapshot = cache.get(cache_key)
+        record_cache("auth_token", snapshot is not None)
+        if snapshot is not None:
+            self._put_local(cache_key, snapshot)
+        return snapshot
+
+    def set(self, token):
+        snapshot = {
+            "token": {"key": token.key, "created": token.created},
+            "user": {field: getattr(token.user, field) for field in USER_FIELDS},
+        }
+        cache_key = self.cache_key(token.key)
+        cache.set(cache_key, snapshot, timeout=self.ttl)
+        self._put_local(cache_key, snapshot)
+        return snapshot
+
+    def _put_local(self, cache_key, snapshot):
+        with self._lock:
+            self._local[cache_key] = (time.monotonic() + self.local_ttl, snapshot)
+            self._local.move_to_end(cache_key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def invalidate(self, *keys):
+        cache_keys = [self.cache_key(key) for key in keys]
+        with self._lock:
+            for cache_key in cache_keys:
+                self._local.pop(cache_key, None)
+        cache.delete_many(cache_keys)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+
+token_cache = TokenCache()
+
+
+def snapshot_credentials(snapshot):
+    """
+    return: (user, token) built from a snapshot, new instances per request
+    so no request sees another's changes
+    """
+    user_values = snapshot["user"]
+    # from_db expects the values in field order, the fields missing from the
+    # snapshot are deferred and saving the user only writes the loaded ones
+    field_names = [
+        field.attname
+        for field in User._meta.concrete_fields
+        if field.attname in user_values
+    ]
+    user = User.from_db(None, field_names, [user_values[name] for name in field_names])
+    token = Token(user=user, **snapshot["token"])
+    token._state.adding = False
+    return user, token
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication reading the token and its user from token_cache,
+    the db is only queried on a miss. Snapshots are dropped by the signals
+    in colsapp.signals when a token is saved or deleted and when its user
+    changes.
+    """
+
+    def authenticate_credentials(self, key):
+        snapshot = token_cache.get(key)
+        if snapshot is None:
+            # raises for unknown keys and inactive users, those are not cached
+            user, token = super().authenticate_credentials(key)
+            snapshot = token_cache.set(token)
+        return snapshot_credentials(snapshot)
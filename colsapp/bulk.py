@@ -0,0 +1,321 @@
+from django.db import transaction
+from django.dispatch import Signal
+from django.utils import timezone
+from rest_framework import serializers
+from .genres import genre_resolver
+from .models import Movie, MovieCollection
+from .response_cache import MOVIES, response_cache
+
+# sent after through rows were written with bulk queries, which unlike
+# add()/remove() do not send m2m_changed. `pairs` are (source_id, target_id)
+# tuples of the `source_field`/`target_field` columns of the through table,
+# action is "post_add" or "post_remove".
+m2m_bulk_changed = Signal(
+    providing_args=["through", "source_field", "target_field", "action", "pairs"]
+)
+
+
+def _send_changed(through, source_field, target_field, action, pairs):
+    m2m_bulk_changed.send(
+        sender=through,
+        through=through,
+        source_field=source_field,
+        target_field=target_field,
+        action=action,
+        pairs=pairs,
+    )
+
+
+def bulk_link(through, source_field, target_field, pairs, batch_size=None, known=False):
+    """
+    inserts through rows for (source_id, target_id) pairs which do not exist
+    yet, with one lookup and one bulk insert
+    params:
+    known: the caller knows none of the pairs exist, skips the lookup
+    return: set of pairs which were added
+    """
+    pairs = set(pairs)
+    if not pairs or known:
+        existing = set()
+    else:
+        existing = set(
+            through.objects.filter(
+                **{
+                    f"{source_field}__in": {source_id for source_id, _ in pairs},
+                    f"{target_field}__in": {target_id for _, target_id in pairs},
+                }
+            ).values_list(source_field, target_field)
+        )
+    pairs -= existing
+    if not pairs:
+        return pairs
+
+    through.objects.bulk_create(
+        [
+            through(**{source_field: source_id, target_field: target_id})
+            for source_id, target_id in pairs
+        ],
+        batch_size=batch_size,
+        ignore_conflicts=True,
+    )
+    _send_changed(through, source_field, target_field, "post_add", pairs)
+    return pairs
+
+
+def bulk_unlink(through, source_field, target_field, pairs, known=False):
+    """
+    deletes the through rows of (source_id, target_id) pairs
+    params:
+    known: the caller knows all of the pairs exist, deletes them with a
+    single query when they share one source
+    return: set of pairs which were removed
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return pairs
+
+    sources = {source_id for source_id, _ in pairs}
+    if known and len(sources) == 1:
+        through.objects.filter(
+            **{
+                source_field: sources.pop(),
+                f"{target_field}__in": [target_id for _, target_id in pairs],
+            }
+        ).delete()
+        _send_changed(through, source_field, target_field, "post_remove", pairs)
+        return pairs
+
+    candidates = through.objects.filter(
+        **{
+            f"{source_field}__in": sources,
+            f"{target_field}__in": {target_id for _, target_id in pairs},
+        }
+    ).values_list("id", source_field, target_field)
+    rows = {
+        (source_id, target_id): row_id
+        for row_id, source_id, target_id in candidates
+        if (source_id, target_id) in pairs
+    }
+    if not rows:
+        return set()
+
+    through.objects.filter(id__in=rows.values()).delete()
+    pairs = set(rows)
+    _send_changed(through, source_field, target_field, "post_remove", pairs)
+    return pairs
+
+
+def bulk_set(through, source_field, target_field, source_id, target_ids, **kwargs):
+    """
+    makes `target_ids` the related ids of `source_id`, reading the current
+    rows once and applying the difference with one bulk insert and one bulk
+    delete
+    return: (added pairs, removed pairs)
+    """
+    current = set(
+        through.objects.filter(**{source_field: source_id}).values_list(
+            target_field, flat=True
+        )
+    )
+    target_ids = set(target_ids)
+    added = bulk_link(
+        through,
+        source_field,
+        target_field,
+        [(source_id, target_id) for target_id in target_ids - current],
+        known=True,
+        **kwargs,
+    )
+    removed = bulk_unlink(
+        through,
+        source_field,
+        target_field,
+        [(source_id, target_id) for target_id in current - target_ids],
+        known=True,
+    )
+    return added, removed
+
+
+class BulkGenreSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=200)
+
+
+class BulkMovieSerializer(serializers.Serializer):
+    """
+    Validates a single bulk item without touching the db, references are
+    checked for all items at once by MovieBulkWriter. Updates (items with an
+    `id`) carry only the fields they change.
+    """
+
+    # required by the items creating a movie
+    create_fields = ("title", "collections", "genres")
+
+    id = serializers.UUIDField(required=False)
+    title = serializers.CharField(max_length=200, required=False)
+    description = serializers.CharField(required=False, allow_blank=True)
+    collections = serializers.ListField(child=serializers.UUIDField(), required=False)
+    genres = BulkGenreSerializer(many=True, required=False)
+
+    def validate(self, data):
+        if "id" not in data:
+            missing = [name for name in self.create_fields if name not in data]
+            if missing:
+                raise serializers.ValidationError(
+                    {name: ["This field is required."] for name in missing}
+                )
+        return data
+
+
+class MovieBulkWriter:
+    """
+    Creates and updates many movies with set based queries.
+
+    Items with an `id` update the fields they carry of that movie, and
+    replace its collections and genres when they carry them, the others are
+    created. Every item is validated first, the
+    valid ones are then written in one transaction and the invalid ones are
+    reported by their index.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+
+    def validate(self, items):
+        valid, errors = [], []
+        for index, item in enumerate(items):
+            serializer = BulkMovieSerializer(data=item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                errors.append({"index": index, "errors": serializer.errors})
+
+        collection_ids = {pk for _, data in valid for pk in data.get("collections", ())}
+        movie_ids = {data["id"] for _, data in valid if "id" in data}
+        known_collections = set(
+            MovieCollection.objects.filter(id__in=collection_ids).values_list(
+                "id", flat=True
+            )
+        )
+        known_movies = set(
+            Movie.objects.filter(id__in=movie_ids).values_list("id", flat=True)
+        )
+
+        checked = []
+        for index, data in valid:
+            item_errors = {}
+            missing = [
+                str(pk)
+                for pk in data.get("collections", ())
+                if pk not in known_collections
+            ]
+            if missing:
+                item_errors["collections"] = [
+                    f'Invalid pk "{pk}" - object does not exist.' for pk in missing
+                ]
+            if "id" in data and data["id"] not in known_movies:
+                item_errors["id"] = [
+                    f'Invalid pk "{data["id"]}" - object does not exist.'
+                ]
+            if item_errors:
+                errors.append({"index": index, "errors": item_errors})
+            else:
+                checked.append((index, data))
+
+        errors.sort(key=lambda error: error["index"])
+        return checked, errors
+
+    @transaction.atomic
+    def write(self, valid):
+        """
+        params:
+        valid: list of (index, validated data) returned by validate
+        return: list of {"index", "id", "created"} per written item
+        """
+        genre_ids = genre_resolver.resolve(
+            {
+                genre["name"].capitalize()
+                for _, data in valid
+                for genre in data.get("genres", ())
+            },
+            batch_size=self.batch_size,
+        )
+
+        now = timezone.now()
+        to_create, results = [], []
+        # updated movies grouped by the fields they carry, bulk_update writes
+        # every given field of every movie
+        to_update = {}
+        collection_links, genre_links = set(), set()
+        # updated movies whose collections/genres are replaced
+        replaced = {"collections": [], "genres": []}
+        for index, data in valid:
+            if "id" in data:
+                fields = tuple(f for f in ("title", "description") if f in data)
+                movie = Movie(
+                    id=data["id"], modified=now, **{f: data[f] for f in fields}
+                )
+                to_update.setdefault(fields + ("modified",), []).append(movie)
+                for name, movie_ids in replaced.items():
+                    if name in data:
+                        movie_ids.append(movie.id)
+            else:
+                movie = Movie(
+                    title=data["title"], description=data.get("description", "")
+                )
+                to_create.append(movie)
+            results.append(
+                {"index": index, "id": movie.id, "created": "id" not in data}
+            )
+
+            collection_links.update(
+                (movie.id, pk) for pk in data.get("collections", ())
+            )
+            genre_links.update(
+                (movie.id, genre_ids[genre["name"].capitalize()])
+                for genre in data.get("genres", ())
+            )
+
+        Movie.objects.bulk_create(to_create, batch_size=self.batch_size)
+        for fields, movies in to_update.items():
+            Movie.objects.bulk_update(movies, fields, batch_size=self.batch_size)
+
+        collections_through = Movie.collections.through
+        genres_through = Movie.genres.through
+        for through, target_field, links, movie_ids in (
+            (
+                collections_through,
+                "moviecollection_id",
+                collection_links,
+                replaced["collections"],
+            ),
+            (genres_through, "moviegenre_id", genre_links, replaced["genres"]),
+        ):
+            if not movie_ids:
+                continue
+            stale = (
+                set(
+                    through.objects.filter(movie_id__in=movie_ids).values_list(
+                        "movie_id", target_field
+                    )
+                )
+                - links
+            )
+            bulk_unlink(through, "movie_id", target_field, stale)
+
+        bulk_link(
+            collections_through,
+            "movie_id",
+            "moviecollection_id",
+            collection_links,
+            batch_size=self.batch_size,
+        )
+        bulk_link(
+            genres_through,
+            "movie_id",
+            "moviegenre_id",
+            genre_links,
+            batch_size=self.batch_size,
+        )
+        # bulk writes send no post_save
+        response_cache.bump(MOVIES)
+        return results
@@ -0,0 +1,233 @@
+"""
+Streaming export of a user's collections with their movies and genres.
+
+Collections are read with a server side cursor (`iterator()`) and handled
+`chunk_size` at a time. Their movies are read in batches of collections
+holding at most `chunk_size` movies together, with one values_list() for
+the movies and one for their genres, and a collection with more movies than
+that is read by itself `chunk_size` movies at a time, keyset paginated by
+movie id. Only about `chunk_size` collections and movies are held in memory
+whatever the size of the library or of a collection, and every batch is
+written out before the next one is read.
+"""
+
+import csv
+import json
+from collections import defaultdict
+from django.db.models import Count
+from .models import Movie
+
+NDJSON = "ndjson"
+CSV = "csv"
+FORMATS = {NDJSON: "application/x-ndjson", CSV: "text/csv"}
+
+CSV_HEADER = [
+    "collection_id",
+    "collection_title",
+    "collection_description",
+    "movie_id",
+    "movie_title",
+    "movie_description",
+    "genres",
+]
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def batches(collections, sizes, size):
+    """
+    groups the collections, in their order, into batches holding at most
+    `size` movies, a collection with more movies is a batch by itself
+    """
+    batch, movies = [], 0
+    for collection in collections:
+        count = sizes.get(collection["id"], 0)
+        if batch and movies + count > size:
+            yield batch
+            batch, movies = [], 0
+        batch.append(collection)
+        movies += count
+    if batch:
+        yield batch
+
+
+def read_movies(collection_ids, after=None, limit=None):
+    """
+    params:
+    after: only the movies with a larger id,
+    limit: max no of movies read
+    return: dict of collection id to its movies, ordered by id, with their
+    genre names
+    """
+    rows = (
+        Movie.collections.through.objects.filter(moviecollection_id__in=collection_ids)
+        .order_by("movie_id")
+        .values_list(
+            "moviecollection_id", "movie_id", "movie__title", "movie__description"
+        )
+    )
+    if after is not None:
+        rows = rows.filter(movie_id__gt=after)
+    if limit is not None:
+        rows = rows[:limit]
+
+    movies = defaultdict(list)
+    for collection_id, movie_id, title, description in rows:
+        movies[collection_id].append(
+            {"id": movie_id, "title": title, "description": description}
+        )
+
+    genres = defaultdict(list)
+    movie_ids = {movie["id"] for items in movies.values() for movie in items}
+    if movie_ids:
+        pairs = (
+            Movie.genres.through.objects.filter(movie_id__in=movie_ids)
+            .order_by("moviegenre__name")
+            .values_list("movie_id", "moviegenre__name")
+        )
+        for movie_id, name in pairs:
+            genres[movie_id].append(name)
+    for items in movies.values():
+        for movie in items:
+            movie["genres"] = genres[movie["id"]]
+    return movies
+
+
+def large_collection_movies(collection_id, chunk_size):
+    """
+    yields the movies of one collection, `chunk_size` per query
+    """
+    after = None
+    while True:
+        movies = read_movies([collection_id], after, chunk_size)[collection_id]
+        yield from movies
+        if len(movies) < chunk_size:
+            return
+        after = movies[-1]["id"]
+
+
+def movie_data(movie):
+    return {
+        "id": str(movie["id"]),
+        "title": movie["title"],
+        "description": movie["description"],
+        "genres": movie["genres"],
+    }
+
+
+def collection_data(collection, movies):
+    return {
+        "id": str(collection["id"]),
+        "title": collection["title"],
+        "description": collection["description"],
+        "created": collection["created"].isoformat(),
+        "movies": movies,
+    }
+
+
+def export_collections(user, chunk_size=1000):
+    """
+    yields the user's collections as dicts, oldest first, each with its
+    movies and their genre names. The `movies` of a collection larger than
+    `chunk_size` are an iterator reading them as it goes, which has to be
+    consumed before the next collection is taken, a list otherwise.
+    """
+    collections = (
+        user.collections.order_by("created", "id")
+        .values("id", "title", "description", "created")
+        .iterator(chunk_size=chunk_size)
+    )
+    for chunk in chunks(collections, chunk_size):
+        sizes = dict(
+            Movie.collections.through.objects.filter(
+                moviecollection_id__in=[collection["id"] for collection in chunk]
+            )
+            .order_by()
+            .values_list("moviecollection_id")
+            .annotate(count=Count("movie_id"))
+        )
+        for batch in batches(chunk, sizes, chunk_size):
+            first = batch[0]["id"]
+            if sizes.get(first, 0) > chunk_size:
+                movies = map(movie_data, large_collection_movies(first, chunk_size))
+                yield collection_data(batch[0], movies)
+                continue
+
+            movies = read_movies([collection["id"] for collection in batch])
+            for collection in batch:
+                items = [movie_data(movie) for movie in movies[collection["id"]]]
+                yield collection_data(collection, items)
+
+
+def ndjson_lines(collections):
+    """
+    one line per collection, the line of a large collection is produced a
+    movie at a time
+    """
+    for collection in collections:
+        movies = collection["movies"]
+        if isinstance(movies, list):
+            yield json.dumps(collection, ensure_ascii=False) + "\n"
+            continue
+        head = json.dumps({**collection, "movies": []}, ensure_ascii=False)
+        # `movies` is the last key, the line goes on after its "["
+        yield head[:-2]
+        for number, movie in enumerate(movies):
+            separator = ", " if number else ""
+            yield separator + json.dumps(movie, ensure_ascii=False)
+        yield "]}\n"
+
+
+class Echo:
+    """
+    file like object handing back what is written, lets csv.writer format
+    one row at a time
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(collections):
+    """
+    one row per movie of a collection, collections without movies get one
+    row with empty movie columns. Genres are separated by "|".
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for collection in collections:
+        head = [collection["id"], collection["title"], collection["description"]]
+        empty = True
+        for movie in collection["movies"]:
+            empty = False
+            yield writer.writerow(
+                head
+                + [
+                    movie["id"],
+                    movie["title"],
+                    movie["description"],
+                    "|".join(movie["genres"]),
+                ]
+            )
+        if empty:
+            yield writer.writerow(head + ["", "", "", ""])
+
+
+def export_lines(user, export_format=NDJSON, chunk_size=1000):
+    """
+    return: iterator of the text of the export, a line or a part of one at a
+    time
+    """
+    collections = export_collections(user, chunk_size=chunk_size)
+    if export_format == CSV:
+        return csv_lines(collections)
+    return ndjson_lines(collections)
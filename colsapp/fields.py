@@ -0,0 +1,129 @@
+from urllib.parse import quote
+from django.urls import NoReverseMatch
+from rest_framework.relations import (
+    MANY_RELATION_KWARGS,
+    HyperlinkedRelatedField,
+    ManyRelatedField,
+    PrimaryKeyRelatedField,
+)
+
+
+class BulkManyRelatedField(ManyRelatedField):
+    """
+    ManyRelatedField fetching every related object with a single query
+    instead of one lookup per item.
+
+    The child relation turns an item into its lookup value without querying
+    (`get_lookup_value`) and reports items which do not exist
+    (`fail_missing`).
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, "__iter__"):
+            self.fail("not_a_list", input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail("empty")
+
+        child = self.child_relation
+        values = [child.get_lookup_value(item) for item in data]
+        if not values:
+            return []
+
+        queryset = child.get_queryset()
+        if child.lookup_field == "pk":
+            # only the keys are needed to write the relation
+            queryset = queryset.only("pk")
+        try:
+            found = queryset.in_bulk(values, field_name=child.lookup_field)
+        except (TypeError, ValueError):
+            child.fail("incorrect_type", data_type=type(values[0]).__name__)
+
+        # in_bulk keys are native values, comparing them as strings
+        found = {str(value): obj for value, obj in found.items()}
+        objects = []
+        for value in values:
+            obj = found.get(str(value))
+            if obj is None:
+                child.fail_missing(value)
+            objects.append(obj)
+        return objects
+
+
+class BulkRelatedFieldMixin:
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {"child_relation": cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return BulkManyRelatedField(**list_kwargs)
+
+
+class BulkPrimaryKeyRelatedField(BulkRelatedFieldMixin, PrimaryKeyRelatedField):
+    """
+    PrimaryKeyRelatedField whose `many=True` form validates in one query
+    """
+
+    lookup_field = "pk"
+
+    def get_lookup_value(self, data):
+        if isinstance(data, bool):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        if self.pk_field is not None:
+            return self.pk_field.to_internal_value(data)
+        return data
+
+    def fail_missing(self, value):
+        self.fail("does_not_exist", pk_value=value)
+
+
+class BulkHyperlinkedRelatedField(BulkRelatedFieldMixin, HyperlinkedRelatedField):
+    """
+    HyperlinkedRelatedField whose `many=True` form validates in one query
+    and renders urls from a template reversed once per serializer instead
+    of calling reverse() for every object
+    """
+
+    _lookup_only = False
+    url_placeholder = "__lookup__"
+
+    def get_url(self, obj, view_name, request, format):
+        if hasattr(obj, "pk") and obj.pk in (None, ""):
+            return None
+
+        templates = self.__dict__.setdefault("_url_templates", {})
+        key = (view_name, format)
+        if key not in templates:
+            try:
+                templates[key] = self.reverse(
+                    view_name,
+                    kwargs={self.lookup_url_kwarg: self.url_placeholder},
+                    request=request,
+                    format=format,
+                )
+            except NoReverseMatch:
+                # the url pattern rejects the placeholder, reverse every time
+                templates[key] = None
+
+        template = templates[key]
+        if template is None:
+            return super().get_url(obj, view_name, request, format)
+        lookup_value = getattr(obj, self.lookup_field)
+        return template.replace(self.url_placeholder, quote(str(lookup_value)))
+
+    def get_lookup_value(self, data):
+        # resolving the url with the regular checks, get_object stops short
+        # of the query and hands back the lookup value
+        self._lookup_only = True
+        try:
+            return self.to_internal_value(data)
+        finally:
+            self._lookup_only = False
+
+    def get_object(self, view_name, view_args, view_kwargs):
+        if self._lookup_only:
+            return view_kwargs[self.lookup_url_kwarg]
+        return super().get_object(view_name, view_args, view_kwargs)
+
+    def fail_missing(self, value):
+        self.fail("does_not_exist")
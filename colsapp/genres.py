@@ -0,0 +1,118 @@
+import functools
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.functions import Lower
+from .models import MovieGenre
+
+# bumped on every genre change so other processes drop their lru too
+GENERATION_KEY = "genre_cache_generation"
+
+
+class GenreResolver:
+    """
+    Resolves genre names to ids with one set based lookup plus one bulk
+    insert of the missing names, through a process local lru of name -> id.
+
+    Names are used as given, callers normalize them (`.capitalize()`).
+    Existing genres are matched case insensitively like the unique index on
+    LOWER(name). Ids resolved inside a transaction are only cached once it
+    commits, a rolled back insert must not leave its id in the lru.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def _check_generation(self):
+        generation = cache.get(GENERATION_KEY, 0)
+        with self._lock:
+            if generation != self._generation:
+                self._ids.clear()
+                self._generation = generation
+
+    def _get(self, name):
+        with self._lock:
+            genre_id = self._ids.get(name)
+            if genre_id is not None:
+                self._ids.move_to_end(name)
+            return genre_id
+
+    def _put(self, name, genre_id):
+        with self._lock:
+            self._ids[name] = genre_id
+            self._ids.move_to_end(name)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def _put_many(self, genre_ids, generation):
+        # a rename or delete since the lookup makes the ids suspect
+        if generation != self._generation:
+            return
+        for name, genre_id in genre_ids.items():
+            self._put(name, genre_id)
+
+    def resolve(self, names, batch_size=None):
+        """
+        params:
+        names: iterable of genre names,
+        batch_size: rows per insert when creating the missing genres
+        return: dict of genre name -> id
+        """
+        names = set(names)
+        if not names:
+            return {}
+
+        self._check_generation()
+        genre_ids = {}
+        for name in names:
+            genre_id = self._get(name)
+            if genre_id is not None:
+                genre_ids[name] = genre_id
+
+        missing = names - set(genre_ids)
+        if missing:
+            found = self._lookup(missing)
+            new_genres = [
+                MovieGenre(name=name) for name in missing if name.lower() not in found
+            ]
+            if new_genres:
+                # a genre created concurrently makes its insert a no-op, the
+                # ids are read back so they are the stored ones either way
+                MovieGenre.objects.bulk_create(
+                    new_genres, batch_size=batch_size, ignore_conflicts=True
+                )
+                found.update(self._lookup(genre.name for genre in new_genres))
+
+            resolved = {name: found[name.lower()] for name in missing}
+            genre_ids.update(resolved)
+            cache_ids = functools.partial(self._put_many, resolved, self._generation)
+            if connection.in_atomic_block:
+                transaction.on_commit(cache_ids)
+            else:
+                cache_ids()
+        return genre_ids
+
+    @staticmethod
+    def _lookup(names):
+        """
+        return: dict of lower cased name -> id of existing genres
+        """
+        return dict(
+            MovieGenre.objects.annotate(lower_name=Lower("name"))
+            .filter(lower_name__in={name.lower() for name in names})
+            .values_list("lower_name", "id")
+        )
+
+    def invalidate(self):
+        with self._lock:
+            self._ids.clear()
+        cache.add(GENERATION_KEY, 0, timeout=None)
+        cache.incr(GENERATION_KEY)
+
+
+genre_resolver = GenreResolver(getattr(settings, "GENRE_CACHE_SIZE", 1024))
@@ -0,0 +1,148 @@
+"""
+Primary key generation for BaseModel.
+
+uuid4 keys are spread over the whole key space, so every insert touches a
+random leaf of the primary key and of the through table indexes. uuid7
+keys start with the unix time in milliseconds, new rows land at the right
+edge of those indexes like a sequence would, while staying uuids of the
+same column type.
+"""
+
+import os
+import random
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, UUIDField, Value, When
+from .response_cache import GENRES, MOVIES, response_cache, user_scope
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+
+def uuid7(timestamp=None):
+    """
+    time ordered uuid, layout of RFC 9562 version 7: 48 bits of unix time
+    in ms, 12 bits of a counter keeping ids of the same ms ordered within
+    the process and 62 random bits
+    params:
+    timestamp: datetime the id is made for, e.g. the created of an existing
+    row, defaults to now
+    """
+    global _last_ms, _counter
+    if timestamp is not None:
+        ms = int(timestamp.timestamp() * 1000)
+        counter = random.getrandbits(12)
+    else:
+        with _lock:
+            ms = time.time_ns() // 1_000_000
+            if ms > _last_ms:
+                # random start, leaving room for the ids of this ms
+                _last_ms, _counter = ms, random.getrandbits(11)
+            else:
+                # same ms or the clock went back, carry on from the last id
+                _counter += 1
+                if _counter > 0xFFF:
+                    _last_ms, _counter = _last_ms + 1, 0
+            ms, counter = _last_ms, _counter
+
+    rand_b = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    value = (ms & ((1 << 48) - 1)) << 80 | 7 << 76 | counter << 64 | 0b10 << 62 | rand_b
+    return uuid.UUID(int=value)
+
+
+def new_id():
+    """
+    default of BaseModel.id, uuid4 unless PRIMARY_KEY_UUID_VERSION is 7
+    """
+    if getattr(settings, "PRIMARY_KEY_UUID_VERSION", 4) == 7:
+        return uuid7()
+    return uuid.uuid4()
+
+
+def referencing_fields(model):
+    """
+    return: foreign keys to the model, including those of m2m through tables
+    """
+    return [
+        relation.field
+        for relation in model._meta.get_fields(include_hidden=True)
+        if relation.auto_created
+        and not relation.concrete
+        and (relation.one_to_many or relation.one_to_one)
+    ]
+
+
+def response_scopes(model, pks):
+    """
+    return: response_cache scopes of the responses showing the ids of the
+    rows, read before the ids change
+    """
+    # models import new_id from this module
+    from .models import Movie, MovieCollection, MovieGenre
+
+    if model is MovieGenre:
+        return {MOVIES, GENRES}
+    if model is MovieCollection:
+        user_ids = model._base_manager.filter(pk__in=pks).values_list(
+            "user_id", flat=True
+        )
+    elif model is Movie:
+        user_ids = Movie.collections.through.objects.filter(
+            movie_id__in=pks
+        ).values_list("moviecollection__user_id", flat=True)
+    else:
+        return set()
+    # movies list their collections, collections their movies
+    return {MOVIES, *[user_scope(user_id) for user_id in set(user_ids)]}
+
+
+def rekey_uuid7(model, batch_size=500):
+    """
+    replaces the non uuid7 ids of the model's rows with uuid7 ids made from
+    their created time, together with every foreign key to them. Foreign
+    keys are checked at commit, so each batch updates the rows and their
+    references in one transaction, and bumps the cached responses showing
+    the old ids once it commits.
+    return: no of rows rekeyed
+    """
+    fields = referencing_fields(model)
+    manager = model._base_manager
+    rekeyed, last = 0, None
+    while True:
+        queryset = manager.order_by("pk")
+        if last is not None:
+            queryset = queryset.filter(pk__gt=last)
+        rows = list(queryset.values_list("pk", "created")[:batch_size])
+        if not rows:
+            return rekeyed
+        last = rows[-1][0]
+
+        # rows rekeyed by an earlier batch come around again, skipping them
+        mapping = {pk: uuid7(created) for pk, created in rows if pk.version != 7}
+        if not mapping:
+            continue
+        with transaction.atomic():
+            response_cache.bump(*response_scopes(model, mapping))
+            for field in fields:
+                field.model._base_manager.filter(
+                    **{f"{field.attname}__in": mapping}
+                ).update(**{field.attname: _switch(field.attname, mapping)})
+            pk_name = model._meta.pk.attname
+            manager.filter(pk__in=mapping).update(
+                **{pk_name: _switch(pk_name, mapping)}
+            )
+        rekeyed += len(mapping)
+
+
+def _switch(name, mapping):
+    return Case(
+        *[
+            When(**{name: old}, then=Value(new, output_field=UUIDField()))
+            for old, new in mapping.items()
+        ],
+        output_field=UUIDField(),
+    )
@@ -0,0 +1,336 @@
+"""
+Bulk import of collections and their movies from NDJSON or CSV.
+
+Records are read lazily and written `batch_size` at a time. The movie ids of
+a batch are resolved with one query per `max_query_params` ids, records
+with unknown movies or invalid fields are reported and skipped, as are the
+links of movies deleted before their batch was written. On postgres the
+collections and the links of a batch are COPYed into temporary staging
+tables and merged with one INSERT ... SELECT each, other databases use
+bulk_create. The links are announced with m2m_bulk_changed so the genre
+counts and cached responses follow.
+
+The files of colsapp.export are accepted: NDJSON lines of
+`{"title", "description", "movies": [id or {"id"}]}` and CSV rows with a
+`collection_title` column and optional `collection_id`,
+`collection_description` and `movie_id` columns, the consecutive rows of a
+collection id (or title) making one collection.
+"""
+
+import csv
+import io
+import json
+import uuid
+from django.db import connection, transaction
+from django.utils import timezone
+from .bulk import m2m_bulk_changed
+from .export import CSV, NDJSON, chunks
+from .ids import new_id
+from .models import Movie, MovieCollection
+from .response_cache import response_cache, user_scope
+
+CollectionMovie = Movie.collections.through
+
+# errors kept for the report, the others are only counted
+MAX_REPORTED_ERRORS = 1000
+
+
+def ndjson_records(lines):
+    """
+    yields (line no, record or None, error or None)
+    """
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, json.loads(line), None
+        except ValueError as exc:
+            yield number, None, f"invalid JSON - {exc}"
+
+
+def csv_records(lines):
+    """
+    yields (line no, record or None, error or None), a record per run of
+    rows of the same collection
+    """
+    lines = (
+        line.decode("utf-8") if isinstance(line, bytes) else line for line in lines
+    )
+    reader = csv.DictReader(lines)
+    if "collection_title" not in (reader.fieldnames or []):
+        yield 1, None, "the collection_title column is missing"
+        return
+
+    key, record, start = None, None, None
+    for row in reader:
+        row_key = row.get("collection_id") or row["collection_title"]
+        if record is None or row_key != key:
+            if record is not None:
+                yield start, record, None
+            key, start = row_key, reader.line_num
+            record = {
+                "title": row["collection_title"],
+                "description": row.get("collection_description") or "",
+                "movies": [],
+            }
+        if row.get("movie_id"):
+            record["movies"].append(row["movie_id"])
+    if record is not None:
+        yield start, record, None
+
+
+def parse_records(lines, import_format=NDJSON):
+    if import_format == CSV:
+        return csv_records(lines)
+    return ndjson_records(lines)
+
+
+def clean_record(record):
+    """
+    return: (title, description, set of movie ids)
+    raises ValueError with the message reported for the record
+    """
+    if not isinstance(record, dict):
+        raise ValueError("expected an object")
+    title = record.get("title")
+    max_length = MovieCollection._meta.get_field("title").max_length
+    if not isinstance(title, str) or not title.strip():
+        raise ValueError("title is required")
+    if len(title) > max_length:
+        raise ValueError(f"title is longer than {max_length} characters")
+    description = record.get("description") or ""
+    if not isinstance(description, str):
+        raise ValueError("description must be a string")
+
+    movies = record.get("movies") or []
+    if not isinstance(movies, list):
+        raise ValueError("movies must be a list")
+    movie_ids = set()
+    for movie in movies:
+        if isinstance(movie, dict):
+            movie = movie.get("id")
+        try:
+            movie_ids.add(uuid.UUID(str(movie)))
+        except ValueError:
+            raise ValueError(f'"{movie}" is not a valid movie id')
+    return title, description, movie_ids
+
+
+class CollectionImporter:
+    """
+    Writes the records of an import for a user, see the module docstring
+    """
+
+    def __init__(self, user, batch_size=5000, progress=None):
+        """
+        params:
+        user: owner of the imported collections,
+        batch_size: no of records written per transaction,
+        progress: called with the report after every batch
+        """
+        self.user = user
+        self.batch_size = batch_size
+        self.progress = progress
+        self.collections = 0
+        self.links = 0
+        # links of rejected records and of movies deleted meanwhile
+        self.skipped_links = 0
+        self.error_count = 0
+        self.errors = []
+
+    def report(self):
+        return {
+            "collections": self.collections,
+            "links": self.links,
+            "skipped_links": self.skipped_links,
+            "error_count": self.error_count,
+            "errors": self.errors,
+        }
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "message": message})
+
+    def run(self, records):
+        """
+        params:
+        records: (line no, record, error) tuples as parse_records yields them
+        return: report of the import
+        """
+        for batch in chunks(records, self.batch_size):
+            self.write_batch(batch)
+            if self.progress is not None:
+                self.progress(self.report())
+        return self.report()
+
+    def resolve_movies(self, movie_ids):
+        """
+        return: set of the ids which exist
+        """
+        movie_ids = list(movie_ids)
+        size = connection.features.max_query_params or len(movie_ids) or 1
+        found = set()
+        for start in range(0, len(movie_ids), size):
+            found.update(
+                Movie.objects.filter(
+                    id__in=movie_ids[start : start + size]
+                ).values_list("id", flat=True)
+            )
+        return found
+
+    def write_batch(self, batch):
+        cleaned = []
+        for line, record, error in batch:
+            if error is None:
+                try:
+                    cleaned.append((line, *clean_record(record)))
+                except ValueError as exc:
+                    error = str(exc)
+            if error is not None:
+                self.add_error(line, error)
+
+        known = self.resolve_movies(
+            {movie_id for *_, movie_ids in cleaned for movie_id in movie_ids}
+        )
+        collections, links, lines = [], set(), {}
+        for line, title, description, movie_ids in cleaned:
+            missing = movie_ids - known
+            if missing:
+                ids = ", ".join(sorted(str(movie_id) for movie_id in missing))
+                self.add_error(line, f"unknown movies {ids}")
+                self.skipped_links += len(movie_ids)
+                continue
+            collection_id = new_id()
+            lines[collection_id] = line
+            collections.append((collection_id, title, description))
+            links.update((collection_id, movie_id) for movie_id in movie_ids)
+        if not collections:
+            return
+
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                added = self.copy_merge(collections, links)
+            else:
+                added = self.bulk_write(collections, links)
+            if added:
+                m2m_bulk_changed.send(
+                    sender=CollectionMovie,
+                    through=CollectionMovie,
+                    source_field="moviecollection_id",
+                    target_field="movie_id",
+                    action="post_add",
+                    pairs=added,
+                )
+            # the collection list changed, with or without links
+            response_cache.bump(user_scope(self.user.pk))
+        self.collections += len(collections)
+        self.links += len(added)
+        self.report_dropped(links - added, lines)
+
+    def report_dropped(self, dropped, lines):
+        """
+        reports the links which were not written, their movie was deleted
+        after the batch resolved it
+        params:
+        lines: line no of every collection id
+        """
+        by_collection = {}
+        for collection_id, movie_id in dropped:
+            by_collection.setdefault(collection_id, []).append(str(movie_id))
+        for collection_id, movie_ids in by_collection.items():
+            ids = ", ".join(sorted(movie_ids))
+            self.add_error(lines[collection_id], f"movies deleted meanwhile {ids}")
+        self.skipped_links += len(dropped)
+
+    def bulk_write(self, collections, links):
+        now = timezone.now()
+        MovieCollection.objects.bulk_create(
+            [
+                MovieCollection(
+                    id=collection_id,
+                    created=now,
+                    modified=now,
+                    title=title,
+                    description=description,
+                    user=self.user,
+                )
+                for collection_id, title, description in collections
+            ]
+        )
+        CollectionMovie.objects.bulk_create(
+            [
+                CollectionMovie(moviecollection_id=collection_id, movie_id=movie_id)
+                for collection_id, movie_id in links
+            ],
+            ignore_conflicts=True,
+        )
+        return links
+
+    def copy_merge(self, collections, links):
+        """
+        COPYs the batch into staging tables and merges them with set based
+        inserts, movies deleted since they were resolved are left out by the
+        join. The tables are dropped at the end of the batch, ON COMMIT DROP
+        alone would keep them for the next batch inside an outer transaction.
+        return: set of the links inserted
+        """
+        qn = connection.ops.quote_name
+        opts = MovieCollection._meta
+        columns = ", ".join(
+            qn(opts.get_field(name).column)
+            for name in ("id", "created", "modified", "active", "title")
+        )
+        description = qn(opts.get_field("description").column)
+        user = qn(opts.get_field("user").column)
+        through = CollectionMovie._meta
+        source = qn(through.get_field("moviecollection").column)
+        target = qn(through.get_field("movie").column)
+        movie_id = qn(Movie._meta.pk.column)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE colsapp_import_collection "
+                "(id uuid, title varchar(200), description text) ON COMMIT DROP"
+            )
+            cursor.execute(
+                "CREATE TEMPORARY TABLE colsapp_import_link "
+                "(collection_id uuid, movie_id uuid) ON COMMIT DROP"
+            )
+            copy_rows(cursor, "colsapp_import_collection", collections)
+            copy_rows(cursor, "colsapp_import_link", links)
+
+            now = timezone.now()
+            cursor.execute(
+                f"INSERT INTO {qn(opts.db_table)} ({columns}, {description}, {user}) "
+                f"SELECT id, %s, %s, true, title, description, %s "
+                f"FROM colsapp_import_collection",
+                [now, now, self.user.pk],
+            )
+            cursor.execute(
+                f"INSERT INTO {qn(through.db_table)} ({source}, {target}) "
+                f"SELECT link.collection_id, link.movie_id "
+                f"FROM colsapp_import_link link "
+                f"JOIN {qn(Movie._meta.db_table)} movie "
+                f"ON movie.{movie_id} = link.movie_id "
+                f"ON CONFLICT DO NOTHING RETURNING {source}, {target}"
+            )
+            added = set(cursor.fetchall())
+            cursor.execute(
+                "DROP TABLE IF EXISTS colsapp_import_collection, colsapp_import_link"
+            )
+            return added
+
+
+def copy_rows(cursor, table, rows):
+    """
+    loads the rows into the table with COPY, every value quoted so empty
+    strings are not read as NULL
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv)", buffer)
@@ -0,0 +1,243 @@
+import logging
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from maya_api.breaker import CircuitBreaker
+from maya_api.client import MayaApiClient
+from .bulk import bulk_link, bulk_unlink
+from .genres import genre_resolver
+from .models import Movie, IngestionCheckpoint
+from .response_cache import MOVIES, response_cache
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionError(Exception):
+    pass
+
+
+def normalize_genres(genres):
+    """
+    maya sends genres as a comma separated string, a list is accepted too
+    return: list of unique capitalized genre names in input order
+    """
+    if not genres:
+        return []
+    if isinstance(genres, str):
+        genres = genres.split(",")
+
+    names = []
+    for genre in genres:
+        name = genre.strip().capitalize()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+class MayaIngestor:
+    """
+    Streams every page of maya `movies/` endpoint into Movie/MovieGenre.
+
+    Pages are fetched `concurrency` at a time and written as one window per
+    transaction together with the checkpoint, so an interrupted run resumes
+    from the last written page. Runs after a finished one are incremental,
+    they fetch the last page again, it may have been partial, and the pages
+    maya added after it. `restart` goes over every page again, only movies
+    which are new or changed are written.
+
+    Its calls go through a breaker of their own, without latency budgets, so
+    a slow run neither opens maya_breaker of the live views nor has its
+    timeout replaced by their budgets.
+    """
+
+    source = "maya:movies"
+
+    def __init__(
+        self,
+        concurrency=8,
+        batch_size=2000,
+        client_kwargs=None,
+        stdout=None,
+    ):
+        """
+        params:
+        concurrency: max no of pages fetched in parallel,
+        batch_size: no of rows per bulk insert/update,
+        client_kwargs: kwargs passed to MayaApiClient e.g. base_url, its
+        timeout is the timeout of every attempt,
+        stdout: stream for progress messages
+        """
+        self.concurrency = max(int(concurrency), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.client_kwargs = client_kwargs or {}
+        self.stdout = stdout
+        self._local = threading.local()
+        self.breaker = CircuitBreaker(
+            "maya_ingestion",
+            LATENCY_BUDGETS={},
+            ADAPTIVE_TIMEOUT_FACTOR=None,
+            HEDGE_AFTER=None,
+        )
+        self.stats = {"pages": 0, "created": 0, "updated": 0, "unchanged": 0}
+
+    def _client(self):
+        # requests sessions are not shared across threads
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = MayaApiClient(
+                **{"breaker": self.breaker, **self.client_kwargs}
+            )
+        return client
+
+    def _log(self, message):
+        logger.info(message)
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def fetch_page(self, page):
+        data = self._client().get_movie_list(page=page)
+        # API seems to be return is_success flag in case of failure
+        if "is_success" in data:
+            raise IngestionError(f"maya returned failure for page {page}: {data}")
+        return data
+
+    def run(self, restart=False):
+        checkpoint, _ = IngestionCheckpoint.objects.get_or_create(source=self.source)
+        if restart:
+            checkpoint.last_page = 0
+        first_page = checkpoint.last_page + 1
+        if checkpoint.finished and not restart:
+            # new movies may have been appended to the last page
+            first_page = max(checkpoint.last_page, 1)
+        if restart or checkpoint.finished:
+            checkpoint.finished = False
+            checkpoint.save()
+
+        data = self.fetch_page(first_page)
+        page_size = settings.MAYA_SETTINGS.get("PAGE_SIZE")
+        if not page_size and data.get("next"):
+            # only a page followed by others is known to be a full one
+            page_size = len(data.get("results") or [])
+        page_size = page_size or 1
+        total_pages = first_page + math.ceil(
+            max(data.get("count", 0) - first_page * page_size, 0) / page_size
+        )
+        if not data.get("next"):
+            total_pages = first_page
+        self._log(f"ingesting pages {first_page}..{total_pages} from maya")
+
+        # enough pages per window to fill a batch, at least one per worker
+        window = max(self.concurrency, self.batch_size // page_size)
+        pending = {first_page: data}
+        page = first_page + 1
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                pages = list(range(page, min(page + window, total_pages + 1)))
+                fetched = dict(zip(pages, executor.map(self.fetch_page, pages)))
+                fetched.update(pending)
+                pending = {}
+                if not fetched:
+                    break
+
+                last_page = max(fetched)
+                records = []
+                for number in sorted(fetched):
+                    records.extend(fetched[number].get("results") or [])
+
+                with transaction.atomic():
+                    self.write(records)
+                    checkpoint.last_page = last_page
+                    checkpoint.save(update_fields=["last_page", "modified"])
+
+                self.stats["pages"] += len(fetched)
+                self._log(f"page {last_page}/{total_pages} done, {self.stats}")
+                page = last_page + 1
+
+        checkpoint.finished = True
+        checkpoint.save(update_fields=["finished", "modified"])
+        return self.stats
+
+    def write(self, records):
+        """
+        upserts a list of maya movie records along with their genres
+        """
+        movies = {}
+        for record in records:
+            movies[str(record["uuid"])] = {
+                "title": record.get("title", ""),
+                "description": record.get("description") or "",
+                "genres": normalize_genres(record.get("genres")),
+            }
+        if not movies:
+            return
+
+        genre_ids = genre_resolver.resolve(
+            {name for movie in movies.values() for name in movie["genres"]},
+            batch_size=self.batch_size,
+        )
+        existing = {
+            str(movie.maya_uuid): movie
+            for movie in Movie.objects.filter(maya_uuid__in=movies.keys()).only(
+                "id", "maya_uuid", "title", "description"
+            )
+        }
+
+        Through = Movie.genres.through
+        current_links = set()
+        if existing:
+            current_links = set(
+                Through.objects.filter(
+                    movie_id__in=[movie.id for movie in existing.values()]
+                ).values_list("movie_id", "moviegenre_id")
+            )
+
+        now = timezone.now()
+        to_create, to_update, wanted_links = [], [], set()
+        for maya_uuid, values in movies.items():
+            movie = existing.get(maya_uuid)
+            if movie is None:
+                movie = Movie(
+                    maya_uuid=maya_uuid,
+                    title=values["title"],
+                    description=values["description"],
+                )
+                to_create.append(movie)
+            elif (movie.title, movie.description) != (
+                values["title"],
+                values["description"],
+            ):
+                movie.title = values["title"]
+                movie.description = values["description"]
+                movie.modified = now
+                to_update.append(movie)
+
+            for name in values["genres"]:
+                wanted_links.add((movie.id, genre_ids[name]))
+
+        Movie.objects.bulk_create(to_create, batch_size=self.batch_size)
+        Movie.objects.bulk_update(
+            to_update, ["title", "description", "modified"], batch_size=self.batch_size
+        )
+
+        # bulk helpers keep the genre counts of collected movies up to date
+        bulk_unlink(Through, "movie_id", "moviegenre_id", current_links - wanted_links)
+        bulk_link(
+            Through,
+            "movie_id",
+            "moviegenre_id",
+            wanted_links - current_links,
+            batch_size=self.batch_size,
+            known=True,
+        )
+
+        if to_create or to_update:
+            # bulk writes send no post_save
+            response_cache.bump(MOVIES)
+
+        self.stats["created"] += len(to_create)
+        self.stats["updated"] += len(to_update)
+        self.stats["unchanged"] += len(movies) - len(to_create) - len(to_update)
@@ -0,0 +1,105 @@
+import inspect
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+from colsapp.models import Movie, MovieCollection, MovieGenre
+from colsapp.pagination import SelectablePagination
+from colsapp.renderers import FastJSONRenderer, orjson
+from colsapp.views import CollectionViewset, MovieViewset
+
+# (name, row serialization, renderer)
+MODES = [
+    ("serializers + JSONRenderer", False, JSONRenderer),
+    ("rows + JSONRenderer", True, JSONRenderer),
+    ("rows + FastJSONRenderer", True, FastJSONRenderer),
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the CPU time of movie and collection list requests built by "
+        "the serializers and by the row serializers, on scratch rows which "
+        "are rolled back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--movies", type=int, default=1000)
+        parser.add_argument("--page-size", type=int, default=100)
+        parser.add_argument("--repeat", type=int, default=50)
+
+    def create_rows(self, movies):
+        user = User.objects.create_user(username="benchmark_list_serialization")
+        genres = [MovieGenre.objects.create(name=f"Genre {i}") for i in range(5)]
+        for i in range(movies // 10):
+            collection = MovieCollection.objects.create(title=f"c{i}", user=user)
+            for j in range(10):
+                movie = Movie.objects.create(title=f"m{i} {j}", description="x" * 200)
+                movie.collections.add(collection)
+                movie.genres.add(*genres[: j % 5 + 1])
+        return user
+
+    def view(self, viewset, renderer, page_size):
+        class View(viewset):
+            # measuring the views, not the response cache
+            list = inspect.unwrap(viewset.list)
+            renderer_classes = [renderer]
+            pagination_class = type(
+                "Pagination", (SelectablePagination,), {"page_size": page_size}
+            )
+
+        return View.as_view({"get": "list"})
+
+    def measure(self, view, url, user, repeat):
+        factory = APIRequestFactory()
+        elapsed = 0.0
+        for _ in range(repeat):
+            request = factory.get(url)
+            force_authenticate(request, user)
+            start = time.process_time()
+            response = view(request)
+            response.render()
+            elapsed += time.process_time() - start
+        return elapsed / repeat, response.content
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            encoder = "the json module, orjson is not installed"
+        else:
+            encoder = f"orjson {orjson.__version__}"
+        self.stdout.write(f"FastJSONRenderer encodes with {encoder}")
+        try:
+            with transaction.atomic():
+                user = self.create_rows(options["movies"])
+                for name, viewset, url in [
+                    ("movies", MovieViewset, "/api/v1/movies/"),
+                    ("collections", CollectionViewset, "/api/v1/collections/"),
+                ]:
+                    self.run(name, viewset, url, user, options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, name, viewset, url, user, options):
+        baseline = content = None
+        for mode, rows, renderer in MODES:
+            view = self.view(viewset, renderer, options["page_size"])
+            with override_settings(FAST_LIST_SERIALIZATION=rows):
+                # the first request warms the url and query caches
+                self.measure(view, url, user, 1)
+                elapsed, mode_content = self.measure(view, url, user, options["repeat"])
+
+            if baseline is None:
+                baseline, content = elapsed, mode_content
+            same = "same output" if mode_content == content else "OUTPUT DIFFERS"
+            self.stdout.write(
+                f"{name}, {mode}: {elapsed * 1000:.2f} ms cpu per request, "
+                f"x{baseline / elapsed:.1f}, {same}"
+            )
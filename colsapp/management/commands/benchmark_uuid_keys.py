@@ -0,0 +1,89 @@
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from colsapp.ids import uuid7
+
+GENERATORS = {"uuid4": uuid.uuid4, "uuid7": uuid7}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare insert throughput and primary key index size of uuid4 and "
+        "uuid7 keys on scratch tables"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10_000_000)
+        parser.add_argument(
+            "--batch-size", type=int, default=1000, help="rows per insert"
+        )
+        parser.add_argument(
+            "--report-every", type=int, default=1_000_000, help="rows between reports"
+        )
+
+    def index_size(self, table):
+        if connection.vendor == "postgresql":
+            sql, params = "SELECT pg_relation_size(%s)", [f"{table}_pkey"]
+        elif connection.vendor == "sqlite":
+            # needs sqlite built with the dbstat table, most builds are
+            sql = "SELECT SUM(pgsize) FROM dbstat WHERE name = %s"
+            params = [f"sqlite_autoindex_{table}_1"]
+        else:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+    def run(self, name, generate, rows, batch_size, report_every):
+        table = f"benchmark_{name}"
+        created = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            cursor.execute(
+                f"CREATE TABLE {table} (id uuid, created timestamp, "
+                f"CONSTRAINT {table}_pkey PRIMARY KEY (id))"
+            )
+
+        elapsed, inserted = 0.0, 0
+        try:
+            while inserted < rows:
+                count = min(batch_size, rows - inserted)
+                params = []
+                for _ in range(count):
+                    params += [str(generate()), created]
+                sql = f"INSERT INTO {table} (id, created) VALUES " + ", ".join(
+                    ["(%s, %s)"] * count
+                )
+                start = time.perf_counter()
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                elapsed += time.perf_counter() - start
+
+                previous, inserted = inserted, inserted + count
+                if inserted // report_every != previous // report_every:
+                    self.stdout.write(
+                        f"{name}: {inserted} rows, {inserted / elapsed:.0f} rows/s"
+                    )
+            return inserted / elapsed, self.index_size(table)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def handle(self, *args, **options):
+        results = {}
+        for name, generate in GENERATORS.items():
+            results[name] = self.run(
+                name,
+                generate,
+                options["rows"],
+                options["batch_size"],
+                options["report_every"],
+            )
+
+        for name, (throughput, size) in results.items():
+            size = "n/a" if size is None else f"{size / 2 ** 20:.1f} MiB"
+            self.stdout.write(
+                f"{name}: {throughput:.0f} rows/s, primary key index {size}"
+            )
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from colsapp.aggregates import check_genre_counts, rebuild_genre_counts
+
+
+class Command(BaseCommand):
+    help = "Compare the materialized per user genre counts with a fresh count"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user", type=int, action="append", help="only check these user ids"
+        )
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="rebuild the counts of the users which differ",
+        )
+
+    def handle(self, *args, **options):
+        mismatches = check_genre_counts(options["user"])
+        for user_id, genre_id, stored, expected in mismatches:
+            self.stdout.write(
+                f"user {user_id} genre {genre_id}: stored {stored}, expected {expected}"
+            )
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("genre counts are consistent"))
+            return
+
+        if options["fix"]:
+            user_ids = sorted({user_id for user_id, *_ in mismatches})
+            with transaction.atomic():
+                rebuild_genre_counts(user_ids)
+            self.stdout.write(self.style.SUCCESS(f"rebuilt {len(user_ids)} users"))
+            return
+
+        raise CommandError(f"{len(mismatches)} genre counts differ")
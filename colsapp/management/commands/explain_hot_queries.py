@@ -0,0 +1,158 @@
+import json
+import uuid
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models.functions import Lower
+from django.utils import timezone
+from colsapp.pagination import keyset_after
+from colsapp.models import Movie, MovieCollection, MovieGenre, UserGenreCount
+from colsapp.search import search
+
+INDEX_SCANS = {"Index Scan", "Index Only Scan", "Bitmap Index Scan"}
+
+# text an Index Cond of the query has to contain, keyset pages have to seek
+# to their position in the index rather than filter the rows before it
+INDEX_CONDS = {
+    "collections keyset page": "created",
+    "movies keyset page": "created",
+}
+
+
+def hot_queries(user):
+    """
+    Lists are read through active_objects like the list views, served by the
+    partial indexes on active rows. Retrieve and update read through objects
+    on purpose: a primary key lookup is served by the pk index either way,
+    and a deactivated row stays reachable by its id.
+
+    return: list of (name, queryset) of the queries behind the views and
+    fav_genres, with made up values where the db has no rows
+    """
+    now = timezone.now()
+    some_id = uuid.uuid4()
+    after = keyset_after(("created", "id"), (now, some_id))
+    collections = user.collections(manager="active_objects").order_by("created", "id")
+    movies = Movie.active_objects.order_by("created", "id")
+    return [
+        ("collections list", collections[:11]),
+        ("collection detail", user.collections.filter(pk=some_id)),
+        ("collections keyset page", collections.filter(after)[:11]),
+        (
+            "collection movies prefetch",
+            Movie.objects.only("id").filter(collections__in=[some_id]),
+        ),
+        ("movies list", movies[:11]),
+        ("movie detail", Movie.objects.filter(pk=some_id)),
+        ("movies keyset page", movies.filter(after)[:11]),
+        (
+            "movie genres prefetch",
+            MovieGenre.objects.only("id", "name").filter(movies__in=[some_id]),
+        ),
+        (
+            "fav genres",
+            UserGenreCount.objects.filter(user=user, movie_count__gt=0)
+            .values_list("genre__name", flat=True)
+            .order_by("-movie_count")[:3],
+        ),
+        (
+            "genres by name",
+            MovieGenre.objects.annotate(lower_name=Lower("name")).filter(
+                lower_name__in=["drama"]
+            ),
+        ),
+        (
+            "collections of movies",
+            Movie.collections.through.objects.filter(movie_id__in=[some_id]),
+        ),
+        (
+            "movies of collections",
+            Movie.collections.through.objects.filter(moviecollection_id__in=[some_id]),
+        ),
+        (
+            "genres of movies",
+            Movie.genres.through.objects.filter(movie_id__in=[some_id]),
+        ),
+        (
+            "movies of genres",
+            Movie.genres.through.objects.filter(moviegenre_id__in=[some_id]),
+        ),
+        ("movie search", search(Movie.objects.all(), "alien")),
+        (
+            "collection search",
+            search(MovieCollection.objects.filter(user=user), "alien"),
+        ),
+    ]
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def check_plan(plan, index_cond=None):
+    """
+    params:
+    plan: "Plan" of an EXPLAIN (FORMAT JSON),
+    index_cond: text an Index Cond of the plan has to contain
+    return: (names of the indexes used, list of problems)
+    """
+    nodes = list(plan_nodes(plan))
+    index_nodes = [node for node in nodes if node["Node Type"] in INDEX_SCANS]
+    indexes = sorted({node["Index Name"] for node in index_nodes})
+    problems = [
+        f"seq scan on {node['Relation Name']}"
+        for node in nodes
+        if node["Node Type"] == "Seq Scan"
+    ]
+    if not indexes and not problems:
+        problems.append("no index used")
+    if index_cond is not None and not any(
+        index_cond in node.get("Index Cond", "") for node in index_nodes
+    ):
+        problems.append(f"{index_cond} is not an index condition")
+    return indexes, problems
+
+
+class Command(BaseCommand):
+    help = (
+        "EXPLAIN the hot queries of colsapp and fail on sequential scans, "
+        "run it against a db of production size"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="user id the queries run for")
+        parser.add_argument(
+            "--no-seqscan",
+            action="store_true",
+            help=(
+                "turn enable_seqscan off to see whether an index can serve the "
+                "queries at all, e.g. on a small dev db"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("the checks read postgres query plans")
+
+        user = User(id=options["user"] or 0)
+        failed = []
+        for name, queryset in hot_queries(user):
+            with transaction.atomic():
+                if options["no_seqscan"]:
+                    # an index which can serve the query is then always used
+                    with connection.cursor() as cursor:
+                        cursor.execute("SET LOCAL enable_seqscan = off")
+                plan = json.loads(queryset.explain(format="json"))[0]["Plan"]
+
+            indexes, problems = check_plan(plan, INDEX_CONDS.get(name))
+            if problems:
+                failed.append(name)
+                self.stdout.write(self.style.ERROR(f"{name}: {', '.join(problems)}"))
+            else:
+                self.stdout.write(f"{name}: {', '.join(indexes)}")
+
+        if failed:
+            raise CommandError(f"{len(failed)} queries do not use an index")
+        self.stdout.write(self.style.SUCCESS("every hot query uses an index"))
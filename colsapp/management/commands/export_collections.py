@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from colsapp.export import FORMATS, NDJSON, export_lines
+
+
+class Command(BaseCommand):
+    help = "Stream every collection of a user with its movies as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument("user", help="username or id of the user")
+        parser.add_argument("--type", choices=sorted(FORMATS), default=NDJSON)
+        parser.add_argument(
+            "--output", help="file written to, the export goes to stdout otherwise"
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.EXPORT_CHUNK_SIZE,
+            help="collections or movies read per query",
+        )
+
+    def get_user(self, value):
+        lookup = {"pk": value} if value.isdigit() else {"username": value}
+        try:
+            return User.objects.get(**lookup)
+        except User.DoesNotExist:
+            raise CommandError(f"user {value} does not exist")
+
+    def handle(self, *args, **options):
+        user = self.get_user(options["user"])
+        lines = export_lines(user, options["type"], chunk_size=options["chunk_size"])
+        if not options["output"]:
+            for line in lines:
+                self.stdout.write(line, ending="")
+            return
+
+        count = 0
+        with open(options["output"], "w", encoding="utf-8", newline="") as output:
+            for line in lines:
+                output.write(line)
+                count += line.endswith("\n")
+        self.stderr.write(f"{count} lines written to {options['output']}")
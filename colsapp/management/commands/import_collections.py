@@ -0,0 +1,69 @@
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from colsapp.export import CSV, FORMATS, NDJSON
+from colsapp.imports import CollectionImporter, parse_records
+
+
+class Command(BaseCommand):
+    help = (
+        "Create a user's collections and their movie links from an NDJSON or "
+        "CSV file in the shape of export_collections"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("user", help="username or id of the owner")
+        parser.add_argument("path", help="file to import")
+        parser.add_argument(
+            "--type",
+            choices=sorted(FORMATS),
+            help="format of the file, defaults to its extension",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.IMPORT_BATCH_SIZE,
+            help="collections written per transaction",
+        )
+
+    def get_user(self, value):
+        lookup = {"pk": value} if value.isdigit() else {"username": value}
+        try:
+            return User.objects.get(**lookup)
+        except User.DoesNotExist:
+            raise CommandError(f"user {value} does not exist")
+
+    def handle(self, *args, **options):
+        user = self.get_user(options["user"])
+        import_format = options["type"]
+        if import_format is None:
+            import_format = CSV if options["path"].endswith(".csv") else NDJSON
+
+        start = time.monotonic()
+
+        def progress(report):
+            elapsed = time.monotonic() - start
+            self.stdout.write(
+                f"{report['collections']} collections, {report['links']} links, "
+                f"{report['error_count']} errors in {elapsed:.1f}s"
+            )
+
+        importer = CollectionImporter(
+            user, batch_size=options["batch_size"], progress=progress
+        )
+        with open(options["path"], encoding="utf-8", newline="") as lines:
+            report = importer.run(parse_records(lines, import_format))
+
+        for error in report["errors"]:
+            self.stderr.write(f"line {error['line']}: {error['message']}")
+        if report["error_count"] > len(report["errors"]):
+            self.stderr.write(
+                f"{report['error_count'] - len(report['errors'])} more errors"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"imported {report['collections']} collections with "
+                f"{report['links']} links, {report['skipped_links']} links skipped"
+            )
+        )
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from maya_api.exceptions import BaseException as MayaException
+from colsapp.ingestion import MayaIngestor, IngestionError
+
+
+class Command(BaseCommand):
+    help = "Ingest the maya movie catalog into Movie/MovieGenre"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", type=int, default=8, help="pages fetched in parallel"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=2000, help="rows per bulk write"
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="ignore the checkpoint and start from the first page",
+        )
+        parser.add_argument(
+            "--base-url", help="maya base url, e.g. of a local fake server"
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=10,
+            help="seconds of every maya request attempt",
+        )
+
+    def handle(self, *args, **options):
+        client_kwargs = {"timeout": options["timeout"]}
+        if options["base_url"]:
+            client_kwargs["base_url"] = options["base_url"]
+
+        ingestor = MayaIngestor(
+            concurrency=options["concurrency"],
+            batch_size=options["batch_size"],
+            client_kwargs=client_kwargs,
+            stdout=self.stdout,
+        )
+        try:
+            stats = ingestor.run(restart=options["restart"])
+        except (IngestionError, MayaException) as e:
+            raise CommandError(f"ingestion stopped, re-run to resume: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"ingestion finished {stats}"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from colsapp.aggregates import rebuild_genre_counts
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialized per user genre counts behind fav_genres"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user", type=int, action="append", help="only rebuild these user ids"
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rows = rebuild_genre_counts(options["user"])
+        self.stdout.write(self.style.SUCCESS(f"{rows} genre counts written"))
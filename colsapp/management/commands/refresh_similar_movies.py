@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from colsapp.similarity import METRICS, refresh_all, refresh_changed
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute the movies collected together with every movie, served by "
+        "the similar action of the movies api. Needs numpy and scipy."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--changed",
+            action="store_true",
+            help="only the movies whose collections changed since the last run",
+        )
+        parser.add_argument(
+            "--top-k",
+            type=int,
+            default=settings.SIMILAR_MOVIES_TOP_K,
+            help="similar movies kept per movie",
+        )
+        parser.add_argument(
+            "--metric", choices=METRICS, default=settings.SIMILAR_MOVIES_METRIC
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="links read and rows written per query",
+        )
+        parser.add_argument(
+            "--block-size",
+            type=int,
+            default=1000,
+            help="movies multiplied at once, bounds the memory of a step",
+        )
+
+    def handle(self, *args, **options):
+        kwargs = {
+            "k": options["top_k"],
+            "metric": options["metric"],
+            "chunk_size": options["chunk_size"],
+            "block_size": options["block_size"],
+        }
+        try:
+            if options["changed"]:
+                movies, rows = refresh_changed(**kwargs)
+                message = f"{rows} similar movies written for {movies} changed movies"
+            else:
+                rows = refresh_all(**kwargs)
+                message = f"{rows} similar movies written"
+        except ImproperlyConfigured as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,54 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from colsapp.genres import genre_resolver
+from colsapp.ids import rekey_uuid7
+from colsapp.models import BaseModel
+
+
+class Command(BaseCommand):
+    help = (
+        "Give existing colsapp rows time ordered uuid7 ids made from their "
+        "created time, updating every foreign key. Ids are part of the api "
+        "urls, run it before they are shared or with the clients warned."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--model",
+            action="append",
+            help="model name to rekey, every colsapp model by default",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="rows per transaction"
+        )
+        parser.add_argument(
+            "--noinput",
+            action="store_false",
+            dest="interactive",
+            help="do not ask for confirmation",
+        )
+
+    def handle(self, *args, **options):
+        models = [
+            model
+            for model in apps.get_app_config("colsapp").get_models()
+            if issubclass(model, BaseModel)
+        ]
+        if options["model"]:
+            names = {name.lower() for name in options["model"]}
+            models = [model for model in models if model._meta.model_name in names]
+            if len(models) != len(names):
+                raise CommandError(f"unknown model in {', '.join(options['model'])}")
+
+        if options["interactive"]:
+            answer = input("Every id of these models changes, type 'yes' to go on: ")
+            if answer != "yes":
+                raise CommandError("rekey cancelled")
+
+        for model in models:
+            rekeyed = rekey_uuid7(model, batch_size=options["batch_size"])
+            self.stdout.write(f"{model._meta.model_name}: {rekeyed} rows rekeyed")
+
+        # the lru maps genre names to the old ids
+        genre_resolver.invalidate()
+        self.stdout.write(self.style.SUCCESS("rekey finished"))
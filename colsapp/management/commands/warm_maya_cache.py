@@ -0,0 +1,91 @@
+import functools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from colsapp.maya_cache import maya_cache, page_key
+from colsapp.views import load_movie_page
+
+
+class Command(BaseCommand):
+    help = (
+        "Load every maya movie page into the maya cache under the keys of "
+        "home_page, once or every --every seconds, so users never hit a cold "
+        "page"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", type=int, default=4, help="pages fetched in parallel"
+        )
+        parser.add_argument(
+            "--max-pages", type=int, help="only warm the first pages, default all"
+        )
+        parser.add_argument(
+            "--every", type=int, help="seconds between runs, runs once without it"
+        )
+        parser.add_argument("--path", default="/", help="path of home_page")
+
+    def warm_page(self, path, page):
+        """
+        return: stored entry, None when another worker is loading the page
+        """
+        return maya_cache.warm(
+            page_key(path, page), functools.partial(load_movie_page, page, path)
+        )
+
+    def warm(self, path, concurrency, max_pages=None):
+        """
+        return: (no of pages warmed, no of failed pages, no of skipped pages)
+        """
+        # the landing page, without ?page=, tells the no of pages and is
+        # the first page, the loop below starts from the second
+        first = self.warm_page(path, None)
+        warmed, failed, skipped = 0, 0, 0
+        if first is not None:
+            warmed += 1
+        else:
+            skipped += 1
+            first, _ = maya_cache.get_or_load(
+                page_key(path), functools.partial(load_movie_page, None, path)
+            )
+        if not first["ok"]:
+            raise CommandError("maya did not return the first page")
+
+        page_size = settings.MAYA_SETTINGS.get("PAGE_SIZE", 10)
+        last_page = max(math.ceil(first["data"].get("count", 0) / page_size), 1)
+        if max_pages is not None:
+            last_page = min(last_page, max_pages)
+
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            pages = range(2, last_page + 1)
+            for entry in executor.map(functools.partial(self.warm_page, path), pages):
+                if entry is None:
+                    skipped += 1
+                elif entry["ok"]:
+                    warmed += 1
+                else:
+                    failed += 1
+        return warmed, failed, skipped
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.monotonic()
+            try:
+                warmed, failed, skipped = self.warm(
+                    options["path"], options["concurrency"], options["max_pages"]
+                )
+            except CommandError as e:
+                if not options["every"]:
+                    raise
+                # maya is down, the next run tries again
+                self.stderr.write(str(e))
+            else:
+                self.stdout.write(
+                    f"{warmed} pages warmed, {failed} failed, {skipped} skipped "
+                    f"in {time.monotonic() - start:.1f}s"
+                )
+            if not options["every"]:
+                break
+            time.sleep(options["every"])
@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from maya_api.client import get_client
+from moviecollection.counters import BatchedCounter, redis_client
+from moviecollection.metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+FRESH = "fresh"
+STALE = "stale"
+MISS = "miss"
+
+DEFAULT_MAYA_CACHE_SETTINGS = {
+    "TTL": 60,
+    "STALE_TTL": 600,
+    "ERROR_TTL": 5,
+    # None outlives the slowest maya call of the client, see lock_timeout
+    "LOCK_TIMEOUT": None,
+    "LOCK_WAIT": 5,
+    "POLL_INTERVAL": 0.05,
+    # fresh ttls are spread by +-TTL_JITTER so keys stored together, e.g.
+    # by warm_maya_cache, do not expire together
+    "TTL_JITTER": 0.1,
+    # pages after the requested one loaded in the background
+    "PREFETCH_PAGES": 1,
+    # max prefetches running at once, the others are dropped
+    "PREFETCH_WORKERS": 4,
+}
+
+STAT_NAMES = (
+    "hit",
+    "stale",
+    "miss",
+    "coalesced",
+    "unavailable",
+    "upstream",
+    "upstream_error",
+    "prefetch",
+)
+
+# deletes the lock only while it still holds our token, a lock which expired
+# and was taken by another worker is left alone
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def page_key(path, page=None):
+    """
+    return: cache key of a home_page response, `movies_{full_path}` as the
+    views build it
+    """
+    if page is None:
+        return f"movies_{path}"
+    return f"movies_{path}?page={page}"
+
+
+class MayaResponseCache:
+    """
+    Proxy cache for maya responses.
+
+    Entries are fresh for `TTL` seconds and then served stale for up to
+    `STALE_TTL` seconds while a single worker, holding a redis lock on the
+    key, refreshes them in the background. On a cold key only the lock
+    holder calls maya and the other workers wait for its result, for up to
+    `LOCK_WAIT` seconds, after which they are served an unavailable entry
+    rather than calling maya too. Failed responses are cached for
+    `ERROR_TTL` seconds only, and a stale good response is preferred over an
+    error while maya is down: it keeps its expiry and is served stale, maya
+    is not asked again for `ERROR_TTL` seconds.
+
+    A loader returns a `(data, ok)` tuple, entries are dicts with `data`,
+    `ok` and `fresh_until` keys, and `retry_after` once a refresh failed.
+
+    `prefetch` loads a key on a small thread pool without blocking the
+    caller, `warm` reloads a key right away whether it is fresh or not.
+    """
+
+    def __init__(self, **options):
+        config = dict(DEFAULT_MAYA_CACHE_SETTINGS)
+        config.update(getattr(settings, "MAYA_CACHE", {}))
+        config.update(options)
+        self.ttl = config["TTL"]
+        self.stale_ttl = config["STALE_TTL"]
+        self.error_ttl = config["ERROR_TTL"]
+        self._lock_timeout = config["LOCK_TIMEOUT"]
+        self.lock_wait = config["LOCK_WAIT"]
+        self.poll_interval = config["POLL_INTERVAL"]
+        self.ttl_jitter = config["TTL_JITTER"]
+        self.prefetch_pages = config["PREFETCH_PAGES"]
+        self.prefetch_workers = config["PREFETCH_WORKERS"]
+        self._prefetch_slots = threading.BoundedSemaphore(self.prefetch_workers)
+        self._executor = None
+        # background refreshes of aget_or_load, the loop only keeps weak
+        # references to its tasks
+        self._tasks = set()
+        self.stats = {name: BatchedCounter(f"maya_cache:{name}") for name in STAT_NAMES}
+
+    def _lookup(self, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None, MISS
+        if time.time() < entry["fresh_until"]:
+            return entry, FRESH
+        return entry, STALE
+
+    @property
+    def lock_timeout(self):
+        """
+        seconds a lock is held at most, by default the worst case time of a
+        maya call, a shorter lock would let a second worker load the key
+        while the first one is still retrying
+        """
+        if self._lock_timeout is None:
+            self._lock_timeout = math.ceil(get_client().worst_case_seconds()) + 1
+        return self._lock_timeout
+
+    def _acquire(self, key):
+        """
+        only one worker gets to refresh the key
+        return: token of the lock to pass to _release, None if it is taken
+        """
+        token = uuid.uuid4().hex
+        client = redis_client()
+        if client is None:
+            acquired = cache.add(f"{key}:lock", token, timeout=self.lock_timeout)
+        else:
+            acquired = client.set(
+                cache.make_key(f"{key}:lock"),
+                token,
+                nx=True,
+                px=int(self.lock_timeout * 1000),
+            )
+        return token if acquired else None
+
+    def _release(self, key, token):
+        client = redis_client()
+        if client is None:
+            if cache.get(f"{key}:lock") == token:
+                cache.delete(f"{key}:lock")
+            return
+        client.eval(RELEASE_SCRIPT, 1, cache.make_key(f"{key}:lock"), token)
+
+    def _jittered(self, ttl):
+        return ttl * random.uniform(1 - self.ttl_jitter, 1 + self.ttl_jitter)
+
+    def _store(self, key, data, ok, ttl=None):
+        if ttl is None:
+            ttl = self._jittered(self.ttl) if ok else self.error_ttl
+        entry = {"data": data, "ok": ok, "fresh_until": time.time() + ttl}
+        cache.set(key, entry, timeout=ttl + (self.stale_ttl if ok else 0))
+        return entry
+
+    def _keep_stale(self, key, entry):
+        """
+        keeps a good entry whose refresh failed, with its fresh_until and
+        expiry, so it is served stale and not retried for `error_ttl` seconds
+        """
+        entry = dict(entry, retry_after=time.time() + self.error_ttl)
+        expires_in = entry["fresh_until"] + self.stale_ttl - time.time()
+        if expires_in > 0:
+            cache.set(key, entry, timeout=expires_in)
+        return entry
+
+    def _due(self, entry):
+        """
+        return: True if a stale entry may be refreshed
+        """
+        return entry is None or time.time() >= entry.get("retry_after", 0)
+
+    def _unavailable(self):
+        # served by waiters who gave up on the lock holder, never stored
+        self.stats["unavailable"].incr()
+        return {"data": None, "ok": False, "fresh_until": 0}
+
+    def _finish(self, key, result, stale_entry=None, token=None):
+        """
+        stores a loader result and releases the lock
+        return: entry to be served
+        """
+        try:
+            data, ok = result
+            if ok:
+                return self._store(key, data, ok)
+
+            self.stats["upstream_error"].incr()
+            if stale_entry is not None and stale_entry["ok"]:
+                # keep serving the last good response while maya is down
+                return self._keep_stale(key, stale_entry)
+            return self._store(key, data, ok)
+        finally:
+            if token is not None:
+                self._release(key, token)
+
+    def _wait(self, key):
+        deadline = time.monotonic() + self.lock_wait
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry
+        return None
+
+    def _call(self, loader):
+        self.stats["upstream"].incr()
+        try:
+            return loader()
+        except Exception:
+            logger.error("maya cache loader failed", exc_info=True)
+            return None, False
+
+    def _refresh(self, key, loader, token, stale_entry=None):
+        return self._finish(key, self._call(loader), stale_entry, token)
+
+    def get_or_load(self, key, loader):
+        """
+        params:
+        key: cache key of the response,
+        loader: callable returning `(data, ok)`
+        return: (entry, state) where state is one of FRESH/STALE/MISS
+        """
+        entry, state = self._lookup(key)
+        self.stats["hit" if state == FRESH else state].incr()
+        record_cache("maya", state != MISS)
+        if state == FRESH:
+            return entry, state
+
+        if state == STALE:
+            token = self._acquire(key) if self._due(entry) else None
+            if token is not None:
+                threading.Thread(
+                    target=self._refresh, args=(key, loader, token, entry), daemon=True
+                ).start()
+            return entry, state
+
+        token = self._acquire(key)
+        if token is not None:
+            return self._refresh(key, loader, token), state
+
+        # someone else is loading the key, waiting for its result
+        self.stats["coalesced"].incr()
+        entry = self._wait(key)
+        if entry is None:
+            # the lock holder is as slow as maya, calling maya again would
+            # only add to its load
+            entry = self._unavailable()
+        return entry, state
+
+    def prefetch(self, key, loader):
+        """
+        loads the key in the background unless it is fresh, without
+        blocking the caller
+        return: False when `prefetch_workers` prefetches are running already
+        and this one is dropped
+        """
+        if not self._prefetch_slots.acquire(blocking=False):
+            return False
+        try:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.prefetch_workers,
+                    thread_name_prefix="maya-prefetch",
+                )
+            self._executor.submit(self._prefetch, key, loader)
+        except Exception:
+            self._prefetch_slots.release()
+            raise
+        return True
+
+    def _prefetch(self, key, loader):
+        try:
+            entry, state = self._lookup(key)
+            token = None
+            if state != FRESH and self._due(entry):
+                token = self._acquire(key)
+            if token is not None:
+                self.stats["prefetch"].incr()
+                self._refresh(key, loader, token, entry)
+        except Exception:
+            logger.error("maya prefetch failed for %s", key, exc_info=True)
+        finally:
+            self._prefetch_slots.release()
+
+    def warm(self, key, loader):
+        """
+        reloads the key now, fresh or not
+        return: the stored entry, None when another worker is loading it
+        """
+        token = self._acquire(key)
+        if token is None:
+            return None
+        entry, _ = self._lookup(key)
+        return self._refresh(key, loader, token, entry)
+
+    async def _acall(self, loader):
+        await sync_to_async(self.stats["upstream"].incr)()
+        try:
+            return await loader()
+        except Exception:
+            logger.error("maya cache loader failed", exc_info=True)
+            return None, False
+
+    async def _arefresh(self, key, loader, token, stale_entry=None):
+        result = await self._acall(loader)
+        return await sync_to_async(self._finish)(key, result, stale_entry, token)
+
+    async def aget_or_load(self, key, loader):
+        """
+        async version of get_or_load, loader is a coroutine function
+        """
+        entry, state = await sync_to_async(self._lookup)(key)
+        await sync_to_async(self.stats["hit" if state == FRESH else state].incr)()
+        record_cache("maya", state != MISS)
+        if state == FRESH:
+            return entry, state
+
+        if state == STALE:
+            token = None
+            if self._due(entry):
+                token = await sync_to_async(self._acquire)(key)
+            if token is not None:
+                task = asyncio.ensure_future(self._arefresh(key, loader, token, entry))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return entry, state
+
+        token = await sync_to_async(self._acquire)(key)
+        if token is not None:
+            return await self._arefresh(key, loader, token), state
+
+        # someone else is loading the key, waiting for its result
+        await sync_to_async(self.stats["coalesced"].incr)()
+        deadline = time.monotonic() + self.lock_wait
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            entry = await sync_to_async(cache.get)(key)
+            if entry is not None:
+                return entry, state
+        return await sync_to_async(self._unavailable)(), state
+
+    def get_stats(self):
+        counts = {name: counter.total() for name, counter in self.stats.items()}
+        lookups = counts["hit"] + counts["stale"] + counts["miss"]
+        counts["hit_ratio"] = (
+            round((counts["hit"] + counts["stale"]) / lookups, 4) if lookups else 0
+        )
+        return counts
+
+    def reset_stats(self):
+        for counter in self.stats.values():
+            counter.reset()
+
+
+maya_cache = MayaResponseCache()
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:46
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("colsapp", "0002_auto_20200719_1022"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IngestionCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+                ("active", models.BooleanField(default=True)),
+                ("source", models.CharField(max_length=200, unique=True)),
+                ("last_page", models.PositiveIntegerField(default=0)),
+                ("finished", models.BooleanField(default=False)),
+            ],
+            options={
+                "verbose_name": "Ingestion Checkpoint",
+                "verbose_name_plural": "Ingestion Checkpoints",
+            },
+        ),
+        migrations.AddField(
+            model_name="movie",
+            name="maya_uuid",
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 3.0.14 on 2026-10-18 06:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+def build_genre_counts(apps, schema_editor):
+    Movie = apps.get_model("colsapp", "Movie")
+    UserGenreCount = apps.get_model("colsapp", "UserGenreCount")
+    rows = (
+        Movie.genres.through.objects.filter(movie__collections__isnull=False)
+        .values("movie__collections__user_id", "moviegenre_id")
+        .annotate(total=models.Count("id"))
+    )
+    UserGenreCount.objects.bulk_create(
+        [
+            UserGenreCount(
+                user_id=row["movie__collections__user_id"],
+                genre_id=row["moviegenre_id"],
+                movie_count=row["total"],
+            )
+            for row in rows
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("colsapp", "0003_maya_ingestion"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserGenreCount",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+                ("active", models.BooleanField(default=True)),
+                ("movie_count", models.IntegerField(default=0)),
+                (
+                    "genre",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="user_counts",
+                        to="colsapp.MovieGenre",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="genre_counts",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "User Genre Count",
+                "verbose_name_plural": "User Genre Counts",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="usergenrecount",
+            index=models.Index(
+                fields=["user", "-movie_count"], name="colsapp_use_user_id_ed36c1_idx"
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="usergenrecount",
+            unique_together={("user", "genre")},
+        ),
+        migrations.RunPython(build_genre_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:00
+
+from django.db import migrations, models
+
+# (model name, index) of the keyset pagination orderings
+INDEXES = [
+    (
+        "movie",
+        models.Index(fields=["created", "id"], name="colsapp_mov_created_3b8603_idx"),
+    ),
+    (
+        "moviecollection",
+        models.Index(
+            fields=["user", "created", "id"], name="colsapp_mov_user_id_f34faf_idx"
+        ),
+    ),
+]
+
+
+def add_indexes(apps, schema_editor):
+    """
+    builds the indexes without blocking writes on postgres, which can not be
+    done in a transaction. IF NOT EXISTS lets a failed run be repeated, an
+    index left invalid by an interrupted build has to be dropped first.
+    """
+    postgres = schema_editor.connection.vendor == "postgresql"
+    for model_name, index in INDEXES:
+        model = apps.get_model("colsapp", model_name)
+        if not postgres:
+            schema_editor.add_index(model, index)
+            continue
+        sql = str(index.create_sql(model, schema_editor))
+        schema_editor.execute(
+            sql.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY IF NOT EXISTS", 1)
+        )
+
+
+def remove_indexes(apps, schema_editor):
+    drop = "DROP INDEX"
+    if schema_editor.connection.vendor == "postgresql":
+        drop = "DROP INDEX CONCURRENTLY"
+    for _, index in INDEXES:
+        schema_editor.execute(f"{drop} IF EXISTS {index.name}")
+
+
+class Migration(migrations.Migration):
+
+    # concurrent index builds can not run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("colsapp", "0004_user_genre_counts"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(model_name=model_name, index=index)
+                for model_name, index in INDEXES
+            ],
+            database_operations=[migrations.RunPython(add_indexes, remove_indexes)],
+        ),
+    ]
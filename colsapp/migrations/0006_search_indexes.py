@@ -0,0 +1,66 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:05
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# has to match colsapp.search.search_document_sql for the index to be used
+SEARCH_DOCUMENT = (
+    "(setweight(to_tsvector('english'::regconfig, COALESCE(title, '')), 'A') || "
+    "setweight(to_tsvector('english'::regconfig, COALESCE(description, '')), 'B'))"
+)
+
+SEARCH_INDEXES = [
+    (
+        "colsapp_movie_search_idx",
+        f"ON colsapp_movie USING gin ({SEARCH_DOCUMENT})",
+    ),
+    (
+        "colsapp_movie_title_trgm_idx",
+        "ON colsapp_movie USING gin (title gin_trgm_ops)",
+    ),
+    (
+        "colsapp_moviecollection_search_idx",
+        f"ON colsapp_moviecollection USING gin ({SEARCH_DOCUMENT})",
+    ),
+    (
+        "colsapp_moviecollection_title_trgm_idx",
+        "ON colsapp_moviecollection USING gin (title gin_trgm_ops)",
+    ),
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    """
+    expression indexes, postgres updates them with each row so no column has
+    to be added and backfilled. Built concurrently so writes go on during
+    the build, an index left invalid by an interrupted build has to be
+    dropped before the migration is repeated.
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name, definition in SEARCH_INDEXES:
+        schema_editor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}"
+        )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name, _ in SEARCH_INDEXES:
+        schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    # concurrent index builds can not run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("colsapp", "0005_keyset_pagination_indexes"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
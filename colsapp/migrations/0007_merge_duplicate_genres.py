@@ -0,0 +1,82 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:10
+
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+def merge_duplicate_genres(apps, schema_editor):
+    """
+    keeps the oldest genre of names differing only in case so that a
+    case insensitive unique index can be built on the name
+    """
+    MovieGenre = apps.get_model("colsapp", "MovieGenre")
+    Movie = apps.get_model("colsapp", "Movie")
+    UserGenreCount = apps.get_model("colsapp", "UserGenreCount")
+    MovieGenreLink = Movie.genres.through
+    CollectionMovie = Movie.collections.through
+
+    duplicated = (
+        MovieGenre.objects.annotate(lower_name=Lower("name"))
+        .values("lower_name")
+        .annotate(total=Count("id"))
+        .filter(total__gt=1)
+    )
+    for group in duplicated:
+        genres = list(
+            MovieGenre.objects.annotate(lower_name=Lower("name"))
+            .filter(lower_name=group["lower_name"])
+            .order_by("created", "id")
+        )
+        keeper, duplicates = genres[0], genres[1:]
+        duplicate_ids = [genre.id for genre in duplicates]
+
+        # movies linked to a duplicate get linked to the keeper instead
+        linked = set(
+            MovieGenreLink.objects.filter(moviegenre_id=keeper.id).values_list(
+                "movie_id", flat=True
+            )
+        )
+        moved = set(
+            MovieGenreLink.objects.filter(moviegenre_id__in=duplicate_ids).values_list(
+                "movie_id", flat=True
+            )
+        )
+        MovieGenreLink.objects.bulk_create(
+            [
+                MovieGenreLink(movie_id=movie_id, moviegenre_id=keeper.id)
+                for movie_id in moved - linked
+            ]
+        )
+        MovieGenre.objects.filter(id__in=duplicate_ids).delete()
+
+        # recounting the keeper, the duplicates' counts went with them
+        UserGenreCount.objects.filter(genre_id=keeper.id).delete()
+        counts = (
+            CollectionMovie.objects.filter(
+                movie__genres=keeper.id, moviecollection__user__isnull=False
+            )
+            .values("moviecollection__user_id")
+            .annotate(total=Count("id"))
+        )
+        UserGenreCount.objects.bulk_create(
+            [
+                UserGenreCount(
+                    user_id=row["moviecollection__user_id"],
+                    genre_id=keeper.id,
+                    movie_count=row["total"],
+                )
+                for row in counts
+            ]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("colsapp", "0006_search_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_genres, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:10
+
+from django.db import migrations, models
+
+# partial indexes of active rows, declared on the models
+MODEL_INDEXES = [
+    (
+        "movie",
+        models.Index(
+            condition=models.Q(active=True),
+            fields=["created", "id"],
+            name="colsapp_movie_active_idx",
+        ),
+    ),
+    (
+        "moviecollection",
+        models.Index(
+            condition=models.Q(active=True),
+            fields=["user", "created", "id"],
+            name="colsapp_collection_active_idx",
+        ),
+    ),
+]
+
+# indexes the models can not declare, (name, unique, table, columns)
+RAW_INDEXES = [
+    # collection -> movies, the unique index of the through table leads
+    # with the movie
+    (
+        "colsapp_movie_collections_collection_movie_idx",
+        False,
+        "colsapp_movie_collections",
+        "(moviecollection_id, movie_id)",
+    ),
+    # genre -> movies
+    (
+        "colsapp_movie_genres_genre_movie_idx",
+        False,
+        "colsapp_movie_genres",
+        "(moviegenre_id, movie_id)",
+    ),
+    # one genre per case insensitive name, used by the genre lookups
+    ("colsapp_moviegenre_name_lower_uniq", True, "colsapp_moviegenre", "(LOWER(name))"),
+]
+
+
+def add_indexes(apps, schema_editor):
+    """
+    builds the indexes without blocking writes on postgres, which can not be
+    done in a transaction. IF NOT EXISTS lets a failed run be repeated, an
+    index left invalid by an interrupted build has to be dropped first.
+    """
+    postgres = schema_editor.connection.vendor == "postgresql"
+    for model_name, index in MODEL_INDEXES:
+        model = apps.get_model("colsapp", model_name)
+        if not postgres:
+            schema_editor.add_index(model, index)
+            continue
+        sql = str(index.create_sql(model, schema_editor))
+        schema_editor.execute(
+            sql.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY IF NOT EXISTS", 1)
+        )
+
+    for name, unique, table, columns in RAW_INDEXES:
+        create = "CREATE UNIQUE INDEX" if unique else "CREATE INDEX"
+        if postgres:
+            create = f"{create} CONCURRENTLY"
+        schema_editor.execute(f"{create} IF NOT EXISTS {name} ON {table} {columns}")
+
+
+def remove_indexes(apps, schema_editor):
+    drop = "DROP INDEX"
+    if schema_editor.connection.vendor == "postgresql":
+        drop = "DROP INDEX CONCURRENTLY"
+    names = [index.name for _, index in MODEL_INDEXES]
+    names += [name for name, *_ in RAW_INDEXES]
+    for name in names:
+        schema_editor.execute(f"{drop} IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    # concurrent index builds can not run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("colsapp", "0007_merge_duplicate_genres"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(model_name=model_name, index=index)
+                for model_name, index in MODEL_INDEXES
+            ],
+            database_operations=[migrations.RunPython(add_indexes, remove_indexes)],
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:20
+
+import colsapp.ids
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("colsapp", "0008_hot_query_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="ingestioncheckpoint",
+            name="id",
+            field=models.UUIDField(
+                default=colsapp.ids.new_id,
+                editable=False,
+                primary_key=True,
+                serialize=False,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="movie",
+            name="id",
+            field=models.UUIDField(
+                default=colsapp.ids.new_id,
+                editable=False,
+                primary_key=True,
+                serialize=False,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="moviecollection",
+            name="id",
+            field=models.UUIDField(
+                default=colsapp.ids.new_id,
+                editable=False,
+                primary_key=True,
+                serialize=False,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="moviegenre",
+            name="id",
+            field=models.UUIDField(
+                default=colsapp.ids.new_id,
+                editable=False,
+                primary_key=True,
+                serialize=False,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="usergenrecount",
+            name="id",
+            field=models.UUIDField(
+                default=colsapp.ids.new_id,
+                editable=False,
+                primary_key=True,
+                serialize=False,
+            ),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:29
+
+import colsapp.ids
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("colsapp", "0009_time_ordered_ids"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SimilarMovie",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=colsapp.ids.new_id,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+                ("active", models.BooleanField(default=True)),
+                ("score", models.FloatField()),
+                ("rank", models.PositiveSmallIntegerField()),
+                (
+                    "movie",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="similar_movies",
+                        to="colsapp.Movie",
+                    ),
+                ),
+                (
+                    "similar",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="colsapp.Movie",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Similar Movie",
+                "verbose_name_plural": "Similar Movies",
+                "unique_together": {("movie", "rank")},
+            },
+        ),
+    ]
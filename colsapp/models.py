@@ -1,15 +1,27 @@
-import uuid
 from django.db import models
-from django.db.models import Count
 from django.contrib.auth.models import User
+from .ids import new_id
+
+
+class ActiveManager(models.Manager):
+    """
+    Manager of active rows only, the partial `active` indexes serve its
+    queries
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(active=True)
 
 
 class BaseModel(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=new_id, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
     active = models.BooleanField(default=True)
 
+    objects = models.Manager()
+    active_objects = ActiveManager()
+
     class Meta:
         abstract = True
 
@@ -36,16 +48,25 @@ class MovieCollection(BaseModel):
         verbose_name = "Movie Collection"
         verbose_name_plural = "Movie Collections"
         app_label = "colsapp"
+        # keyset pagination of a user's collections
+        indexes = [
+            models.Index(fields=["user", "created", "id"]),
+            models.Index(
+                fields=["user", "created", "id"],
+                name="colsapp_collection_active_idx",
+                condition=models.Q(active=True),
+            ),
+        ]
 
     def __str__(self):
         return f"Name : {self.title}"
 
     @staticmethod
     def fav_genres(user):
+        # reads the counts kept up to date by colsapp.aggregates
         fav_genres = (
-            MovieGenre.objects.filter(movies__collections__user=user)
-            .values_list("name", flat=True)
-            .annotate(movie_count=Count("movies"))
+            UserGenreCount.objects.filter(user=user, movie_count__gt=0)
+            .values_list("genre__name", flat=True)
             .order_by("-movie_count")[:3]
         )
         return list(fav_genres)
@@ -54,6 +75,8 @@ class MovieCollection(BaseModel):
 class Movie(BaseModel):
     title = models.CharField(max_length=200)
     description = models.TextField(blank=True, default="")
+    # uuid of the movie on maya api, set for ingested movies only
+    maya_uuid = models.UUIDField(null=True, blank=True, unique=True, editable=False)
     collections = models.ManyToManyField(MovieCollection, related_name="movies",)
     genres = models.ManyToManyField(MovieGenre, related_name="movies")
 
@@ -61,6 +84,81 @@ class Movie(BaseModel):
         verbose_name = "Movie"
         verbose_name_plural = "Movies"
         app_label = "colsapp"
+        # keyset pagination
+        indexes = [
+            models.Index(fields=["created", "id"]),
+            models.Index(
+                fields=["created", "id"],
+                name="colsapp_movie_active_idx",
+                condition=models.Q(active=True),
+            ),
+        ]
 
     def __str__(self):
         return f"Name : {self.title}"
+
+
+class UserGenreCount(BaseModel):
+    """
+    No of (collection, movie) pairs of a user per genre of the movie, the
+    materialized form of the fav_genres aggregate
+    """
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="genre_counts"
+    )
+    genre = models.ForeignKey(
+        MovieGenre, on_delete=models.CASCADE, related_name="user_counts"
+    )
+    movie_count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = "User Genre Count"
+        verbose_name_plural = "User Genre Counts"
+        app_label = "colsapp"
+        unique_together = ("user", "genre")
+        indexes = [models.Index(fields=["user", "-movie_count"])]
+
+    def __str__(self):
+        return f"User : {self.user_id}, Genre : {self.genre_id}"
+
+
+class IngestionCheckpoint(BaseModel):
+    """
+    Progress of a paginated ingestion so an interrupted run can resume
+    """
+
+    source = models.CharField(max_length=200, unique=True)
+    last_page = models.PositiveIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+
+    class Meta:
+        verbose_name = "Ingestion Checkpoint"
+        verbose_name_plural = "Ingestion Checkpoints"
+        app_label = "colsapp"
+
+    def __str__(self):
+        return f"Source : {self.source}, Page : {self.last_page}"
+
+
+class SimilarMovie(BaseModel):
+    """
+    Top movies collected together with a movie, ranked from 1, written by
+    the refresh_similar_movies command (colsapp.similarity)
+    """
+
+    movie = models.ForeignKey(
+        Movie, on_delete=models.CASCADE, related_name="similar_movies"
+    )
+    similar = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        verbose_name = "Similar Movie"
+        verbose_name_plural = "Similar Movies"
+        app_label = "colsapp"
+        unique_together = ("movie", "rank")
+
+    def __str__(self):
+        return f"Movie : {self.movie_id}, Similar : {self.similar_id}"
@@ -0,0 +1,245 @@
+import json
+from base64 import b64decode, b64encode
+from urllib import parse
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+EXACT = "exact"
+ESTIMATED = "estimated"
+
+
+def estimate_count(queryset, exact_below=1000):
+    """
+    row count estimated by the postgres planner, which unlike COUNT(*) does
+    not scan the rows. Small estimates are off the most and cheap to count,
+    below `exact_below` and on other databases the exact count is returned.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return queryset.count()
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    estimate = int(plan[0]["Plan"]["Plan Rows"])
+    if estimate < exact_below:
+        return queryset.count()
+    return estimate
+
+
+def keyset_after(ordering, position):
+    """
+    params:
+    ordering: pair of fields, a leading "-" sorting descending,
+    position: their values in the last row of the previous page
+    return: Q of the rows after `position`, `(first, second) > (a, b)`
+    spelled out for mixed directions. The OR alone is no range bound of an
+    index scan on postgres, the `first >= a` ANDed to it is, so the index
+    is read from the position on rather than from its start.
+    """
+    (first, second), (first_value, second_value) = ordering, position
+    name = first.lstrip("-")
+    bound = "lte" if first.startswith("-") else "gte"
+    return Q(**{f"{name}__{bound}": first_value}) & (
+        Q(**{_after_lookup(first): first_value})
+        | Q(**{name: first_value, _after_lookup(second): second_value})
+    )
+
+
+def _after_lookup(field):
+    if field.startswith("-"):
+        return f"{field[1:]}__lt"
+    return f"{field}__gt"
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (created, id).
+
+    The cursor holds the created and id of the last row of a page and the
+    next page is read with `(created, id) > cursor` (keyset_after), which an
+    index on (created, id) answers from the cursor on without the COUNT(*)
+    and OFFSET scan of page numbers. The id breaks ties of rows created in the same instant.
+
+    Subclasses may order on other pairs of fields, a leading "-" sorting
+    descending, with `parse_position` turning the cursor strings back into
+    values.
+
+    No count is returned unless asked for with `?count=exact` or
+    `?count=estimated`.
+    """
+
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+    page_size = api_settings.PAGE_SIZE
+    ordering = ("created", "id")
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.count = self.get_count(queryset, request)
+        self.reverse, position = self.decode_cursor(request)
+
+        ordering = self.ordering
+        if self.reverse:
+            ordering = [
+                field[1:] if field.startswith("-") else f"-{field}"
+                for field in ordering
+            ]
+        queryset = queryset.order_by(*ordering)
+
+        if position is not None:
+            queryset = queryset.filter(keyset_after(ordering, position))
+
+        # one extra row tells if there is a page after this one
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if self.reverse:
+            results.reverse()
+
+        self.page = results
+        if self.reverse:
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+        return results
+
+    def parse_position(self, first, second):
+        """
+        return: cursor values as the ordering fields expect them
+        """
+        first = parse_datetime(first)
+        if first is None:
+            raise ValueError("invalid cursor position")
+        return first, second
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param)
+        if mode == EXACT:
+            return queryset.count()
+        if mode == ESTIMATED:
+            return estimate_count(queryset)
+        return None
+
+    def decode_cursor(self, request):
+        """
+        return: (reverse, (created, id) or None)
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return False, None
+
+        try:
+            querystring = b64decode(encoded.encode("ascii")).decode("ascii")
+            tokens = parse.parse_qs(querystring)
+            reverse = bool(int(tokens.get("r", ["0"])[0]))
+            position = self.parse_position(tokens["a"][0], tokens["b"][0])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        return reverse, position
+
+    def encode_cursor(self, instance, reverse):
+        # pages of values() querysets hold dicts
+        if isinstance(instance, dict):
+            first, second = [instance[field.lstrip("-")] for field in self.ordering]
+        else:
+            first, second = [
+                getattr(instance, field.lstrip("-")) for field in self.ordering
+            ]
+        if hasattr(first, "isoformat"):
+            first = first.isoformat()
+        tokens = {"a": str(first), "b": str(second)}
+        if reverse:
+            tokens["r"] = "1"
+        querystring = parse.urlencode(tokens)
+        encoded = b64encode(querystring.encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        response = {
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+            "results": data,
+        }
+        if self.count is not None:
+            response = {"count": self.count, **response}
+        return Response(response)
+
+
+class RankedKeysetPagination(KeysetPagination):
+    """
+    Keyset pagination of search results, best rank first
+    """
+
+    ordering = ("-rank", "id")
+
+    def parse_position(self, first, second):
+        return float(first), second
+
+
+class SelectablePagination(PageNumberPagination):
+    """
+    Page numbers by default, keyset pagination with `?pagination=cursor` or
+    when a cursor is sent. `?count=estimated` replaces the exact COUNT(*)
+    of either mode with the planner estimate.
+    """
+
+    mode_query_param = "pagination"
+    keyset_pagination_class = KeysetPagination
+    keyset = None
+
+    def use_keyset(self, request):
+        return (
+            request.query_params.get(self.mode_query_param) == "cursor"
+            or self.keyset_pagination_class.cursor_query_param in request.query_params
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.use_keyset(request):
+            self.keyset = self.keyset_pagination_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+
+        if request.query_params.get(KeysetPagination.count_query_param) == ESTIMATED:
+            self.django_paginator_class = EstimatedCountPaginator
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
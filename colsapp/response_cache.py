@@ -0,0 +1,193 @@
+import functools
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from rest_framework import status
+from moviecollection.metrics import record_cache
+from moviecollection.routers import primary_reads
+
+DEFAULT_RESPONSE_CACHE_SETTINGS = {
+    # seconds a cached response lives, writes invalidate it before that
+    "TTL": 300,
+    # seconds after a write during which the responses of its scopes are
+    # built from the primary, more than the lag of the db replicas
+    "RECENT": 5,
+}
+
+# generation scopes, each versions the responses built from its data
+MOVIES = "movies"
+GENRES = "genres"
+
+# headers set per request rather than stored with the rendered body
+UNCACHED_HEADERS = {"etag", "x-cache", "set-cookie", "content-length"}
+
+# part of every key, changed with the layout of the cached entries
+ENTRY_FORMAT = "2"
+
+
+def user_scope(user_id):
+    return f"user:{user_id}"
+
+
+class VersionedResponseCache:
+    """
+    Cache of GET responses whose keys hold generation numbers.
+
+    A response is keyed on its user, url, renderer and the current
+    generation of every scope it was built from (the user's collections,
+    movies, genres). A write bumps the generations of the scopes it touches,
+    so the old entries are never read again and simply expire, which makes
+    invalidation a single incr whatever the number of cached pages.
+
+    Generations start from the clock, a generation evicted from the cache
+    comes back larger than any number it had before.
+    """
+
+    def __init__(self, **options):
+        config = dict(DEFAULT_RESPONSE_CACHE_SETTINGS)
+        config.update(getattr(settings, "RESPONSE_CACHE", {}))
+        config.update(options)
+        self.ttl = config["TTL"]
+        self.recent = config["RECENT"]
+
+    @staticmethod
+    def generation_key(scope):
+        return f"generation:{scope}"
+
+    @staticmethod
+    def changed_key(scope):
+        return f"changed:{scope}"
+
+    def generations(self, scopes):
+        """
+        return: (generation of each scope, whether one of them changed in
+        the last `recent` seconds)
+        """
+        keys = [self.generation_key(scope) for scope in scopes]
+        changed_keys = [self.changed_key(scope) for scope in scopes]
+        found = cache.get_many(keys + changed_keys)
+        for key in keys:
+            if key not in found:
+                cache.add(key, time.time_ns(), timeout=None)
+                found[key] = cache.get(key)
+        changed = any(key in found for key in changed_keys)
+        return [found[key] for key in keys], changed
+
+    def _bump(self, scopes):
+        for scope in scopes:
+            key = self.generation_key(scope)
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, time.time_ns(), timeout=None)
+        cache.set_many(
+            {self.changed_key(scope): True for scope in scopes}, timeout=self.recent
+        )
+
+    def bump(self, *scopes):
+        """
+        invalidates the responses of the scopes once the current transaction
+        commits, a reader can not cache the data of before the write under
+        the new generation
+        """
+        scopes = set(scopes)
+        if scopes:
+            transaction.on_commit(lambda: self._bump(scopes))
+
+    def key(self, request, scopes):
+        """
+        return: (cache key, etag, whether a scope changed lately) of the
+        request's response
+        """
+        generations, changed = self.generations(scopes)
+        parts = [
+            ENTRY_FORMAT,
+            str(request.user.pk),
+            request.get_full_path(),
+            request.accepted_renderer.format,
+            *[str(generation) for generation in generations],
+        ]
+        digest = hashlib.sha1("|".join(parts).encode()).hexdigest()
+        return f"response:{digest}", f'"{digest}"', changed
+
+    def get(self, key):
+        entry = cache.get(key)
+        record_cache("response", entry is not None)
+        return entry
+
+    def set(self, key, response):
+        """
+        stores the rendered body once the response is rendered, a hit skips
+        serializing and rendering both
+        """
+
+        def store(rendered):
+            entry = {
+                "content": rendered.content,
+                "headers": [
+                    (header, value)
+                    for header, value in rendered.items()
+                    if header.lower() not in UNCACHED_HEADERS
+                ],
+            }
+            cache.set(key, entry, timeout=self.ttl)
+
+        response.add_post_render_callback(store)
+
+
+response_cache = VersionedResponseCache()
+
+
+def etag_matches(request, etag):
+    """
+    return: whether If-None-Match lists the etag, with the weak comparison
+    RFC 7232 asks for
+    """
+    tags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+    tags = {tag[2:] if tag.startswith("W/") else tag for tag in tags}
+    return "*" in tags or etag in tags
+
+
+def cached_response(method):
+    """
+    serves a viewset action from response_cache, with the scopes returned by
+    the view's `cache_scopes()` and with the headers it was built with.
+    Answers 304 when If-None-Match lists the etag of a cached response. Right after a write to its scopes a response
+    is built from the primary, a lagging replica would have it cached under
+    the new generation.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        key, etag, changed = response_cache.key(request, self.cache_scopes())
+        entry = response_cache.get(key)
+        if entry is not None:
+            if etag_matches(request, etag):
+                response = HttpResponseNotModified()
+            else:
+                response = HttpResponse(entry["content"])
+            # a 304 carries the cached headers as well, Vary and
+            # Cache-Control among them
+            for header, value in entry["headers"]:
+                if response.status_code == 200 or header.lower() != "content-type":
+                    response[header] = value
+            response["ETag"] = etag
+            response["X-Cache"] = "HIT"
+            return response
+
+        if changed:
+            with primary_reads():
+                response = method(self, request, *args, **kwargs)
+        else:
+            response = method(self, request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response_cache.set(key, response)
+            response["ETag"] = etag
+        response["X-Cache"] = "MISS"
+        return response
+
+    return wrapper
@@ -0,0 +1,112 @@
+"""
+Full text and trigram search over the title and description of movies and
+collections.
+
+Matches come from a weighted tsvector of title (A) and description (B),
+ranked with ts_rank, or from pg_trgm similarity of the title which catches
+typos. Both are answered by GIN indexes created in migration 0006, the
+tsvector one is an expression index so postgres keeps it current on every
+write and no column or trigger has to be maintained. The expression built
+by SearchDocument has to stay identical to the indexed one.
+"""
+
+from django.contrib.postgres.search import SearchQuery, SearchVectorField
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connections
+from django.db.models import F, FloatField, Func, Q, TextField, Value
+from django.db.models.functions import Cast
+
+# text search configuration of the indexes, changing it needs a migration
+SEARCH_CONFIG = "english"
+
+HEADLINE_OPTIONS = "StartSel=<b>, StopSel=</b>, MaxFragments=2, MaxWords=20"
+
+
+def search_document_sql(title, description):
+    """
+    return: sql of the weighted tsvector, shared by the query and the
+    migration creating the index
+    """
+    return (
+        f"(setweight(to_tsvector('{SEARCH_CONFIG}'::regconfig, "
+        f"COALESCE({title}, '')), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}'::regconfig, "
+        f"COALESCE({description}, '')), 'B'))"
+    )
+
+
+class SearchDocument(Func):
+    """
+    the indexed tsvector of a row
+    """
+
+    output_field = SearchVectorField()
+
+    def __init__(self, title="title", description="description", **extra):
+        super().__init__(F(title), F(description), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        title, description = self.get_source_expressions()
+        title_sql, title_params = compiler.compile(title)
+        description_sql, description_params = compiler.compile(description)
+        sql = search_document_sql(title_sql, description_sql)
+        return sql, title_params + description_params
+
+
+class SearchHeadline(Func):
+    """
+    ts_headline of a text column, fragments matching the query in <b> tags
+    """
+
+    output_field = TextField()
+
+    def __init__(self, expression, query, **extra):
+        super().__init__(expression, query, **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        expression, query = self.get_source_expressions()
+        expression_sql, expression_params = compiler.compile(expression)
+        query_sql, query_params = compiler.compile(query)
+        sql = (
+            f"ts_headline('{SEARCH_CONFIG}'::regconfig, "
+            f"COALESCE({expression_sql}, ''), {query_sql}, %s)"
+        )
+        return sql, expression_params + query_params + [HEADLINE_OPTIONS]
+
+
+def search(queryset, text):
+    """
+    params:
+    queryset: movies or collections,
+    text: the user's search text
+    return: matching rows annotated with `rank` and `headline`
+    """
+    if connections[queryset.db].vendor != "postgresql":
+        # plain substring match where postgres search is not available
+        return queryset.filter(
+            Q(title__icontains=text) | Q(description__icontains=text)
+        ).annotate(
+            rank=Value(0.0, output_field=FloatField()), headline=F("description")
+        )
+
+    query = SearchQuery(text, config=SEARCH_CONFIG)
+    return (
+        queryset.annotate(document=SearchDocument())
+        .filter(Q(document=query) | Q(title__trigram_similar=text))
+        .annotate(
+            # ts_rank and similarity are real, as double precision the rank
+            # compares exactly with the cursor value parsed by
+            # RankedKeysetPagination
+            rank=Cast(
+                Func(
+                    SearchDocument(),
+                    query,
+                    function="ts_rank",
+                    output_field=FloatField(),
+                )
+                + TrigramSimilarity("title", text),
+                FloatField(),
+            ),
+            headline=SearchHeadline("description", query),
+        )
+    )
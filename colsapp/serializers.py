@@ -1,4 +1,7 @@
 from rest_framework import fields, serializers
+from .bulk import bulk_link, bulk_set
+from .fields import BulkHyperlinkedRelatedField, BulkPrimaryKeyRelatedField
+from .genres import genre_resolver
 from .models import MovieCollection, MovieGenre, Movie, User
 
 
@@ -16,6 +19,8 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 class CollectionSerializer(serializers.HyperlinkedModelSerializer):
+    # validates every movie url with a single query
+    serializer_related_field = BulkHyperlinkedRelatedField
     user = serializers.ReadOnlyField(source="user.username")
 
     class Meta:
@@ -26,19 +31,40 @@ class CollectionSerializer(serializers.HyperlinkedModelSerializer):
         movies = validated_data.pop("movies")
         collection = MovieCollection.objects.create(**validated_data)
 
-        for movie in movies:
-            collection.movies.add(movie)
+        bulk_link(
+            Movie.collections.through,
+            "moviecollection_id",
+            "movie_id",
+            [(collection.id, movie.pk) for movie in movies],
+            known=True,
+        )
         return collection
 
     def update(self, instance, validated_data):
-        movies = validated_data.pop("movies")
+        movies = validated_data.pop("movies", None)
         instance.title = validated_data.get("title", instance.title)
         instance.description = validated_data.get("description", instance.description)
         instance.save()
-        instance.movies.set(movies)
+        if movies is not None:
+            # applying only the difference to the current movies
+            bulk_set(
+                Movie.collections.through,
+                "moviecollection_id",
+                "movie_id",
+                instance.id,
+                [movie.pk for movie in movies],
+            )
         return instance
 
 
+class CollectionMoviesSerializer(serializers.Serializer):
+    """
+    movie ids for the add/remove movies actions of a collection
+    """
+
+    movies = serializers.ListField(child=serializers.UUIDField(), allow_empty=False)
+
+
 class GenresSerializer(serializers.ModelSerializer):
     def to_representation(self, value):
         return value.name
@@ -50,7 +76,7 @@ class GenresSerializer(serializers.ModelSerializer):
 
 class MovieSerializer(serializers.ModelSerializer):
     genres = GenresSerializer(many=True)
-    collections = serializers.PrimaryKeyRelatedField(
+    collections = BulkPrimaryKeyRelatedField(
         queryset=MovieCollection.objects.all(), many=True, write_only=True
     )
 
@@ -63,13 +89,10 @@ class MovieSerializer(serializers.ModelSerializer):
         genres = validated_data.pop("genres")
         movie = Movie.objects.create(**validated_data)
 
-        for collection in collections:
-            movie.collections.add(collection)
+        # creating genres in case of not exists, one lookup for all of them
+        genre_ids = genre_resolver.resolve(gen["name"].capitalize() for gen in genres)
 
-        for gen in genres:
-            # creating genre in case of not exists
-            genre, status = MovieGenre.objects.get_or_create(
-                name=gen["name"].capitalize()
-            )
-            movie.genres.add(genre)
+        # add() writes the through rows with a single bulk insert
+        movie.collections.add(*collections)
+        movie.genres.add(*genre_ids.values())
         return movie
@@ -0,0 +1,173 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from . import aggregates, similarity
+from .authentication import token_cache
+from .bulk import m2m_bulk_changed
+from .genres import genre_resolver
+from .models import Movie, MovieCollection, MovieGenre
+from .response_cache import GENRES, MOVIES, response_cache, user_scope
+
+
+@receiver(post_save, sender=MovieGenre)
+@receiver(post_delete, sender=MovieGenre)
+def invalidate_genre_cache(sender, instance, created=False, **kwargs):
+    # new genres can not be stale in any lru, renames and deletes can
+    if not created:
+        genre_resolver.invalidate()
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    # covers tokens deleted, regenerated (delete and create) and issued by
+    # UserCreate
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created=False, **kwargs):
+    # snapshots hold the user, e.g. is_active, drop those of its tokens
+    if not created:
+        token_cache.invalidate(
+            *Token.objects.filter(user=instance).values_list("key", flat=True)
+        )
+
+
+@receiver(post_save, sender=MovieCollection)
+@receiver(post_delete, sender=MovieCollection)
+def bump_collection_responses(sender, instance, **kwargs):
+    # create, update and delete of a collection
+    response_cache.bump(user_scope(instance.user_id))
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def bump_movie_responses(sender, instance, **kwargs):
+    response_cache.bump(MOVIES)
+
+
+@receiver(post_save, sender=MovieGenre)
+@receiver(post_delete, sender=MovieGenre)
+def bump_genre_responses(sender, instance, **kwargs):
+    # movies show genre names and so do the fav_genres of collection lists
+    response_cache.bump(MOVIES, GENRES)
+
+
+def _bump_collection_owners(collection_ids):
+    user_ids = MovieCollection.objects.filter(id__in=collection_ids).values_list(
+        "user_id", flat=True
+    )
+    response_cache.bump(*[user_scope(user_id) for user_id in set(user_ids)])
+
+
+def _bump_responses(sender, pairs):
+    """
+    collection responses list their movies, movie responses their genres.
+    fav_genres changes are bumped by aggregates.apply_deltas.
+    """
+    if not pairs:
+        return
+    if sender is Movie.collections.through:
+        _bump_collection_owners({collection_id for collection_id, _ in pairs})
+    else:
+        response_cache.bump(MOVIES)
+
+
+def _mark_similar(sender, pairs):
+    # the similar movies of the movies of changed collection links
+    if pairs and sender is Movie.collections.through:
+        similarity.mark_changed({movie_id for _, movie_id in pairs})
+
+
+def _link_pairs(sender, instance, reverse, pk_set):
+    """
+    return: pairs in the orientation aggregates expects, (collection, movie)
+    for Movie.collections and (movie, genre) for Movie.genres
+    """
+    if sender is Movie.collections.through:
+        if reverse:
+            return {(instance.pk, movie_id) for movie_id in pk_set}
+        return {(collection_id, instance.pk) for collection_id in pk_set}
+    if reverse:
+        return {(movie_id, instance.pk) for movie_id in pk_set}
+    return {(instance.pk, genre_id) for genre_id in pk_set}
+
+
+def _existing_pairs(sender, instance, reverse, pk_set=None):
+    # rows which a remove/clear is about to delete
+    source_field = "movie_id"
+    target_field = (
+        "moviecollection_id" if sender is Movie.collections.through else "moviegenre_id"
+    )
+    if reverse:
+        source_field, target_field = target_field, source_field
+    queryset = sender.objects.filter(**{source_field: instance.pk})
+    if pk_set is not None:
+        queryset = queryset.filter(**{f"{target_field}__in": pk_set})
+    return _link_pairs(
+        sender, instance, reverse, set(queryset.values_list(target_field, flat=True))
+    )
+
+
+def _deltas(sender, pairs, sign):
+    if sender is Movie.collections.through:
+        return aggregates.collection_movie_deltas(pairs, sign)
+    return aggregates.movie_genre_deltas(pairs, sign)
+
+
+@receiver(m2m_changed, sender=Movie.collections.through)
+@receiver(m2m_changed, sender=Movie.genres.through)
+def update_genre_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "post_add":
+        pairs = _link_pairs(sender, instance, reverse, pk_set)
+        aggregates.apply_deltas(_deltas(sender, pairs, 1))
+        _bump_responses(sender, pairs)
+        _mark_similar(sender, pairs)
+
+    elif action in ("pre_remove", "pre_clear"):
+        # remove() reports the requested ids, only the existing ones count
+        instance._removed_links = _existing_pairs(
+            sender, instance, reverse, pk_set if action == "pre_remove" else None
+        )
+
+    elif action in ("post_remove", "post_clear"):
+        pairs = instance.__dict__.pop("_removed_links", set())
+        aggregates.apply_deltas(_deltas(sender, pairs, -1))
+        _bump_responses(sender, pairs)
+        _mark_similar(sender, pairs)
+
+
+@receiver(m2m_bulk_changed, sender=Movie.collections.through)
+@receiver(m2m_bulk_changed, sender=Movie.genres.through)
+def update_genre_counts_bulk(sender, source_field, action, pairs, **kwargs):
+    # aggregates expects the collection / genre side as documented above
+    if (sender is Movie.collections.through) == (source_field == "movie_id"):
+        pairs = {(target_id, source_id) for source_id, target_id in pairs}
+    sign = 1 if action == "post_add" else -1
+    aggregates.apply_deltas(_deltas(sender, pairs, sign))
+    _bump_responses(sender, pairs)
+    _mark_similar(sender, pairs)
+
+
+@receiver(pre_delete, sender=MovieCollection)
+def remove_collection_genre_counts(sender, instance, **kwargs):
+    # through rows are deleted by the cascade without m2m_changed
+    movie_ids = Movie.collections.through.objects.filter(
+        moviecollection_id=instance.pk
+    ).values_list("movie_id", flat=True)
+    pairs = {(instance.pk, movie_id) for movie_id in movie_ids}
+    aggregates.apply_deltas(aggregates.collection_movie_deltas(pairs, -1))
+    _mark_similar(Movie.collections.through, pairs)
+
+
+@receiver(pre_delete, sender=Movie)
+def remove_movie_genre_counts(sender, instance, **kwargs):
+    collection_ids = Movie.collections.through.objects.filter(
+        movie_id=instance.pk
+    ).values_list("moviecollection_id", flat=True)
+    pairs = {(collection_id, instance.pk) for collection_id in collection_ids}
+    aggregates.apply_deltas(aggregates.collection_movie_deltas(pairs, -1))
+    # the collections lose the movie
+    _bump_collection_owners({collection_id for collection_id, _ in pairs})
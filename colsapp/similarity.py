@@ -0,0 +1,263 @@
+"""
+"Users who collected this also collected" suggestions.
+
+The collection x movie incidence matrix X is read from the Movie.collections
+through table in chunks into a scipy sparse matrix. X.T @ X holds the no of
+collections every pair of movies shares (co-occurrence), divided by
+sqrt(n_i * n_j) of the movies' collection counts it is their cosine
+similarity. The products are computed for `block_size` movies at a time so
+the result never holds the whole catalogue, and the top K of every movie
+are stored in SimilarMovie, which the `similar` action of MovieViewset reads
+with one index lookup.
+
+Link changes mark their movies as changed in the cache, a refresh of the
+changed movies recomputes their rows from the collections holding them
+only. The rows of the movies they are similar to are left as they are
+until the next full refresh.
+
+numpy and scipy are only needed by the refresh, not by the action.
+"""
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Count
+from moviecollection.counters import redis_client
+from .export import chunks
+from .models import Movie, SimilarMovie
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+CollectionMovie = Movie.collections.through
+
+COOCCURRENCE = "cooccurrence"
+COSINE = "cosine"
+METRICS = (COOCCURRENCE, COSINE)
+
+CHANGED_KEY = "similar_movies:changed"
+# changed movies are refreshed well before this, it only bounds the set
+CHANGED_TIMEOUT = 7 * 24 * 3600
+
+
+def mark_changed(movie_ids):
+    """
+    records movies whose collections changed for refresh_changed
+    """
+    movie_ids = {str(movie_id) for movie_id in movie_ids}
+    if not movie_ids:
+        return
+    client = redis_client()
+    if client is None:
+        cache.set(
+            CHANGED_KEY, cache.get(CHANGED_KEY, set()) | movie_ids, CHANGED_TIMEOUT
+        )
+        return
+    key = cache.make_key(CHANGED_KEY)
+    pipe = client.pipeline()
+    pipe.sadd(key, *movie_ids)
+    pipe.expire(key, CHANGED_TIMEOUT)
+    pipe.execute()
+
+
+def pop_changed():
+    """
+    return: set of the movie ids marked since the last call
+    """
+    client = redis_client()
+    if client is None:
+        movie_ids = cache.get(CHANGED_KEY, set())
+        cache.delete(CHANGED_KEY)
+        return movie_ids
+    key = cache.make_key(CHANGED_KEY)
+    pipe = client.pipeline()
+    pipe.smembers(key)
+    pipe.delete(key)
+    members, _ = pipe.execute()
+    return {member.decode() for member in members}
+
+
+def _require_scipy():
+    if sparse is None:
+        raise ImproperlyConfigured("similar movies need numpy and scipy installed")
+
+
+def links(movie_ids=None):
+    """
+    return: values_list of (collection id, movie id) of active collections
+    and movies, only of the collections holding `movie_ids` when given
+    """
+    queryset = CollectionMovie.objects.filter(
+        moviecollection__active=True, movie__active=True
+    )
+    if movie_ids is not None:
+        queryset = queryset.filter(
+            moviecollection_id__in=CollectionMovie.objects.filter(
+                movie_id__in=movie_ids
+            ).values("moviecollection_id")
+        )
+    return queryset.values_list("moviecollection_id", "movie_id")
+
+
+def load_incidence(pairs, chunk_size=10000):
+    """
+    params:
+    pairs: (collection id, movie id) pairs, e.g. links()
+    return: (csr matrix of collections x movies, list of the movie id of
+    every column)
+    """
+    _require_scipy()
+    collections, movies = {}, {}
+    rows, cols = [], []
+    if hasattr(pairs, "iterator"):
+        pairs = pairs.iterator(chunk_size)
+    for chunk in chunks(pairs, chunk_size):
+        rows.append(
+            np.fromiter(
+                (collections.setdefault(c, len(collections)) for c, _ in chunk),
+                dtype=np.int32,
+                count=len(chunk),
+            )
+        )
+        cols.append(
+            np.fromiter(
+                (movies.setdefault(m, len(movies)) for _, m in chunk),
+                dtype=np.int32,
+                count=len(chunk),
+            )
+        )
+
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int32)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int32)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(collections), len(movies)),
+    )
+    # a pair listed twice is still one link
+    matrix.data[:] = 1
+    return matrix, list(movies)
+
+
+def top_similar(matrix, k, metric=COSINE, rows=None, counts=None, block_size=1000):
+    """
+    params:
+    matrix: collections x movies incidence matrix,
+    k: no of similar movies kept per movie,
+    rows: column indexes of the movies to compute, defaults to all,
+    counts: no of collections of every column, defaults to the column sums,
+    which are only right when `matrix` holds every collection of the movies,
+    block_size: no of movies multiplied at once
+    yields (column index, column indexes of the similar movies, scores),
+    best first
+    """
+    _require_scipy()
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    items = matrix.T.tocsr()
+    if counts is None:
+        counts = np.asarray(matrix.sum(axis=0)).ravel()
+    scale = 1 / np.sqrt(np.maximum(counts, 1))
+    rows = np.arange(items.shape[0]) if rows is None else np.asarray(rows)
+
+    for start in range(0, len(rows), block_size):
+        block = rows[start : start + block_size]
+        # shared collections of every movie of the block with every movie
+        products = items[block] @ matrix
+        if metric == COSINE:
+            products = sparse.diags(scale[block]) @ products @ sparse.diags(scale)
+        products = products.tocsr()
+        for offset, row in enumerate(block):
+            begin, end = products.indptr[offset], products.indptr[offset + 1]
+            cols, scores = products.indices[begin:end], products.data[begin:end]
+            keep = cols != row
+            cols, scores = cols[keep], scores[keep]
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+                cols, scores = cols[top], scores[top]
+            order = np.lexsort((cols, -scores))
+            yield row, cols[order], scores[order]
+
+
+def similar_rows(results, movie_ids):
+    for row, cols, scores in results:
+        for rank, (col, score) in enumerate(zip(cols, scores), 1):
+            yield SimilarMovie(
+                movie_id=movie_ids[row],
+                similar_id=movie_ids[col],
+                score=float(score),
+                rank=rank,
+            )
+
+
+def refresh_all(k=20, metric=COSINE, chunk_size=10000, block_size=1000):
+    """
+    recomputes every movie, readers see the old rows until the commit
+    return: no of rows written
+    """
+    # the changed movies are recomputed too
+    pop_changed()
+    matrix, movie_ids = load_incidence(links(), chunk_size)
+    written = 0
+    with transaction.atomic():
+        SimilarMovie.objects.all().delete()
+        results = top_similar(matrix, k, metric, block_size=block_size)
+        for batch in chunks(similar_rows(results, movie_ids), chunk_size):
+            SimilarMovie.objects.bulk_create(batch)
+            written += len(batch)
+    return written
+
+
+def refresh_changed(k=20, metric=COSINE, chunk_size=10000, block_size=1000):
+    """
+    recomputes the movies marked by mark_changed, `block_size` at a time
+    return: (no of movies, no of rows written)
+    """
+    _require_scipy()
+    changed = pop_changed()
+    written = 0
+    try:
+        for batch in chunks(sorted(changed), block_size):
+            written += refresh_movies(batch, k, metric, chunk_size)
+    except Exception:
+        # kept for the next run
+        mark_changed(changed)
+        raise
+    return len(changed), written
+
+
+def refresh_movies(movie_ids, k=20, metric=COSINE, chunk_size=10000):
+    """
+    recomputes the movies from the collections holding them
+    return: no of rows written
+    """
+    pairs = links(movie_ids)
+    matrix, columns = load_incidence(pairs, chunk_size)
+    # the other movies are counted in all their collections, not only in
+    # the ones loaded
+    counts = dict(
+        CollectionMovie.objects.filter(
+            movie_id__in=pairs.values("movie_id"), moviecollection__active=True
+        )
+        .values("movie_id")
+        .annotate(total=Count("id"))
+        .values_list("movie_id", "total")
+    )
+    wanted = {str(movie_id) for movie_id in movie_ids}
+    rows = [col for col, movie_id in enumerate(columns) if str(movie_id) in wanted]
+    results = top_similar(
+        matrix,
+        k,
+        metric,
+        rows=rows,
+        counts=np.array([counts.get(m, 0) for m in columns], dtype=np.float32),
+        block_size=max(len(rows), 1),
+    )
+    similar = list(similar_rows(results, columns))
+    with transaction.atomic():
+        # movies left without collections lose their rows
+        SimilarMovie.objects.filter(movie_id__in=movie_ids).delete()
+        SimilarMovie.objects.bulk_create(similar, batch_size=chunk_size)
+    return len(similar)
@@ -1,3 +1,2135 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import logging
+import threading
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipIf
+from urllib.parse import parse_qs, urlparse
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.db.models import Count, FloatField
+from django.db.models.functions import Cast
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from maya_api import async_client
+from maya_api.async_client import AsyncMayaApiClient, close_session, get_session
+from maya_api.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, maya_breaker
+from maya_api.client import (
+    MayaApiClient,
+    attempt_timeout,
+    retry_plan,
+    worst_case_seconds,
+)
+from maya_api.exceptions import (
+    ApiConnectionErrorException,
+    ApiTimeoutException,
+    ResponseException,
+)
+from moviecollection import asgi
+from moviecollection.counters import BatchedCounter, flusher
+from moviecollection.logs import (
+    JSONFormatter,
+    QueuedHandler,
+    RateLimitedAdminEmailHandler,
+    current_request_id,
+    reset_request_id,
+    set_request_id,
+)
+from moviecollection.metrics import SamplingProfiler, metrics_store, record_cache
+from moviecollection.traffic import HOUR, TrafficCounter, traffic_counter
+from moviecollection.routers import (
+    ReplicaRouter,
+    is_pinned,
+    replica_reads,
+    start_request,
+)
+from .aggregates import CollectionMovie, check_genre_counts
+from .async_views import home_page
+from .bulk import bulk_link, bulk_set, bulk_unlink
+from .export import CSV, export_lines
+from .genres import GenreResolver
+from .management.commands.explain_hot_queries import (
+    INDEX_CONDS,
+    check_plan,
+    hot_queries,
+)
+from .ids import rekey_uuid7, uuid7
+from .imports import CollectionImporter
+from .ingestion import IngestionError, MayaIngestor
+from .models import (
+    IngestionCheckpoint,
+    Movie,
+    MovieCollection,
+    MovieGenre,
+    SimilarMovie,
+    UserGenreCount,
+)
+from .maya_cache import MayaResponseCache, page_key
+from .renderers import FastJSONRenderer
+from .response_cache import GENRES, MOVIES, user_scope
+from .row_serializers import MovieRowSerializer
+from .search import search
+from .similarity import COOCCURRENCE, refresh_all, refresh_changed, sparse
 
-# Create your tests here.
+
+class QueryCountTests(TestCase):
+    """
+    Read paths have to take the same no of queries whatever the no of rows,
+    a failure here usually means a serializer field queries per object.
+    """
+
+    def setUp(self):
+        # measuring the views, not the response cache
+        patcher = mock.patch(
+            "colsapp.response_cache.response_cache.get", return_value=None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username="reader", password="secret")
+        token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        self.genres = [MovieGenre.objects.create(name=f"Genre {i}") for i in range(3)]
+
+    def add_rows(self, count):
+        for i in range(count):
+            collection = MovieCollection.objects.create(title=f"c{i}", user=self.user)
+            movie = Movie.objects.create(title=f"m{i}")
+            movie.collections.add(collection)
+            movie.genres.add(*self.genres)
+
+    def assert_constant_queries(self, url, num):
+        # count, page, prefetches and fav genres, the token is cached
+        self.add_rows(2)
+        self.client.get(url)
+        with self.assertNumQueries(num):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        self.add_rows(8)
+        with self.assertNumQueries(num):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_movie_list(self):
+        response = self.assert_constant_queries("/api/v1/movies/", 3)
+        self.assertEqual(len(response.data["results"][0]["genres"]), 3)
+
+    def test_movie_list_cursor(self):
+        self.assert_constant_queries("/api/v1/movies/?pagination=cursor", 2)
+
+    def test_movie_detail(self):
+        self.add_rows(1)
+        movie = Movie.objects.get()
+        self.client.get(f"/api/v1/movies/{movie.id}/")
+        with self.assertNumQueries(2):
+            self.client.get(f"/api/v1/movies/{movie.id}/")
+
+    def test_collection_list(self):
+        response = self.assert_constant_queries("/api/v1/collections/", 4)
+        collection = response.data["data"]["collections"][0]
+        movie = Movie.objects.get(collections=collection["id"])
+        self.assertEqual(
+            collection["movies"], [f"http://testserver/api/v1/movies/{movie.id}/"]
+        )
+
+    def test_collection_list_cursor(self):
+        self.assert_constant_queries("/api/v1/collections/?pagination=cursor", 3)
+
+    def test_collection_detail(self):
+        self.add_rows(1)
+        collection = MovieCollection.objects.get()
+        self.client.get(f"/api/v1/collections/{collection.id}/")
+        with self.assertNumQueries(2):
+            self.client.get(f"/api/v1/collections/{collection.id}/")
+
+
+class FakeMayaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        maya = self.server
+        query = parse_qs(urlparse(self.path).query)
+        page = int(query.get("page", ["1"])[0])
+        maya.requested.append(page)
+        time.sleep(maya.delay)
+        if page in maya.failing:
+            status = maya.failing_status
+            data = {"is_success": False, "message": "maya is down"}
+        else:
+            status, data = 200, maya.page(page)
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeMaya(ThreadingHTTPServer):
+    """
+    maya `movies/` endpoint serving `count` made up movies, 10 per page
+    """
+
+    page_size = 10
+
+    def __init__(self, count):
+        super().__init__(("127.0.0.1", 0), FakeMayaHandler)
+        self.count = count
+        self.failing = set()
+        self.failing_status = 500
+        # seconds every response is held back
+        self.delay = 0
+        self.requested = []
+        self.base_url = f"http://127.0.0.1:{self.server_port}/"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # clients which timed out before the response was written
+        pass
+
+    def movie(self, number):
+        return {
+            "uuid": str(uuid.uuid5(uuid.NAMESPACE_URL, f"maya/{number}")),
+            "title": f"movie {number}",
+            "description": "",
+            "genres": "drama, Comedy" if number % 2 else "Drama,drama",
+        }
+
+    def page(self, page):
+        start = (page - 1) * self.page_size
+        numbers = range(start, min(start + self.page_size, self.count))
+        next_page = None
+        if start + self.page_size < self.count:
+            next_page = f"{self.base_url}movies/?page={page + 1}"
+        return {
+            "count": self.count,
+            "next": next_page,
+            "results": [self.movie(number) for number in numbers],
+        }
+
+
+class IngestionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.maya = FakeMaya(25)
+        self.addCleanup(self.maya.stop)
+
+    def ingest(self, **options):
+        ingestor = MayaIngestor(
+            concurrency=1,
+            batch_size=10,
+            client_kwargs={"base_url": self.maya.base_url},
+        )
+        return ingestor.run(**options)
+
+    def checkpoint(self):
+        return IngestionCheckpoint.objects.get(source=MayaIngestor.source)
+
+    def test_full_run(self):
+        stats = self.ingest()
+        self.assertEqual((stats["pages"], stats["created"]), (3, 25))
+        self.assertEqual(Movie.objects.filter(maya_uuid__isnull=False).count(), 25)
+        self.assertEqual(
+            sorted(MovieGenre.objects.values_list("name", flat=True)),
+            ["Comedy", "Drama"],
+        )
+        movie = Movie.objects.get(title="movie 1")
+        self.assertEqual(
+            sorted(movie.genres.values_list("name", flat=True)), ["Comedy", "Drama"]
+        )
+        self.assertEqual(Movie.objects.get(title="movie 2").genres.count(), 1)
+        checkpoint = self.checkpoint()
+        self.assertEqual((checkpoint.last_page, checkpoint.finished), (3, True))
+
+    def test_resume_after_failure(self):
+        self.maya.failing.add(3)
+        with self.assertRaises(IngestionError):
+            self.ingest()
+        self.assertEqual(Movie.objects.count(), 20)
+        self.assertEqual(self.checkpoint().last_page, 2)
+
+        self.maya.failing.clear()
+        self.maya.requested.clear()
+        stats = self.ingest()
+        self.assertEqual(self.maya.requested, [3])
+        self.assertEqual(stats["created"], 5)
+        self.assertEqual(Movie.objects.count(), 25)
+
+    def test_rerun_is_incremental(self):
+        self.ingest()
+        self.maya.count = 32
+        self.maya.requested.clear()
+        stats = self.ingest()
+        # the last page is read again for the movies appended to it
+        self.assertEqual(self.maya.requested, [3, 4])
+        self.assertEqual((stats["created"], stats["unchanged"]), (7, 5))
+        self.assertEqual(self.checkpoint().last_page, 4)
+
+        self.maya.requested.clear()
+        stats = self.ingest(restart=True)
+        self.assertEqual(self.maya.requested, [1, 2, 3, 4])
+        self.assertEqual((stats["created"], stats["unchanged"]), (0, 32))
+
+
+class IngestionBreakerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.maya = FakeMaya(25)
+        self.addCleanup(self.maya.stop)
+
+    def test_own_breaker_and_timeout(self):
+        ingestor = MayaIngestor(
+            concurrency=1,
+            client_kwargs={"base_url": self.maya.base_url, "timeout": 0.2},
+        )
+        client = ingestor._client()
+        self.assertIsNot(client.breaker, maya_breaker)
+        # the live budget of movies/ does not apply
+        _, retries, timeout = client.call_plan("movies/")
+        self.assertEqual((retries, timeout), (3, 0.2))
+
+        self.maya.delay = 0.3
+        with self.assertRaises(ApiTimeoutException):
+            ingestor.run()
+        self.assertEqual(self.maya.requested, [1] * 4)
+        self.assertIsNone(cache.get(maya_breaker._window_keys()[0]))
+        self.assertEqual(cache.get(ingestor.breaker._window_keys()[1]), 1)
+
+
+class MovieBulkTests(TestCase):
+    url = "/api/v1/movies/bulk/"
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="writer", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.collection = MovieCollection.objects.create(title="c", user=self.user)
+        self.other = MovieCollection.objects.create(title="o", user=self.user)
+        self.movie = Movie.objects.create(title="old", description="keep")
+        self.movie.collections.add(self.collection)
+        self.drama = MovieGenre.objects.create(name="Drama")
+        self.movie.genres.add(self.drama)
+
+    def item(self, title, genres=("drama",), collection=None):
+        return {
+            "title": title,
+            "collections": [str((collection or self.collection).id)],
+            "genres": [{"name": name} for name in genres],
+        }
+
+    def post(self, items):
+        return self.client.post(self.url, items, format="json")
+
+    def fav_genres(self):
+        return dict(
+            UserGenreCount.objects.filter(user=self.user).values_list(
+                "genre__name", "movie_count"
+            )
+        )
+
+    def test_ndjson(self):
+        lines = [json.dumps(self.item("a")), "", json.dumps(self.item("b"))]
+        response = self.client.post(
+            self.url, "\n".join(lines), content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["data"]["created"], 2)
+
+        response = self.client.post(
+            self.url, '{"title": "a"}\n{"title"', content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("line 2", response.data["detail"])
+
+    def test_errors_by_index(self):
+        response = self.post(
+            [
+                self.item("valid"),
+                {"collections": [], "genres": []},
+                self.item("unknown collection", collection=MovieCollection(title="x")),
+                {"id": str(uuid.uuid4()), "title": "unknown movie"},
+            ]
+        )
+        self.assertEqual(response.status_code, 207)
+        errors = {error["index"]: error["errors"] for error in response.data["errors"]}
+        self.assertEqual(sorted(errors), [1, 2, 3])
+        self.assertIn("title", errors[1])
+        self.assertIn("collections", errors[2])
+        self.assertIn("id", errors[3])
+        self.assertTrue(Movie.objects.filter(title="valid").exists())
+
+    def test_updates_write_the_given_fields_only(self):
+        response = self.post(
+            [{"id": str(self.movie.id), "title": "new"}, self.item("created")]
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            (response.data["data"]["created"], response.data["data"]["updated"]),
+            (1, 1),
+        )
+        self.movie.refresh_from_db()
+        self.assertEqual((self.movie.title, self.movie.description), ("new", "keep"))
+        self.assertEqual(list(self.movie.collections.all()), [self.collection])
+        self.assertEqual(list(self.movie.genres.all()), [self.drama])
+
+        self.post([{"id": str(self.movie.id), "description": ""}])
+        self.movie.refresh_from_db()
+        self.assertEqual((self.movie.title, self.movie.description), ("new", ""))
+
+    def test_updates_replace_the_given_relations(self):
+        self.post([{"id": str(self.movie.id), "collections": [str(self.other.id)]}])
+        self.assertEqual(list(self.movie.collections.all()), [self.other])
+        self.assertEqual(list(self.movie.genres.all()), [self.drama])
+
+    def test_genre_counts_follow_bulk_links(self):
+        self.assertEqual(self.fav_genres(), {"Drama": 1})
+        self.post([self.item("a", genres=("drama", "comedy"))])
+        self.assertEqual(self.fav_genres(), {"Drama": 2, "Comedy": 1})
+
+        self.post(
+            [{"id": str(self.movie.id), "genres": [{"name": "comedy"}]}],
+        )
+        self.assertEqual(self.fav_genres(), {"Drama": 1, "Comedy": 2})
+        self.post([{"id": str(self.movie.id), "collections": []}])
+        self.assertEqual(self.fav_genres(), {"Drama": 1, "Comedy": 1})
+        self.assertEqual(check_genre_counts(), [])
+
+
+class GenreCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="fan", password="secret")
+        self.other_user = User.objects.create_user(username="other", password="x")
+        self.collection = MovieCollection.objects.create(title="a", user=self.user)
+        self.second = MovieCollection.objects.create(title="b", user=self.user)
+        self.foreign = MovieCollection.objects.create(title="c", user=self.other_user)
+        self.drama = MovieGenre.objects.create(name="Drama")
+        self.comedy = MovieGenre.objects.create(name="Comedy")
+        self.horror = MovieGenre.objects.create(name="Horror")
+        self.movie = Movie.objects.create(title="m1")
+        self.movie.genres.add(self.drama, self.comedy)
+        self.sequel = Movie.objects.create(title="m2")
+        self.sequel.genres.add(self.drama)
+
+    def assertCountsMatch(self):
+        # the Count aggregate fav_genres ran before the counts were stored
+        for user in (self.user, self.other_user):
+            expected = dict(
+                MovieGenre.objects.filter(movies__collections__user=user)
+                .values_list("name")
+                .annotate(movie_count=Count("movies"))
+            )
+            stored = dict(
+                UserGenreCount.objects.filter(user=user, movie_count__gt=0).values_list(
+                    "genre__name", "movie_count"
+                )
+            )
+            self.assertEqual(stored, expected)
+        self.assertEqual(check_genre_counts(), [])
+
+    def test_add_remove_clear(self):
+        self.movie.collections.add(self.collection, self.second, self.foreign)
+        self.sequel.collections.add(self.collection)
+        self.assertCountsMatch()
+        self.assertEqual(
+            MovieCollection.fav_genres(self.user),
+            ["Drama", "Comedy"],
+        )
+
+        # ids which are not linked do not count
+        self.movie.collections.remove(self.second, MovieCollection(title="x").pk)
+        self.assertCountsMatch()
+        self.movie.genres.add(self.horror)
+        self.movie.genres.remove(self.drama)
+        self.assertCountsMatch()
+        self.movie.collections.clear()
+        self.assertCountsMatch()
+        self.sequel.genres.clear()
+        self.assertCountsMatch()
+        self.assertEqual(MovieCollection.fav_genres(self.user), [])
+
+    def test_reverse_side(self):
+        self.collection.movies.add(self.movie, self.sequel)
+        self.foreign.movies.add(self.sequel)
+        self.horror.movies.add(self.sequel)
+        self.assertCountsMatch()
+        self.collection.movies.remove(self.movie)
+        self.drama.movies.clear()
+        self.assertCountsMatch()
+        self.foreign.movies.clear()
+        self.assertCountsMatch()
+
+    def test_bulk_link_unlink(self):
+        CollectionMovie = Movie.collections.through
+        MovieGenreLink = Movie.genres.through
+        bulk_link(
+            CollectionMovie,
+            "moviecollection_id",
+            "movie_id",
+            [(self.collection.id, self.movie.id), (self.foreign.id, self.movie.id)],
+        )
+        bulk_link(
+            CollectionMovie,
+            "movie_id",
+            "moviecollection_id",
+            [(self.sequel.id, self.second.id), (self.movie.id, self.collection.id)],
+        )
+        self.assertCountsMatch()
+        bulk_link(
+            MovieGenreLink,
+            "movie_id",
+            "moviegenre_id",
+            [(self.sequel.id, self.horror.id)],
+        )
+        self.assertCountsMatch()
+
+        bulk_unlink(
+            CollectionMovie,
+            "movie_id",
+            "moviecollection_id",
+            [(self.movie.id, self.collection.id), (self.movie.id, self.second.id)],
+        )
+        self.assertCountsMatch()
+        bulk_unlink(
+            MovieGenreLink,
+            "movie_id",
+            "moviegenre_id",
+            [(self.sequel.id, self.drama.id)],
+            known=True,
+        )
+        self.assertCountsMatch()
+
+    def test_deletes(self):
+        self.movie.collections.add(self.collection, self.foreign)
+        self.sequel.collections.add(self.collection, self.second)
+        self.collection.delete()
+        self.assertCountsMatch()
+        self.movie.delete()
+        self.assertCountsMatch()
+        self.assertEqual(MovieCollection.fav_genres(self.user), ["Drama"])
+
+    def test_check_genre_counts(self):
+        self.movie.collections.add(self.collection, self.foreign)
+        self.assertEqual(check_genre_counts(), [])
+        UserGenreCount.objects.filter(user=self.user, genre=self.drama).update(
+            movie_count=5
+        )
+        UserGenreCount.objects.filter(user=self.other_user, genre=self.comedy).delete()
+        self.assertEqual(
+            sorted(check_genre_counts()),
+            sorted(
+                [
+                    (self.user.id, self.drama.id, 5, 1),
+                    (self.other_user.id, self.comedy.id, 0, 1),
+                ]
+            ),
+        )
+        self.assertEqual(
+            check_genre_counts([self.user.id]), [(self.user.id, self.drama.id, 5, 1)]
+        )
+
+        with self.assertRaises(CommandError):
+            call_command("check_genre_counts", stdout=io.StringIO())
+        call_command("check_genre_counts", "--fix", stdout=io.StringIO())
+        self.assertCountsMatch()
+
+
+class UUID7Tests(TestCase):
+    def test_layout(self):
+        before = time.time_ns() // 1_000_000
+        value = uuid7()
+        after = time.time_ns() // 1_000_000
+        self.assertEqual(value.version, 7)
+        self.assertEqual(value.variant, uuid.RFC_4122)
+        self.assertEqual(value.int >> 76 & 0xF, 7)
+        self.assertEqual(value.int >> 62 & 0b11, 0b10)
+        self.assertTrue(before <= value.int >> 80 <= after)
+
+        created = timezone.now()
+        self.assertEqual(uuid7(created).int >> 80, int(created.timestamp() * 1000))
+
+    @mock.patch("colsapp.ids._counter", 0)
+    @mock.patch("colsapp.ids._last_ms", 0)
+    @mock.patch("colsapp.ids.time")
+    def test_ordered_within_one_ms(self, clock):
+        clock.time_ns.return_value = 1_700_000_000_000 * 1_000_000
+        # more ids than the 12 bit counter holds
+        values = [uuid7() for _ in range(5000)]
+        self.assertEqual(values, sorted(values))
+        self.assertEqual(len(set(values)), 5000)
+        self.assertEqual(values[0].int >> 80, 1_700_000_000_000)
+        self.assertEqual(values[-1].int >> 80, 1_700_000_000_001)
+
+        # a clock going back does not reorder them
+        clock.time_ns.return_value = 1_600_000_000_000 * 1_000_000
+        self.assertGreater(uuid7(), values[-1])
+
+
+class RekeyUUID7Tests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="x")
+        self.collection = MovieCollection.objects.create(title="c", user=self.user)
+        self.drama = MovieGenre.objects.create(name="Drama")
+        self.movies = [Movie.objects.create(title=f"m{n}") for n in range(5)]
+        for movie in self.movies:
+            movie.collections.add(self.collection)
+            movie.genres.add(self.drama)
+
+    def test_rekey(self):
+        with mock.patch("colsapp.ids.response_cache.bump") as bump:
+            self.assertEqual(rekey_uuid7(Movie, batch_size=2), 5)
+            self.assertEqual(rekey_uuid7(MovieGenre), 1)
+            self.assertEqual(rekey_uuid7(MovieCollection), 1)
+            self.assertEqual(rekey_uuid7(Movie), 0)
+
+        for movie in Movie.objects.all():
+            self.assertEqual(movie.id.version, 7)
+            self.assertEqual(movie.id.int >> 80, int(movie.created.timestamp() * 1000))
+        self.assertEqual(
+            set(Movie.objects.values_list("title", flat=True)),
+            {movie.title for movie in self.movies},
+        )
+        collection = MovieCollection.objects.get()
+        self.assertEqual(collection.id.version, 7)
+        self.assertEqual(collection.movies.count(), 5)
+        genre = MovieGenre.objects.get()
+        self.assertEqual(genre.movies.count(), 5)
+        self.assertEqual(UserGenreCount.objects.get(user=self.user).genre_id, genre.id)
+        self.assertEqual(check_genre_counts(), [])
+
+        scopes = [set(call.args) for call in bump.call_args_list]
+        user = user_scope(self.user.pk)
+        # 3 batches of movies, the genre and the collection
+        self.assertEqual(
+            scopes,
+            [{MOVIES, user}] * 3 + [{MOVIES, GENRES}, {MOVIES, user}],
+        )
+
+    def test_command(self):
+        call_command("rekey_uuid7", "--noinput", stdout=io.StringIO())
+        self.assertEqual(
+            {
+                movie_id.version
+                for movie_id in Movie.objects.values_list("id", flat=True)
+            },
+            {7},
+        )
+        with self.assertRaises(CommandError):
+            call_command("rekey_uuid7", "--noinput", "--model", "nothing")
+
+
+class CollectionMoviesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="curator", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.collection = MovieCollection.objects.create(title="c", user=self.user)
+        self.url = f"/api/v1/collections/{self.collection.id}/"
+        drama = MovieGenre.objects.create(name="Drama")
+        self.movies = [Movie.objects.create(title=f"m{n}") for n in range(5)]
+        for movie in self.movies:
+            movie.genres.add(drama)
+        self.collection.movies.add(*self.movies[:3])
+
+    def movie_ids(self):
+        return set(self.collection.movies.values_list("id", flat=True))
+
+    def link_ids(self):
+        return dict(
+            CollectionMovie.objects.filter(moviecollection=self.collection).values_list(
+                "movie_id", "id"
+            )
+        )
+
+    def queries(self, function, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            result = function(*args, **kwargs)
+        return result, len(context.captured_queries)
+
+    def test_bulk_set_applies_the_difference(self):
+        m0, m1, m2, m3, _ = [movie.id for movie in self.movies]
+        links = self.link_ids()
+        added, removed = bulk_set(
+            CollectionMovie,
+            "moviecollection_id",
+            "movie_id",
+            self.collection.id,
+            [m1, m2, m3],
+        )
+        self.assertEqual(added, {(self.collection.id, m3)})
+        self.assertEqual(removed, {(self.collection.id, m0)})
+        self.assertEqual(self.movie_ids(), {m1, m2, m3})
+        # kept links are not rewritten
+        current = self.link_ids()
+        self.assertEqual((current[m1], current[m2]), (links[m1], links[m2]))
+        self.assertEqual(check_genre_counts(), [])
+
+        # reading the current rows is all an unchanged list costs
+        result, queries = self.queries(
+            bulk_set,
+            CollectionMovie,
+            "moviecollection_id",
+            "movie_id",
+            self.collection.id,
+            [m1, m2, m3],
+        )
+        self.assertEqual((result, queries), ((set(), set()), 1))
+
+    def test_known_skips_the_lookup(self):
+        m3, m4 = self.movies[3].id, self.movies[4].id
+        pairs = [(self.collection.id, m3)]
+        _, lookup = self.queries(
+            bulk_link, CollectionMovie, "moviecollection_id", "movie_id", pairs
+        )
+        bulk_unlink(CollectionMovie, "moviecollection_id", "movie_id", pairs)
+        added, known = self.queries(
+            bulk_link,
+            CollectionMovie,
+            "moviecollection_id",
+            "movie_id",
+            pairs,
+            known=True,
+        )
+        self.assertEqual(added, set(pairs))
+        self.assertEqual(known, lookup - 1)
+
+        # the lookup keeps an existing pair from being linked twice
+        self.assertEqual(
+            bulk_link(CollectionMovie, "moviecollection_id", "movie_id", pairs),
+            set(),
+        )
+
+        pairs = [(self.collection.id, m3), (self.collection.id, m4)]
+        removed, lookup = self.queries(
+            bulk_unlink, CollectionMovie, "moviecollection_id", "movie_id", pairs
+        )
+        # m4 was never linked
+        self.assertEqual(removed, {(self.collection.id, m3)})
+        bulk_link(CollectionMovie, "moviecollection_id", "movie_id", pairs)
+        removed, known = self.queries(
+            bulk_unlink,
+            CollectionMovie,
+            "moviecollection_id",
+            "movie_id",
+            pairs,
+            known=True,
+        )
+        self.assertEqual(removed, set(pairs))
+        self.assertEqual(known, lookup - 1)
+        self.assertEqual(check_genre_counts(), [])
+
+    def test_update_movies(self):
+        m0, m1, m2, m3, _ = [movie.id for movie in self.movies]
+        links = self.link_ids()
+        urls = [f"http://testserver/api/v1/movies/{m}/" for m in (m2, m3)]
+        response = self.client.patch(self.url, {"movies": urls}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.movie_ids(), {m2, m3})
+        self.assertEqual(self.link_ids()[m2], links[m2])
+        self.assertEqual(check_genre_counts(), [])
+
+        # movies are left as they are when not sent
+        response = self.client.patch(self.url, {"title": "renamed"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.movie_ids(), {m2, m3})
+
+    def test_add_and_remove_movies(self):
+        m0, _, _, m3, m4 = [movie.id for movie in self.movies]
+        response = self.client.patch(
+            f"{self.url}add-movies/", {"movies": [str(m0), str(m3)]}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["data"], {"added": 1})
+        self.assertIn(m3, self.movie_ids())
+
+        unknown = uuid.uuid4()
+        response = self.client.patch(
+            f"{self.url}add-movies/", {"movies": [str(m4), str(unknown)]}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(unknown), response.data["movies"][0])
+        self.assertNotIn(m4, self.movie_ids())
+
+        response = self.client.patch(
+            f"{self.url}remove-movies/", {"movies": [str(m0), str(m4)]}, format="json"
+        )
+        self.assertEqual(response.data["data"], {"removed": 1})
+        self.assertEqual(len(self.movie_ids()), 3)
+        self.assertEqual(check_genre_counts(), [])
+
+        response = self.client.patch(
+            f"{self.url}remove-movies/", {"movies": []}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class ExplainHotQueriesTests(TestCase):
+    def index_scan(self, cond):
+        return {
+            "Node Type": "Limit",
+            "Plans": [
+                {
+                    "Node Type": "Index Scan",
+                    "Index Name": "colsapp_movie_active_idx",
+                    "Index Cond": cond,
+                }
+            ],
+        }
+
+    def test_seq_scans_fail(self):
+        plan = {"Node Type": "Seq Scan", "Relation Name": "colsapp_movie"}
+        self.assertEqual(check_plan(plan), ([], ["seq scan on colsapp_movie"]))
+
+    def test_keyset_pages_seek_on_created(self):
+        seek = self.index_scan("(created >= '2026-01-01 00:00:00+00')")
+        self.assertEqual(
+            check_plan(seek, "created"), (["colsapp_movie_active_idx"], [])
+        )
+        # the created bound applied as a filter reads every row before the page
+        _, problems = check_plan(self.index_scan("(active = true)"), "created")
+        self.assertEqual(problems, ["created is not an index condition"])
+
+    def test_lists_read_active_rows_only(self):
+        user = User.objects.create_user(username="reader", password="secret")
+        queries = dict(hot_queries(user))
+        for name in INDEX_CONDS:
+            self.assertIn(name, queries)
+        where = {
+            name: str(q.query).partition("WHERE")[2] for name, q in queries.items()
+        }
+        for name in ("movies list", "collections list", "movies keyset page"):
+            self.assertIn('"active"', where[name])
+        for name in ("movie detail", "collection detail"):
+            self.assertNotIn('"active"', where[name])
+
+    def test_needs_postgres(self):
+        with self.assertRaises(CommandError):
+            call_command("explain_hot_queries")
+
+
+class GenreResolverTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="writer", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.collections = [
+            MovieCollection.objects.create(title=f"c{i}", user=self.user)
+            for i in range(10)
+        ]
+
+    def post_movie(self, title, genres, collections):
+        return self.client.post(
+            "/api/v1/movies/",
+            {
+                "title": title,
+                "description": "",
+                "genres": [{"name": name} for name in genres],
+                "collections": [str(c.id) for c in collections],
+            },
+            format="json",
+        )
+
+    def test_constant_queries_per_movie(self):
+        # genres and collections are looked up, inserted and linked with the
+        # same statements whatever their no
+        self.post_movie("warm up", ["drama"], self.collections[:1])
+        with self.assertNumQueries(16):
+            response = self.post_movie("one", ["comedy"], self.collections[:1])
+        self.assertEqual(response.status_code, 201)
+        with self.assertNumQueries(16):
+            response = self.post_movie(
+                "ten", [f"genre {i}" for i in range(10)], self.collections
+            )
+        self.assertEqual(response.status_code, 201)
+        movie = Movie.objects.get(title="ten")
+        self.assertEqual(movie.genres.count(), 10)
+        self.assertEqual(movie.collections.count(), 10)
+
+
+class GenreResolverCommitTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.resolver = GenreResolver()
+
+    def test_ids_are_cached_after_commit(self):
+        with transaction.atomic():
+            genre_ids = self.resolver.resolve(["Drama"])
+            self.assertIsNone(self.resolver._get("Drama"))
+        self.assertEqual(self.resolver._get("Drama"), genre_ids["Drama"])
+        with self.assertNumQueries(0):
+            self.resolver.resolve(["Drama"])
+
+    def test_rolled_back_ids_are_not_cached(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.resolver.resolve(["Drama"])
+            raise ValueError
+        self.assertIsNone(self.resolver._get("Drama"))
+        genre_ids = self.resolver.resolve(["Drama"])
+        self.assertEqual(MovieGenre.objects.get(name="Drama").id, genre_ids["Drama"])
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_pages_of_tied_rows(self):
+        # 25 movies in 3 instants, pages of 10 end in the middle of ties
+        movies = [Movie.objects.create(title=f"m{i}") for i in range(25)]
+        now = timezone.now()
+        for i, movie in enumerate(movies):
+            Movie.objects.filter(pk=movie.pk).update(
+                created=now + timedelta(seconds=i % 3)
+            )
+
+        seen, url, pages = [], "/api/v1/movies/?pagination=cursor", 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(movie["id"] for movie in response.data["results"])
+            url, pages = response.data["next"], pages + 1
+        self.assertEqual(pages, 3)
+        expected = Movie.objects.order_by("created", "id").values_list("id", flat=True)
+        self.assertEqual(seen, [str(movie_id) for movie_id in expected])
+
+        # and back from the last page
+        response = self.client.get(response.data["previous"])
+        self.assertEqual(
+            [movie["id"] for movie in response.data["results"]], seen[10:20]
+        )
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        drama = MovieGenre.objects.create(name="Drama")
+        for i in range(15):
+            movie = Movie.objects.create(
+                title=f"Alien {i}", description=f"alien number {i}", active=i % 5 != 0
+            )
+            if i < 4:
+                movie.genres.add(drama)
+        Movie.objects.create(title="Heat", description="a heist")
+        collection = MovieCollection.objects.create(title="Aliens", user=self.user)
+        collection.movies.add(*Movie.objects.filter(genres=drama))
+        MovieCollection.objects.create(title="Heists", user=self.user)
+
+    def search(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_ranked_pages(self):
+        # every rank ties off postgres, the pages go by id then
+        data = self.search("/api/v1/movies/search/?q=alien")
+        first = data["data"]["movies"]
+        self.assertEqual(len(first), 10)
+        self.assertEqual(first[0]["headline"], first[0]["description"])
+        self.assertIn("rank", first[0])
+        second = self.search(data["next"])["data"]["movies"]
+        titles = [movie["title"] for movie in first + second]
+        self.assertEqual(len(titles), 15)
+        self.assertEqual(len(set(titles)), 15)
+
+    def test_filters(self):
+        data = self.search("/api/v1/movies/search/?q=alien&genre=drama")
+        self.assertEqual(len(data["data"]["movies"]), 4)
+        data = self.search("/api/v1/movies/search/?q=alien&active=false")
+        self.assertEqual(
+            sorted(movie["title"] for movie in data["data"]["movies"]),
+            ["Alien 0", "Alien 10", "Alien 5"],
+        )
+        data = self.search("/api/v1/collections/search/?q=alien&genre=drama")
+        self.assertEqual(
+            [collection["title"] for collection in data["data"]["collections"]],
+            ["Aliens"],
+        )
+
+    def test_q_is_required(self):
+        response = self.client.get("/api/v1/movies/search/?q=")
+        self.assertEqual(response.status_code, 400)
+
+    def test_rank_is_double_precision_on_postgres(self):
+        # compared with the cursor's float, a real rank never equals it
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            queryset = search(Movie.objects.all(), "alien")
+        rank = queryset.query.annotations["rank"]
+        self.assertIsInstance(rank, Cast)
+        self.assertIsInstance(rank.output_field, FloatField)
+
+
+class RowSerializationTests(TestCase):
+    """
+    list pages built from values() rows have to render exactly as the
+    serializers' ones
+    """
+
+    def setUp(self):
+        patcher = mock.patch(
+            "colsapp.response_cache.response_cache.get", return_value=None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        genres = [MovieGenre.objects.create(name=name) for name in ("Drama", "Action")]
+        for i in range(12):
+            collection = MovieCollection.objects.create(
+                title=f"c{i}", description="caf\u00e9 \u2028", user=self.user
+            )
+            for j in range(3):
+                movie = Movie.objects.create(title=f"m{i} {j}")
+                movie.collections.add(collection)
+                movie.genres.add(*genres[: j % 3])
+
+    def assert_same_content(self, url):
+        with override_settings(FAST_LIST_SERIALIZATION=False):
+            expected = self.client.get(url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, expected.content)
+        return response
+
+    def test_movies(self):
+        self.assert_same_content("/api/v1/movies/")
+        self.assert_same_content("/api/v1/movies/?page=2")
+
+    def test_collections(self):
+        self.assert_same_content("/api/v1/collections/")
+
+    def test_cursor_pages(self):
+        for url in ("/api/v1/movies/", "/api/v1/collections/"):
+            response = self.assert_same_content(f"{url}?pagination=cursor")
+            self.assert_same_content(response.data["next"])
+
+    def test_fast_renderer(self):
+        data = {"title": "caf\u00e9 \u2028", "rank": 0.1, "ids": [1, None, True]}
+        self.assertEqual(
+            FastJSONRenderer().render(data),
+            JSONRenderer().render(data),
+        )
+
+
+@override_settings(EXPORT_CHUNK_SIZE=2)
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        genre = MovieGenre.objects.create(name="Drama")
+        for i in range(5):
+            collection = MovieCollection.objects.create(title=f"c{i}", user=self.user)
+            movie = Movie.objects.create(title=f"m{i}")
+            movie.collections.add(collection)
+            movie.genres.add(genre)
+        MovieCollection.objects.create(title="empty", user=self.user)
+
+    def test_ndjson(self):
+        response = self.client.get("/api/v1/collections/export/")
+        self.assertTrue(response.streaming)
+        lines = [json.loads(line) for line in response.streaming_content]
+        self.assertEqual([line["title"] for line in lines][-2:], ["c4", "empty"])
+        self.assertEqual(lines[0]["movies"][0]["title"], "m0")
+        self.assertEqual(lines[0]["movies"][0]["genres"], ["Drama"])
+        self.assertEqual(lines[-1]["movies"], [])
+
+    def test_csv(self):
+        response = self.client.get("/api/v1/collections/export/?type=csv")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(
+            csv.reader(b"".join(response.streaming_content).decode().splitlines())
+        )
+        self.assertEqual(rows[0][:2], ["collection_id", "collection_title"])
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[1][4:], ["m0", "", "Drama"])
+
+    def test_unknown_type(self):
+        response = self.client.get("/api/v1/collections/export/?type=xml")
+        self.assertEqual(response.status_code, 400)
+
+    def test_large_collection_is_read_in_chunks(self):
+        large = MovieCollection.objects.create(title="large", user=self.user)
+        for i in range(5):
+            Movie.objects.create(title=f"l{i}").collections.add(large)
+
+        for export_format in ("ndjson", CSV):
+            whole = "".join(export_lines(self.user, export_format))
+            with CaptureQueriesContext(connection) as queries:
+                chunked = "".join(export_lines(self.user, export_format, chunk_size=2))
+            self.assertEqual(chunked, whole)
+            # 5 movies of the large collection, 2 per query
+            limited = [q for q in queries if "LIMIT 2" in q["sql"]]
+            self.assertEqual(len(limited), 3)
+
+        last = json.loads("".join(export_lines(self.user)).splitlines()[-1])
+        self.assertEqual(len(last["movies"]), 5)
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.genre = MovieGenre.objects.create(name="Drama")
+        self.movies = [Movie.objects.create(title=f"m{i}") for i in range(3)]
+        for movie in self.movies:
+            movie.genres.add(self.genre)
+
+    def upload(self, name, content):
+        upload = SimpleUploadedFile(name, content.encode())
+        return self.client.post(
+            "/api/v1/collections/import/", {"file": upload}, format="multipart"
+        )
+
+    def test_ndjson(self):
+        first, second, third = [str(movie.id) for movie in self.movies]
+        lines = [
+            {"title": "a", "movies": [first, {"id": second}]},
+            {"title": "b", "description": "d", "movies": []},
+            {"title": "", "movies": [third]},
+            {"title": "c", "movies": [str(uuid.uuid4())]},
+        ]
+        content = "\n".join(json.dumps(line) for line in lines) + "\n{oops\n"
+        response = self.upload("library.ndjson", content)
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data["data"]["collections"], 2)
+        self.assertEqual(response.data["data"]["links"], 2)
+        self.assertEqual(response.data["data"]["skipped_links"], 1)
+        self.assertEqual(
+            [error["line"] for error in response.data["errors"]], [3, 5, 4]
+        )
+
+        collection = MovieCollection.objects.get(title="a")
+        self.assertEqual(collection.user, self.user)
+        self.assertEqual(collection.movies.count(), 2)
+        self.assertEqual(MovieCollection.fav_genres(self.user), ["Drama"])
+
+    def test_links_of_deleted_movies_are_reported(self):
+        deleted = self.movies[1].id
+
+        class Importer(CollectionImporter):
+            def bulk_write(self, collections, links):
+                # the movie went away between the lookup and the write
+                links = {link for link in links if link[1] != deleted}
+                return super().bulk_write(collections, links)
+
+        importer = Importer(self.user)
+        records = [
+            (1, {"title": "a", "movies": [str(m.id) for m in self.movies]}, None),
+            (2, {"title": "b", "movies": [str(self.movies[0].id)]}, None),
+        ]
+        report = importer.run(records)
+        self.assertEqual(
+            (report["collections"], report["links"], report["skipped_links"]),
+            (2, 3, 1),
+        )
+        self.assertEqual(
+            report["errors"],
+            [{"line": 1, "message": f"movies deleted meanwhile {deleted}"}],
+        )
+
+    def test_csv_export_round_trip(self):
+        collection = MovieCollection.objects.create(title="x", user=self.user)
+        collection.movies.add(*self.movies)
+        MovieCollection.objects.create(title="empty", user=self.user)
+        export = self.client.get("/api/v1/collections/export/?type=csv")
+        content = b"".join(export.streaming_content).decode()
+
+        response = self.upload("library.csv", content)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["data"]["collections"], 2)
+        self.assertEqual(response.data["data"]["links"], 3)
+        self.assertEqual(self.user.collections.filter(title="x").count(), 2)
+
+
+@override_settings(REPLICA_DATABASES=["replica_1"])
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.router = ReplicaRouter()
+
+    def test_only_marked_reads_use_replicas(self):
+        start_request()
+        self.assertEqual(self.router.db_for_read(Movie), "default")
+        with replica_reads(self.user.pk):
+            self.assertEqual(self.router.db_for_read(Movie), "replica_1")
+            self.assertEqual(self.router.db_for_write(Movie), "default")
+            # the rest of the request reads what it wrote
+            self.assertEqual(self.router.db_for_read(Movie), "default")
+
+    def test_write_pins_user_to_primary(self):
+        response = self.client.post(
+            "/api/v1/collections/", {"title": "c", "movies": []}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(is_pinned(self.user.pk))
+        with replica_reads(self.user.pk):
+            self.assertEqual(self.router.db_for_read(Movie), "default")
+
+
+class BatchedCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def counter(self, **options):
+        counter = BatchedCounter("test_counter", **options)
+        self.addCleanup(flusher._buffers.discard, counter)
+        return counter
+
+    def test_idle_counters_are_flushed(self):
+        counter = self.counter(flush_every=100, flush_interval=0.05)
+        counter.incr()
+        deadline = time.monotonic() + 5
+        while cache.get("test_counter") is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.get("test_counter"), 1)
+
+    def test_reset_drops_increments_buffered_before_it(self):
+        worker = self.counter(flush_interval=60)
+        other = self.counter(flush_interval=60)
+        worker.incr()
+        worker.flush()
+        self.assertEqual(other.total(), 1)
+
+        worker.incr(2)
+        other.reset()
+        worker.flush()
+        self.assertEqual(other.total(), 0)
+
+        worker.incr()
+        worker.flush()
+        self.assertEqual(other.total(), 1)
+
+    def test_increments_made_after_a_reset_elsewhere_count(self):
+        worker = self.counter(flush_interval=60)
+        other = self.counter(flush_interval=60)
+        worker.incr()
+        worker.flush()
+
+        worker.incr(2)
+        other.reset()
+        worker.incr(3)
+        worker.flush()
+        self.assertEqual(other.total(), 3)
+
+    def test_shards(self):
+        counter = self.counter(shards=4)
+        counter.incr(3)
+        self.assertEqual(counter.total(), 3)
+        counter.reset()
+        counter.incr()
+        self.assertEqual(counter.total(), 1)
+        self.assertEqual(len(counter.shard_keys(counter.current_epoch())), 4)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics_store.reset()
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_prometheus_endpoint(self):
+        self.client.get("/api/v1/movies/")
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        labels = 'method="GET",route="movie-list"'
+        self.assertIn("# TYPE http_request_duration_seconds histogram", lines)
+        self.assertIn(f"http_request_duration_seconds_count{{{labels}}} 1", lines)
+        self.assertIn(
+            f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1', lines
+        )
+        self.assertIn(
+            f'cache_lookups_total{{{labels},cache="response",result="miss"}} 1', lines
+        )
+        queries = [line for line in lines if line.startswith("db_queries_total")]
+        self.assertGreater(int(queries[0].split()[-1]), 0)
+
+    def test_profiler_folds_stacks(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        deadline = time.monotonic() + 0.05
+        while time.monotonic() < deadline:
+            pass
+        stacks = profiler.stop()
+        self.assertTrue(any("test_profiler_folds_stacks" in stack for stack in stacks))
+        with tempfile.TemporaryDirectory() as directory:
+            path = profiler.dump(stacks, directory, "GET:movie-list")
+            with open(path) as dump:
+                self.assertRegex(dump.readline(), r";.* \d+$")
+
+
+@skipIf(sparse is None, "needs numpy and scipy")
+class SimilarMoviesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.movies = {name: Movie.objects.create(title=name) for name in "abcd"}
+        for titles in ("ab", "abc", "ad"):
+            collection = MovieCollection.objects.create(title=titles, user=self.user)
+            collection.movies.set([self.movies[title] for title in titles])
+
+    def similar(self, name):
+        response = self.client.get(f"/api/v1/movies/{self.movies[name].id}/similar/")
+        self.assertEqual(response.status_code, 200)
+        return [
+            (movie["title"], round(movie["score"], 3))
+            for movie in response.data["movies"]
+        ]
+
+    def test_cosine(self):
+        refresh_all(k=2)
+        # c and d tie
+        first, second = self.similar("a")
+        self.assertEqual(first, ("b", 0.816))
+        self.assertIn(second, [("c", 0.577), ("d", 0.577)])
+        self.assertEqual(self.similar("d"), [("a", 0.577)])
+
+    def test_cooccurrence(self):
+        refresh_all(k=5, metric=COOCCURRENCE)
+        self.assertEqual(self.similar("a"), [("b", 2), ("c", 1), ("d", 1)])
+
+    def test_refresh_changed(self):
+        refresh_all(k=5)
+        MovieCollection.objects.get(title="ad").movies.add(self.movies["c"])
+        self.assertEqual(refresh_changed(k=5)[0], 1)
+        self.assertEqual(self.similar("c"), [("a", 0.816), ("d", 0.707), ("b", 0.5)])
+        self.assertEqual(refresh_changed(k=5), (0, 0))
+
+    def test_movie_deleted_since_the_similar_rows_were_read(self):
+        refresh_all(k=5, metric=COOCCURRENCE)
+        values = MovieRowSerializer.values
+
+        def without_b(serializer, queryset):
+            return values(serializer, queryset.exclude(title="b"))
+
+        with mock.patch.object(MovieRowSerializer, "values", without_b):
+            self.assertEqual(self.similar("a"), [("c", 1), ("d", 1)])
+
+    def test_unknown_movie(self):
+        response = self.client.get(f"/api/v1/movies/{uuid.uuid4()}/similar/")
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(SimilarMovie.objects.exists())
+
+
+class TrafficTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.counter = TrafficCounter(flush_every=1000, flush_interval=60)
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_buckets(self):
+        now = 7200 * 100
+        self.counter.record("GET:movie-list", 200, 1, timestamp=now)
+        self.counter.record("GET:movie-list", 200, 1, timestamp=now + 1)
+        self.counter.record("GET:movie-list", 404, 2, timestamp=now + 61)
+        self.counter.record("POST:collection-list", 201, 2, timestamp=now + 3600)
+
+        first, second = self.counter.query(now, now + 61)
+        self.assertEqual(first["requests"], 2)
+        self.assertEqual(first["unique_users"], 1)
+        self.assertEqual(second["by_status"], {"4xx": 1})
+
+        hours = self.counter.query(now, now + 3600, HOUR)
+        self.assertEqual([hour["requests"] for hour in hours], [3, 1])
+        self.assertEqual(hours[0]["unique_users"], 2)
+        only = self.counter.query(now, now + 3600, HOUR, "POST:collection-list")
+        self.assertEqual([hour["requests"] for hour in only], [0, 1])
+        self.assertEqual([hour["unique_users"] for hour in only], [0, 1])
+        only = self.counter.query(now, now + 3600, HOUR, "GET:movie-list")
+        self.assertEqual([hour["unique_users"] for hour in only], [2, 0])
+
+        self.counter.delete(now, now, HOUR)
+        self.assertEqual(self.counter.query(now, now, HOUR)[0]["requests"], 0)
+        only = self.counter.query(now, now, HOUR, "GET:movie-list")
+        self.assertEqual(only[0]["unique_users"], 0)
+        with self.assertRaises(ValueError):
+            self.counter.query(0, now)
+
+    def test_request_count_range(self):
+        self.client.get("/api/v1/movies/")
+        response = self.client.get(
+            "/request-count/",
+            {"start": "2020-01-01T00:00:00", "granularity": "hour"},
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(
+            "/request-count/", {"start": timezone.now().isoformat()}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("buckets", response.data)
+
+
+class MayaCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.maya = MayaResponseCache(
+            TTL=60, STALE_TTL=600, ERROR_TTL=5, LOCK_WAIT=0.2, LOCK_TIMEOUT=10
+        )
+        self.maya.reset_stats()
+        self.loader = mock.Mock(return_value=({"results": [1]}, True))
+
+    def stale(self, key):
+        entry = {"data": {"results": [0]}, "ok": True, "fresh_until": time.time() - 1}
+        cache.set(key, entry, timeout=600)
+        return entry
+
+    def wait_for_release(self, key):
+        deadline = time.monotonic() + 5
+        while cache.get(f"{key}:lock") is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_miss_then_hit(self):
+        entry, state = self.maya.get_or_load("k", self.loader)
+        self.assertEqual((entry["data"], state), ({"results": [1]}, "miss"))
+        entry, state = self.maya.get_or_load("k", self.loader)
+        self.assertEqual(state, "fresh")
+        self.assertEqual(self.loader.call_count, 1)
+        stats = self.maya.get_stats()
+        self.assertEqual((stats["hit"], stats["miss"], stats["upstream"]), (1, 1, 1))
+        self.assertIsNone(cache.get("k:lock"))
+
+    def test_stale_is_served_while_refreshed(self):
+        self.stale("k")
+        entry, state = self.maya.get_or_load("k", self.loader)
+        self.assertEqual((entry["data"], state), ({"results": [0]}, "stale"))
+        self.wait_for_release("k")
+        entry, state = self.maya.get_or_load("k", self.loader)
+        self.assertEqual((entry["data"], state), ({"results": [1]}, "fresh"))
+
+    def test_errors_are_cached_for_error_ttl(self):
+        self.loader.return_value = ({"is_success": False}, False)
+        entry, _ = self.maya.get_or_load("k", self.loader)
+        self.assertFalse(entry["ok"])
+        self.assertAlmostEqual(entry["fresh_until"], time.time() + 5, delta=1)
+        self.maya.get_or_load("k", self.loader)
+        self.assertEqual(self.loader.call_count, 1)
+        self.assertEqual(self.maya.get_stats()["upstream_error"], 1)
+
+    def test_failed_refresh_keeps_the_stale_entry(self):
+        stale = self.stale("k")
+        self.loader.return_value = (None, False)
+        self.maya.get_or_load("k", self.loader)
+        self.wait_for_release("k")
+
+        entry, state = self.maya.get_or_load("k", self.loader)
+        self.assertEqual(state, "stale")
+        self.assertEqual(entry["fresh_until"], stale["fresh_until"])
+        self.assertEqual(entry["data"], stale["data"])
+        # not retried before ERROR_TTL
+        self.assertEqual(self.loader.call_count, 1)
+        self.assertIsNone(cache.get("k:lock"))
+
+    def test_waiters_get_the_lock_holders_result(self):
+        token = self.maya._acquire("k")
+
+        def load():
+            time.sleep(0.05)
+            self.maya._finish("k", ({"results": [2]}, True), token=token)
+
+        thread = threading.Thread(target=load)
+        thread.start()
+        entry, state = self.maya.get_or_load("k", self.loader)
+        thread.join()
+        self.assertEqual((entry["data"], state), ({"results": [2]}, "miss"))
+        self.loader.assert_not_called()
+        self.assertEqual(self.maya.get_stats()["coalesced"], 1)
+
+    def test_waiters_give_up_without_calling_maya(self):
+        self.maya._acquire("k")
+        entry, _ = self.maya.get_or_load("k", self.loader)
+        self.assertFalse(entry["ok"])
+        self.assertIsNone(cache.get("k"))
+        self.loader.assert_not_called()
+        self.assertEqual(self.maya.get_stats()["unavailable"], 1)
+
+    def test_lock_is_only_released_by_its_holder(self):
+        token = self.maya._acquire("k")
+        self.assertIsNone(self.maya._acquire("k"))
+        self.maya._release("k", "someone else")
+        self.assertEqual(cache.get("k:lock"), token)
+        self.maya._release("k", token)
+        self.assertIsNotNone(self.maya._acquire("k"))
+
+    def test_lock_outlives_the_slowest_call(self):
+        maya = MayaResponseCache(LOCK_TIMEOUT=None)
+        client = mock.Mock(**{"worst_case_seconds.return_value": 41.8})
+        with mock.patch("colsapp.maya_cache.get_client", return_value=client):
+            self.assertEqual(maya.lock_timeout, 43)
+
+    def test_async_refresh_task_is_kept_until_done(self):
+        self.stale("k")
+
+        async def loader():
+            return {"results": [3]}, True
+
+        async def run():
+            entry, state = await self.maya.aget_or_load("k", loader)
+            tasks = set(self.maya._tasks)
+            await asyncio.gather(*tasks)
+            return state, tasks
+
+        state, tasks = asyncio.run(run())
+        self.assertEqual((state, len(tasks)), ("stale", 1))
+        self.assertEqual(self.maya._tasks, set())
+        self.assertEqual(cache.get("k")["data"], {"results": [3]})
+
+
+class MayaPrefetchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        patcher = mock.patch("colsapp.views.load_movie_page", side_effect=self.page)
+        self.load = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def page(self, page, path):
+        page = int(page or 1)
+        next_page = f"{path}?page={page + 1}" if page < 3 else None
+        return {"count": 30, "next": next_page, "results": [page]}, True
+
+    def wait_for(self, key):
+        deadline = time.monotonic() + 5
+        while cache.get(key) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return cache.get(key)
+
+    def test_next_page_is_prefetched(self):
+        response = self.client.get("/", {"page": 2})
+        self.assertEqual(response.data["results"], [2])
+        entry = self.wait_for(page_key("/", 3))
+        self.assertEqual(entry["data"]["results"], [3])
+
+        # served from the prefetched entry, the last page prefetches nothing
+        self.load.reset_mock()
+        self.client.get("/", {"page": 3})
+        self.assertEqual(self.load.call_count, 0)
+
+    def test_ttls_are_jittered(self):
+        maya = MayaResponseCache(TTL=100, TTL_JITTER=0.1)
+        now = time.time()
+        fresh = [
+            maya._store(f"movies_/?page={page}", {}, True)["fresh_until"] - now
+            for page in range(50)
+        ]
+        self.assertTrue(all(89 < ttl < 111 for ttl in fresh))
+        self.assertGreater(len({round(ttl) for ttl in fresh}), 1)
+
+    def test_warm_command(self):
+        out = io.StringIO()
+        call_command("warm_maya_cache", stdout=out)
+        self.assertIn("3 pages warmed, 0 failed, 0 skipped", out.getvalue())
+        self.assertEqual(self.load.call_count, 3)
+        for key in (page_key("/"), page_key("/", 2), page_key("/", 3)):
+            self.assertTrue(cache.get(key)["ok"])
+        self.assertIsNone(cache.get(page_key("/", 1)))
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+        patcher = mock.patch("maya_api.breaker.time")
+        patcher.start().time.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+
+    def breaker(self, **options):
+        options = {
+            "MIN_CALLS": 4,
+            "ERROR_RATE": 0.5,
+            "SLOW_RATE": 0.25,
+            "OPEN_TIMEOUT": 30,
+            "LATENCY_BUDGETS": {"movies/": 2},
+            "MIN_TIMEOUT": 0.5,
+            "HEDGE_AFTER": None,
+            **options,
+        }
+        return CircuitBreaker("test", **options)
+
+    def test_open_probe_close(self):
+        breaker = self.breaker()
+        for success in (True, True, False):
+            breaker.record(success, 0.1, "movies/")
+        self.assertEqual(breaker.state(), CLOSED)
+        breaker.record(False, 0.1, "movies/")
+        self.assertEqual(breaker.state(), OPEN)
+        self.assertEqual(breaker.allow(), (False, False))
+
+        self.now += 31
+        self.assertEqual(breaker.allow(), (True, True))
+        self.assertEqual(breaker.state(), HALF_OPEN)
+        # one probe at a time
+        self.assertEqual(breaker.allow(), (False, False))
+        breaker.record(False, 0.1, "movies/", probe=True)
+        self.assertEqual(breaker.state(), OPEN)
+
+        self.now += 31
+        self.assertEqual(breaker.allow(), (True, True))
+        breaker.record(True, 0.1, "movies/", probe=True)
+        self.assertEqual(breaker.state(), CLOSED)
+        self.assertEqual(breaker.allow(), (True, False))
+        # the window of the failures starts over
+        breaker.record(False, 0.1, "movies/")
+        self.assertEqual(breaker.state(), CLOSED)
+
+    def test_slow_probe_reopens(self):
+        breaker = self.breaker()
+        breaker.open()
+        self.now += 31
+        _, probe = breaker.allow()
+        breaker.record(True, 2.5, "movies/", probe=probe)
+        self.assertEqual(breaker.state(), OPEN)
+
+    def test_slow_call_rate(self):
+        breaker = self.breaker()
+        for latency in (0.1, 1.9):
+            breaker.record(True, latency, "movies/")
+        # endpoints without a budget are never slow
+        breaker.record(True, 5, "other/")
+        self.assertEqual(breaker.state(), CLOSED)
+        breaker.record(True, 2.5, "movies/")
+        self.assertEqual(breaker.state(), OPEN)
+
+    def test_timeouts(self):
+        breaker = self.breaker()
+        self.assertEqual(breaker.timeout_for("movies/", 10), 2)
+        self.assertEqual(breaker.timeout_for("other/", 10), 10)
+        for _ in range(20):
+            breaker.latencies.add("movies/", 0.1)
+        self.assertAlmostEqual(breaker.timeout_for("movies/", 10), 0.5)
+
+    def test_retry_plan(self):
+        # 3 retries sleep 0.6 and 1.2 seconds, 4 attempts share the rest
+        self.assertAlmostEqual(worst_case_seconds(3, 0.3, 1), 5.8)
+        self.assertAlmostEqual(attempt_timeout(5.8, 3, 0.3), 1)
+        self.assertEqual(retry_plan(5.8, 3, 0.3, 1)[0], 3)
+        # retries are dropped rather than attempts cut short
+        self.assertEqual(retry_plan(2, 3, 0.3, 1), (1, 1))
+        self.assertEqual(retry_plan(0.5, 3, 0.3, 1), (0, 0.5))
+
+        client = MayaApiClient(
+            breaker=self.breaker(MIN_ATTEMPT_TIMEOUT=1),
+            retries=3,
+            backoff_factor=0.3,
+            timeout=10,
+        )
+        self.assertEqual(client.call_plan("movies/"), (2, 1, 1))
+        self.assertEqual(client.worst_case_seconds("movies/"), 2)
+        budget, retries, timeout = client.call_plan("other/")
+        self.assertAlmostEqual(budget, 41.8)
+        self.assertEqual((retries, timeout), (3, 10))
+
+    def test_budget_bounds_the_whole_call(self):
+        maya = FakeMaya(25)
+        self.addCleanup(maya.stop)
+        maya.delay = 0.6
+        client = MayaApiClient(
+            breaker=self.breaker(MIN_ATTEMPT_TIMEOUT=1), base_url=maya.base_url
+        )
+        # slower than MIN_TIMEOUT, within the attempt of a 2 seconds budget
+        self.assertEqual(len(client.get_movie_list(1)["results"]), 10)
+
+        client.breaker = self.breaker(
+            LATENCY_BUDGETS={"movies/": 1}, MIN_ATTEMPT_TIMEOUT=0.3
+        )
+        client.backoff_factor = 0
+        maya.requested.clear()
+        start = time.monotonic()
+        with self.assertRaises(ApiTimeoutException):
+            client.get_movie_list(1)
+        # scheduling slack only
+        self.assertLessEqual(time.monotonic() - start, 1 + 0.05)
+        self.assertEqual(len(maya.requested), 3)
+
+    def test_hedging(self):
+        client = MayaApiClient(
+            breaker=self.breaker(HEDGE_AFTER=0.05), base_url="http://maya/"
+        )
+        calls = []
+        slow_done = threading.Event()
+
+        def send_get(url, params, timeout, retries, deadline):
+            calls.append(timeout)
+            if len(calls) == 1:
+                slow_done.wait(1)
+                return mock.Mock(status_code=200, name="slow"), 0
+            return mock.Mock(status_code=200, name="fast"), 0
+
+        with mock.patch.object(client, "_send_get", side_effect=send_get):
+            response = client._get("http://maya/movies/")
+        slow_done.set()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(response._extract_mock_name(), "fast")
+
+        calls.clear()
+        with mock.patch.object(
+            client, "_send_get", return_value=(mock.Mock(status_code=200), 0)
+        ) as send_get:
+            client._get("http://maya/movies/")
+        self.assertEqual(send_get.call_count, 1)
+
+
+class LoggingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.stream = io.StringIO()
+        self.logger = logging.getLogger("colsapp.tests.logging")
+        self.logger.propagate = False
+        self.addCleanup(setattr, self.logger, "propagate", True)
+
+    def queued(self, target, maxsize=100):
+        handler = QueuedHandler(target, maxsize=maxsize)
+        handler.setFormatter(JSONFormatter())
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def records(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_json_records_with_request_id(self):
+        handler = self.queued(logging.StreamHandler(self.stream))
+        token = set_request_id("abc")
+        try:
+            self.logger.warning("maya took %s", "long", extra={"seconds": 1.5})
+        finally:
+            reset_request_id(token)
+        handler.close()
+        (record,) = self.records()
+        self.assertEqual(record["message"], "maya took long")
+        self.assertEqual(record["request_id"], "abc")
+        self.assertEqual(record["seconds"], 1.5)
+
+    def test_full_queue_drops_records(self):
+        release = threading.Event()
+
+        class SlowHandler(logging.StreamHandler):
+            def emit(self, record):
+                release.wait(5)
+                super().emit(record)
+
+        handler = self.queued(SlowHandler(self.stream), maxsize=1)
+        for number in range(5):
+            self.logger.warning("record %s", number)
+        release.set()
+        handler.close()
+        records = self.records()
+        dropped = [record["dropped"] for record in records if "dropped" in record]
+        self.assertEqual(len(records) - len(dropped) + sum(dropped), 5)
+        self.assertGreaterEqual(sum(dropped), 3)
+
+    def test_listener_per_process(self):
+        handler = self.queued(logging.StreamHandler(self.stream))
+        # nothing runs until the first record
+        self.assertIsNone(handler.listener)
+        self.logger.warning("parent")
+        parent = handler.listener
+        self.assertIsNotNone(parent._thread)
+
+        # a forked worker starts its own listener and queue
+        parent_queue = handler.queue
+        with mock.patch("moviecollection.logs.os.getpid", return_value=-1):
+            self.logger.warning("worker")
+            self.assertIsNot(handler.listener, parent)
+            self.assertIsNot(handler.queue, parent_queue)
+            handler.close()
+        parent.stop()
+        self.assertEqual(
+            sorted(record["message"] for record in self.records()),
+            ["parent", "worker"],
+        )
+
+    @override_settings(ADMINS=[("admin", "admin@example.com")])
+    def test_error_mails_are_rate_limited(self):
+        handler = RateLimitedAdminEmailHandler(interval=60)
+        for _ in range(3):
+            record = self.logger.makeRecord(
+                self.logger.name, logging.ERROR, __file__, 1, "boom", (), None
+            )
+            handler.emit(record)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_request_id_header(self):
+        client = APIClient()
+        response = client.get("/request-count/", HTTP_X_REQUEST_ID="abc-1")
+        self.assertEqual(response["X-Request-ID"], "abc-1")
+        response = client.get("/request-count/", HTTP_X_REQUEST_ID="a b")
+        self.assertRegex(response["X-Request-ID"], r"^[0-9a-f]{32}$")
+
+
+class AsyncMayaClientTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.maya = FakeMaya(25)
+        self.addCleanup(self.maya.stop)
+        self.breaker = CircuitBreaker(
+            "test", MIN_CALLS=100, MIN_TIMEOUT=0.05, LATENCY_BUDGETS={}
+        )
+
+    def get(self, page=1, base_url=None, **options):
+        options = {"retries": 2, "backoff_factor": 0.3, **options}
+        client = AsyncMayaApiClient(
+            base_url=base_url or self.maya.base_url, breaker=self.breaker, **options
+        )
+        self.sleeps = sleeps = []
+
+        async def sleep(seconds):
+            sleeps.append(seconds)
+
+        async def get():
+            try:
+                with mock.patch("maya_api.async_client.asyncio.sleep", new=sleep):
+                    return await client.get_movie_list(page)
+            finally:
+                await close_session()
+
+        return asyncio.run(get()), sleeps
+
+    def test_success(self):
+        data, sleeps = self.get(page=3)
+        self.assertEqual(len(data["results"]), 5)
+        self.assertEqual((self.maya.requested, sleeps), ([3], []))
+
+    def test_retryable_status(self):
+        self.maya.failing.add(1)
+        self.maya.failing_status = 502
+        with self.assertRaises(ResponseException):
+            self.get()
+        # the first attempt and 2 retries, backoff as urllib3 Retry
+        self.assertEqual(self.maya.requested, [1, 1, 1])
+        self.assertEqual(self.sleeps, [0, 0.6])
+
+    def test_other_status_is_returned(self):
+        self.maya.failing.add(1)
+        data, sleeps = self.get()
+        self.assertEqual(data["message"], "maya is down")
+        self.assertEqual((self.maya.requested, sleeps), ([1], []))
+
+    def test_connection_error(self):
+        self.maya.stop()
+        with self.assertRaises(ApiConnectionErrorException):
+            self.get(retries=1)
+
+    def test_timeout(self):
+        self.maya.delay = 0.3
+        with self.assertRaises(ApiTimeoutException):
+            self.get(retries=1, timeout=0.1)
+        self.assertEqual(self.maya.requested, [1, 1])
+
+    def test_budget_ends_retries(self):
+        self.maya.delay = 0.3
+        self.breaker.budgets = {"movies/": 0.5}
+        self.breaker.min_attempt_timeout = 0.1
+        start = time.monotonic()
+        with self.assertRaises(ApiTimeoutException):
+            self.get(retries=10, backoff_factor=0, timeout=10)
+        # closing the session and the loop take the rest
+        self.assertLess(time.monotonic() - start, 0.5 + 0.1)
+        # 4 retries leave every attempt 0.1 seconds of the budget
+        self.assertLessEqual(len(self.maya.requested), 5)
+
+    def test_session_of_the_running_loop(self):
+        async def sessions():
+            first, second = get_session(), get_session()
+            await close_session()
+            return first, second
+
+        first, second = asyncio.run(sessions())
+        self.assertIs(first, second)
+        self.assertTrue(first.closed)
+        self.assertIsNone(async_client._session)
+        with self.assertRaises(RuntimeError):
+            get_session()
+
+    def test_session_of_a_previous_loop_is_closed(self):
+        async def session():
+            return get_session()
+
+        # asyncio.run cancels the tasks of the loop, which closes its session
+        first = asyncio.run(session())
+        self.assertTrue(first.closed)
+
+        loop = asyncio.new_event_loop()
+        try:
+            first = loop.run_until_complete(session())
+            second = asyncio.run(session())
+            self.assertIsNot(first, second)
+            self.assertFalse(first.closed)
+            # the close was scheduled on the first loop
+            loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertTrue(first.closed)
+        finally:
+            for task in asyncio.all_tasks(loop):
+                task.cancel()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+
+class AsgiRoutingTests(TestCase):
+    def call(self, scope, messages=()):
+        messages = list(messages)
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi.application(scope, receive, send))
+        return sent
+
+    def http(self, method, path):
+        return {"type": "http", "method": method, "path": path, "headers": []}
+
+    def test_routes(self):
+        self.assertIs(asgi.ASYNC_ROUTES[("GET", "/")], home_page)
+        served = []
+
+        async def view(scope, receive, send):
+            served.append(("async", scope["method"], scope["path"]))
+
+        async def django_application(scope, receive, send):
+            served.append(("django", scope["method"], scope["path"]))
+
+        with mock.patch.dict(asgi.ASYNC_ROUTES, {("GET", "/"): view}), mock.patch(
+            "moviecollection.asgi.django_application", new=django_application
+        ):
+            self.call(self.http("GET", "/"))
+            self.call(self.http("POST", "/"))
+            self.call(self.http("GET", "/api/v1/collection/"))
+        self.assertEqual(
+            served,
+            [
+                ("async", "GET", "/"),
+                ("django", "POST", "/"),
+                ("django", "GET", "/api/v1/collection/"),
+            ],
+        )
+
+    def test_lifespan_closes_the_session(self):
+        sessions = []
+
+        async def receive():
+            if not sessions:
+                sessions.append(get_session())
+                return {"type": "lifespan.startup"}
+            return {"type": "lifespan.shutdown"}
+
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        asyncio.run(asgi.application({"type": "lifespan"}, receive, send))
+        self.assertEqual(
+            sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+        )
+        self.assertTrue(sessions[0].closed)
+        self.assertIsNone(async_client._session)
+
+
+class AsyncHomePageTests(TestCase):
+    def setUp(self):
+        # requests of other tests still buffered
+        traffic_counter.flush()
+        cache.clear()
+        metrics_store.reset()
+        self.seen = {}
+        entry = {"data": {"count": 1, "next": None, "results": []}, "ok": True}
+
+        async def aget_or_load(key, loader):
+            self.seen["request_id"] = current_request_id()
+            record_cache("maya", True)
+            return entry, "fresh"
+
+        for target, options in (
+            (
+                "colsapp.async_views._prepare_home_page",
+                {"return_value": mock.Mock(pk=7)},
+            ),
+            ("colsapp.async_views.prefetch_movie_pages", {}),
+            ("colsapp.async_views.maya_cache.aget_or_load", {"new": aget_or_load}),
+        ):
+            patcher = mock.patch(target, **options)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, headers=()):
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/",
+            "query_string": b"page=2",
+            "headers": [(b"authorization", b"Token abc"), *headers],
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(home_page(scope, receive, send))
+        start = messages[0]
+        return start["status"], dict(start["headers"])
+
+    def test_request_id(self):
+        status, headers = self.get([(b"x-request-id", b"abc-1")])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"x-request-id"], b"abc-1")
+        self.assertEqual(self.seen["request_id"], "abc-1")
+        self.assertIsNone(current_request_id())
+
+    def test_metrics(self):
+        self.get()
+        self.get()
+        route = metrics_store.snapshot()["GET:home"]
+        self.assertEqual(route["requests"], 2)
+        self.assertEqual(route["cache:maya:hit"], 2)
+        self.assertNotIn("errors", route)
+
+    def test_traffic(self):
+        self.get()
+        now = time.time()
+        (bucket,) = traffic_counter.query(now, now, HOUR, "GET:home")
+        self.assertEqual(bucket["by_status"], {"2xx": 1})
+        self.assertEqual(bucket["unique_users"], 1)
+
+    def test_invalid_request_id_is_replaced(self):
+        _, headers = self.get([(b"x-request-id", b"a b")])
+        self.assertRegex(headers[b"x-request-id"].decode(), r"^[0-9a-f]{32}$")
+        self.assertEqual(self.seen["request_id"], headers[b"x-request-id"].decode())
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="secret")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def test_warm_cache_needs_no_query(self):
+        self.client.get("/request-count/")
+        with self.assertNumQueries(0):
+            response = self.client.get("/request-count/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get("/request-count/")
+        self.token.delete()
+        self.assertEqual(self.client.get("/request-count/").status_code, 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get("/request-count/")
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get("/request-count/").status_code, 401)
+
+
+class ResponseCacheTests(TransactionTestCase):
+    # generations are bumped on commit, which TestCase never does
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="reader", password="secret")
+        token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        self.collection = MovieCollection.objects.create(title="c", user=self.user)
+
+    def test_hit_and_not_modified(self):
+        response = self.client.get("/api/v1/collections/")
+        self.assertEqual(response["X-Cache"], "MISS")
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/v1/collections/")
+        self.assertEqual(response["X-Cache"], "HIT")
+
+        response = self.client.get(
+            "/api/v1/collections/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_hit_keeps_headers(self):
+        miss = self.client.get("/api/v1/collections/")
+        hit = self.client.get("/api/v1/collections/")
+        self.assertEqual(hit["X-Cache"], "HIT")
+        for header in ("Content-Type", "Vary", "Allow"):
+            self.assertEqual(hit[header], miss[header])
+
+        response = self.client.get(
+            "/api/v1/collections/", HTTP_IF_NONE_MATCH=f'"other", W/{miss["ETag"]}'
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["Vary"], miss["Vary"])
+
+    def test_etag_is_compared_exactly(self):
+        etag = self.client.get("/api/v1/collections/")["ETag"]
+        for header in (etag[:-3] + '"', f'"x{etag[1:]}', etag.strip('"')):
+            response = self.client.get(
+                "/api/v1/collections/", HTTP_IF_NONE_MATCH=header
+            )
+            self.assertEqual(response.status_code, 200, header)
+
+    def test_write_invalidates(self):
+        etag = self.client.get("/api/v1/collections/")["ETag"]
+        movie = Movie.objects.create(title="m")
+        genre = MovieGenre.objects.create(name="Drama")
+        movie.genres.add(genre)
+        self.client.patch(
+            f"/api/v1/collections/{self.collection.id}/add-movies/",
+            {"movies": [str(movie.id)]},
+            format="json",
+        )
+
+        response = self.client.get("/api/v1/collections/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["data"]["fav_genres"], ["Drama"])
+        self.assertEqual(len(response.data["data"]["collections"][0]["movies"]), 1)
+
+    def test_movie_change_invalidates(self):
+        movie = Movie.objects.create(title="before")
+        self.client.get(f"/api/v1/movies/{movie.id}/")
+        movie.title = "after"
+        movie.save()
+        response = self.client.get(f"/api/v1/movies/{movie.id}/")
+        self.assertEqual(response.data["title"], "after")
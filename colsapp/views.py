@@ -1,18 +1,57 @@
+import functools
 import logging
+import math
+import uuid
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.cache import cache
+from django.db.models import Prefetch
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework.decorators import api_view, permission_classes, action
+from rest_framework.exceptions import NotFound
 from rest_framework import permissions, viewsets, status
+from rest_framework.parsers import JSONParser, MultiPartParser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
-from maya_api.client import MayaApiClient
-from .serializers import MovieSerializer, CollectionSerializer, UserSerializer
-from .models import Movie, MovieCollection, MovieGenre
+from maya_api.breaker import maya_breaker
+from maya_api.client import get_client
+from maya_api.exceptions import (
+    ApiConnectionErrorException,
+    ApiTimeoutException,
+    CircuitOpenException,
+)
+from moviecollection.counters import request_counter
+from moviecollection.metrics import PROMETHEUS_CONTENT_TYPE, metrics_store
+from moviecollection.routers import read_from_replica
+from moviecollection.traffic import GRANULARITIES, MINUTE, traffic_counter
+from .export import CSV, FORMATS, NDJSON, export_lines
+from .imports import CollectionImporter, parse_records
+from .maya_cache import FRESH, maya_cache, page_key
+from .pagination import RankedKeysetPagination, SelectablePagination
+from .response_cache import GENRES, MOVIES, cached_response, user_scope
+from .row_serializers import CollectionRowSerializer, MovieRowSerializer
+from .search import search
+from .bulk import MovieBulkWriter, bulk_link, bulk_unlink
+from .parsers import NDJSONParser
+from .serializers import (
+    CollectionMoviesSerializer,
+    CollectionSerializer,
+    MovieSerializer,
+    UserSerializer,
+)
+from .models import Movie, MovieCollection, MovieGenre, SimilarMovie
 
 
 logger = logging.getLogger(__name__)
 
+# payload sent when maya could not be reached
+MAYA_UNAVAILABLE = {
+    "is_success": False,
+    "message": "movies are not available right now, please try again later",
+}
+
 
 class UserCreate(APIView):
     """ 
@@ -35,95 +74,578 @@ class UserCreate(APIView):
 @api_view(["GET"])
 @permission_classes([permissions.IsAuthenticated])
 def request_count(request):
-    data = {"request_count": cache.get("request_count", 0)}
+    """
+    total requests, with ?start=&end= (ISO datetimes) also the traffic of
+    every minute or hour (?granularity=) of the range, optionally of one
+    ?endpoint= ("<method>:<view name>")
+    """
+    data = {"request_count": request_counter.total()}
+    if "start" in request.query_params or "end" in request.query_params:
+        try:
+            start, end, granularity = traffic_range(request.query_params)
+            data["buckets"] = traffic_counter.query(
+                start, end, granularity, request.query_params.get("endpoint")
+            )
+        except ValueError as exc:
+            return Response({"message": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
     return Response(data=data, status=status.HTTP_200_OK)
 
 
 @api_view(["POST"])
 @permission_classes([permissions.IsAuthenticated])
 def reset_request_count(request):
-    cache.delete("request_count")
+    """
+    resets the total, or with ?start=&end= deletes the traffic buckets of
+    the range instead
+    """
+    if "start" in request.query_params or "end" in request.query_params:
+        try:
+            start, end, granularity = traffic_range(request.query_params)
+        except ValueError as exc:
+            return Response({"message": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        traffic_counter.delete(start, end, granularity)
+        data = {"message": "traffic deleted successfully"}
+        return Response(data, status=status.HTTP_200_OK)
+
+    request_counter.reset()
     data = {"message": "request count reset successfully"}
     return Response(data, status=status.HTTP_200_OK)
 
 
+def traffic_range(params):
+    """
+    return: (start, end, granularity) of the query params, start and end as
+    timestamps, end defaults to now
+    raises ValueError for invalid params
+    """
+    granularity = params.get("granularity", MINUTE)
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    bounds = []
+    for name in ("start", "end"):
+        value = params.get(name)
+        if value is None:
+            bounds.append(timezone.now())
+            continue
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError(f"{name} must be an ISO 8601 datetime")
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed, timezone.utc)
+        bounds.append(parsed)
+    start, end = bounds
+    if start > end:
+        raise ValueError("start must be before end")
+    return start.timestamp(), end.timestamp(), granularity
+
+
 @api_view(["GET"])
 @permission_classes([permissions.IsAuthenticated])
-def home_page(request):
-    page = request.GET.get("page")
-    full_path = f"movies_{request.get_full_path()}"
+def metrics(request):
+    """
+    per route request metrics in the Prometheus text format
+    """
+    return HttpResponse(metrics_store.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
 
-    if full_path in cache:
-        # getting from cache
-        return Response(cache.get(full_path), status=status.HTTP_200_OK)
+def rewrite_page_links(data, api_movie_url, path):
+    """
+    points maya next/previous links to our home page
+    """
+    for key in ("next", "previous"):
+        if data.get(key):
+            data[key] = data[key].replace(api_movie_url, path)
+    return data
 
+
+def load_movie_page(page, path):
+    """
+    fetches a page of maya movies for the maya cache
+    return: (data, ok)
+    """
     try:
-        client = MayaApiClient()
+        client = get_client()
         data = client.get_movie_list(page=page)
 
     except ApiConnectionErrorException as e:
-        pass
+        return dict(MAYA_UNAVAILABLE), False
 
     except ApiTimeoutException as e:
-        pass
+        return dict(MAYA_UNAVAILABLE), False
+
+    except CircuitOpenException as e:
+        # failing fast, maya is known to be down
+        return dict(MAYA_UNAVAILABLE), False
 
     except Exception as e:
-        pass
+        logger.error("maya movie list failed", exc_info=True)
+        return dict(MAYA_UNAVAILABLE), False
+
+    # API seems to be return is_success flag in case of failure
+    if "is_success" in data:
+        return data, False
+
+    # catalog is fed into db by `manage.py ingest_maya`
+    rewrite_page_links(data, client._build_url("movies/"), path)
+    return data, True
 
+
+def local_movie_page(page, path):
+    """
+    builds a maya shaped page out of the ingested movies, used while maya is
+    unavailable and nothing is cached for the page
+    return: data or None when the page can not be served locally
+    """
+    page_size = settings.MAYA_SETTINGS.get("PAGE_SIZE", 10)
+    try:
+        page = max(int(page or 1), 1)
+    except ValueError:
+        return None
+
+    queryset = Movie.objects.filter(maya_uuid__isnull=False)
+    count = queryset.count()
+    offset = (page - 1) * page_size
+    if offset >= count:
+        return None
+
+    movies = queryset.order_by("created", "id").prefetch_related("genres")[
+        offset : offset + page_size
+    ]
+    previous_page = None
+    if page > 1:
+        previous_page = f"{path}?page={page - 1}"
+    next_page = None
+    if offset + page_size < count:
+        next_page = f"{path}?page={page + 1}"
+    return {
+        "count": count,
+        "next": next_page,
+        "previous": previous_page,
+        "results": [
+            {
+                "title": movie.title,
+                "description": movie.description,
+                "genres": ",".join(genre.name for genre in movie.genres.all()),
+                "uuid": str(movie.maya_uuid),
+            }
+            for movie in movies
+        ],
+    }
+
+
+def prefetch_movie_pages(path, page, data):
+    """
+    loads the pages after `page` into the maya cache in the background,
+    they are the ones the user is most likely to ask for next
+    """
+    if not data.get("next"):
+        return
+    try:
+        page = max(int(page or 1), 1)
+    except ValueError:
+        return
+    page_size = settings.MAYA_SETTINGS.get("PAGE_SIZE", 10)
+    last_page = max(math.ceil(data.get("count", 0) / page_size), page + 1)
+    for number in range(page + 1, min(page + maya_cache.prefetch_pages, last_page) + 1):
+        maya_cache.prefetch(
+            page_key(path, number), functools.partial(load_movie_page, number, path)
+        )
+
+
+def maya_cache_response(entry, state):
+    if entry["ok"]:
+        response_status = status.HTTP_200_OK
+    else:
+        response_status = status.HTTP_503_SERVICE_UNAVAILABLE
+    data = entry["data"] if entry["data"] is not None else dict(MAYA_UNAVAILABLE)
+    cache_status = "HIT" if state == FRESH else state.upper()
+    return data, response_status, {"X-Cache": cache_status}
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def home_page(request):
+    page = request.GET.get("page")
+    full_path = f"movies_{request.get_full_path()}"
+
+    entry, state = maya_cache.get_or_load(
+        full_path, lambda: load_movie_page(page, request.path)
+    )
+    if entry["ok"]:
+        prefetch_movie_pages(request.path, page, entry["data"])
     else:
-        # API seems to be return is_success flag in case of failure
-        if "is_success" not in data:
-            # TODO : a celery task to feed api data into db
-            next_page = data.get("next")
-            previous_page = data.get("previous")
-            api_movie_url = client._build_url("movies/")
-            if next_page:
-                next_page = next_page.replace(api_movie_url, request.path)
-                data["next"] = next_page
-            if previous_page:
-                previous_page = previous_page.replace(api_movie_url, request.path)
-                data["previous"] = previous_page
-            return Response(data, status=status.HTTP_200_OK)
+        data = local_movie_page(page, request.path)
+        if data is not None:
+            return Response(
+                data, status=status.HTTP_200_OK, headers={"X-Cache": "LOCAL"}
+            )
 
-    # setting the cache
-    cache.set(full_path, data)
+    data, response_status, headers = maya_cache_response(entry, state)
+    return Response(data, status=response_status, headers=headers)
 
-    return Response(data, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def maya_cache_stats(request):
+    data = maya_cache.get_stats()
+    data["breaker_state"] = maya_breaker.state()
+    return Response(data=data, status=status.HTTP_200_OK)
 
-class MovieViewset(viewsets.ModelViewSet):
+
+class SearchMixin:
+    """
+    `search` list action ranking rows by `q` over title and description,
+    filtered with `genre` and `active` and paginated by rank
+    """
+
+    search_results_key = None
+
+    def filter_genre(self, queryset, genre):
+        raise NotImplementedError
+
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        text = request.query_params.get("q", "").strip()
+        if not text:
+            data = {"is_success": False, "message": "q is required"}
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.get_queryset()
+        genre = request.query_params.get("genre")
+        if genre:
+            queryset = self.filter_genre(queryset, genre)
+        active = request.query_params.get("active")
+        if active is not None:
+            queryset = queryset.filter(active=active.lower() in ("1", "true", "yes"))
+
+        paginator = RankedKeysetPagination()
+        page = paginator.paginate_queryset(search(queryset, text), request, self)
+        results = self.get_serializer(page, many=True).data
+        for result, obj in zip(results, page):
+            result["rank"] = obj.rank
+            result["headline"] = obj.headline
+
+        response = paginator.get_paginated_response(results)
+        response.data["is_success"] = True
+        response.data["data"] = {self.search_results_key: response.data.pop("results")}
+        return response
+
+
+class RowListMixin:
+    """
+    list pages serialized by `row_serializer_class` from values() rows while
+    FAST_LIST_SERIALIZATION is on, with the same output as the serializer
+    """
+
+    row_serializer_class = None
+
+    def serialize_list(self, queryset):
+        """
+        return: (data, paginated)
+        """
+        rows = None
+        if getattr(settings, "FAST_LIST_SERIALIZATION", True):
+            rows = self.row_serializer_class(self.request, self.format_kwarg)
+            queryset = rows.values(queryset)
+
+        page = self.paginate_queryset(queryset)
+        items = queryset if page is None else page
+        if rows is not None:
+            data = rows.serialize(items)
+        else:
+            data = self.get_serializer(items, many=True).data
+        return data, page is not None
+
+
+class MovieViewset(RowListMixin, SearchMixin, viewsets.ModelViewSet):
     """
     Viewsets for movies
     """
 
     serializer_class = MovieSerializer
+    row_serializer_class = MovieRowSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = SelectablePagination
+    search_results_key = "movies"
 
     def get_queryset(self):
-        return Movie.objects.all()
+        # lists show active movies, served by the partial active index.
+        # Retrieve and update use every movie on purpose, a deactivated one
+        # stays reachable by its id through the pk index.
+        manager = Movie.active_objects if self.action == "list" else Movie.objects
+        # genres are rendered by name, fetched for the whole page at once
+        genres = MovieGenre.objects.only("id", "name").order_by("name")
+        return manager.prefetch_related(Prefetch("genres", queryset=genres)).order_by(
+            "created", "id"
+        )
+
+    def cache_scopes(self):
+        return [MOVIES]
+
+    @read_from_replica
+    @cached_response
+    def list(self, request, *args, **kwargs):
+        data, paginated = self.serialize_list(self.filter_queryset(self.get_queryset()))
+        if paginated:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    @read_from_replica
+    @cached_response
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @action(detail=True, methods=["get"])
+    @read_from_replica
+    def similar(self, request, pk=None):
+        """
+        movies most often collected together with this one, best first, as
+        computed by refresh_similar_movies. ?limit= caps their no.
+        """
+        try:
+            limit = int(
+                request.query_params.get("limit", settings.SIMILAR_MOVIES_TOP_K)
+            )
+            pk = uuid.UUID(pk)
+        except ValueError:
+            raise NotFound()
+        similar = list(
+            SimilarMovie.objects.filter(movie_id=pk)
+            .order_by("rank")
+            .values_list("similar_id", "score")[: max(limit, 0)]
+        )
+        if not similar and not Movie.objects.filter(pk=pk).exists():
+            raise NotFound()
+
+        row_serializer = MovieRowSerializer(request, self.format_kwarg)
+        movie_ids = [movie_id for movie_id, _ in similar]
+        rows = {
+            row["id"]: row
+            for row in row_serializer.values(Movie.objects.filter(id__in=movie_ids))
+        }
+        # a movie deleted after the similar rows were read is left out
+        ranked = [
+            (rows[movie_id], score) for movie_id, score in similar if movie_id in rows
+        ]
+        movies = row_serializer.serialize(row for row, _ in ranked)
+        for movie, (_, score) in zip(movies, ranked):
+            movie["score"] = score
+        return Response({"movies": movies})
+
+    def filter_genre(self, queryset, genre):
+        return queryset.filter(
+            id__in=Movie.genres.through.objects.filter(
+                moviegenre__name__iexact=genre
+            ).values("movie_id")
+        )
+
+    @action(detail=False, methods=["post"], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        creates and updates a list of movies, as a JSON array or NDJSON
+        """
+        items = request.data
+        if not isinstance(items, list):
+            data = {"is_success": False, "message": "expected a list of movies"}
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(items) > settings.BULK_MAX_ITEMS:
+            data = {
+                "is_success": False,
+                "message": f"at most {settings.BULK_MAX_ITEMS} movies per request",
+            }
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
+        writer = MovieBulkWriter()
+        valid, errors = writer.validate(items)
+        results = writer.write(valid) if valid else []
+
+        created = sum(1 for result in results if result["created"])
+        data = {
+            "is_success": not errors,
+            "data": {
+                "created": created,
+                "updated": len(results) - created,
+                "movies": results,
+            },
+            "errors": errors,
+        }
+        if not errors:
+            response_status = status.HTTP_201_CREATED
+        elif results:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(data, status=response_status)
 
-class CollectionViewset(viewsets.ModelViewSet):
+
+class CollectionViewset(RowListMixin, SearchMixin, viewsets.ModelViewSet):
     """
     Viewset for  Movie collections
     """
 
     serializer_class = CollectionSerializer
+    row_serializer_class = CollectionRowSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = SelectablePagination
+    search_results_key = "collections"
 
     def get_queryset(self):
-        return self.request.user.collections.prefetch_related("movies")
+        # lists show active collections, served by the partial active index.
+        # Retrieve and update use every collection of the user on purpose, a
+        # deactivated one stays reachable by its id.
+        # The user's related manager sets the user on every collection.
+        collections = self.request.user.collections
+        if self.action == "list":
+            collections = self.request.user.collections(manager="active_objects")
+        # movies are rendered as urls, their ids are all that is needed
+        return collections.prefetch_related(
+            Prefetch("movies", queryset=Movie.objects.only("id").order_by("id"))
+        ).order_by("created", "id")
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def cache_scopes(self):
+        # fav_genres shows genre names
+        return [user_scope(self.request.user.pk), GENRES]
+
+    @read_from_replica
+    @cached_response
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    def filter_genre(self, queryset, genre):
+        # collections holding a movie of the genre
+        return queryset.filter(
+            id__in=Movie.collections.through.objects.filter(
+                movie__genres__name__iexact=genre
+            ).values("moviecollection_id")
+        )
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        """
+        streams every collection of the user with its movies and genres,
+        `type` is ndjson (default) or csv
+        """
+        export_format = request.query_params.get("type", NDJSON)
+        if export_format not in FORMATS:
+            data = {
+                "is_success": False,
+                "message": f"type must be one of {', '.join(FORMATS)}",
+            }
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(
+            export_lines(
+                request.user, export_format, chunk_size=settings.EXPORT_CHUNK_SIZE
+            ),
+            content_type=FORMATS[export_format],
+        )
+        filename = f"collections.{export_format}"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        # sent as it is produced, not buffered by the proxy
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="import",
+        parser_classes=[MultiPartParser],
+    )
+    def import_collections(self, request):
+        """
+        creates the collections of an uploaded NDJSON or CSV `file`, in the
+        shape of the export. `type` defaults to the file extension.
+        """
+        upload = request.FILES.get("file")
+        if upload is None:
+            data = {"is_success": False, "message": "file is required"}
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        import_format = request.query_params.get("type")
+        if import_format is None:
+            import_format = CSV if upload.name.endswith(".csv") else NDJSON
+        if import_format not in FORMATS:
+            data = {
+                "is_success": False,
+                "message": f"type must be one of {', '.join(FORMATS)}",
+            }
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        importer = CollectionImporter(
+            request.user, batch_size=settings.IMPORT_BATCH_SIZE
+        )
+        report = importer.run(parse_records(upload, import_format))
+        errors = report.pop("errors")
+        data = {"is_success": not errors, "data": report, "errors": errors}
+        if not errors:
+            response_status = status.HTTP_201_CREATED
+        elif report["collections"]:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(data, status=response_status)
+
+    def _movie_ids(self, request):
+        serializer = CollectionMoviesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return set(serializer.validated_data["movies"])
+
+    @action(detail=True, methods=["patch"], url_path="add-movies")
+    def add_movies(self, request, pk=None):
+        """
+        adds movies to the collection without resending the full list
+        """
+        collection = self.get_object()
+        movie_ids = self._movie_ids(request)
+        known = set(Movie.objects.filter(id__in=movie_ids).values_list("id", flat=True))
+        missing = movie_ids - known
+        if missing:
+            data = {
+                "is_success": False,
+                "movies": [
+                    f'Invalid pk "{movie_id}" - object does not exist.'
+                    for movie_id in sorted(str(movie_id) for movie_id in missing)
+                ],
+            }
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        added = bulk_link(
+            Movie.collections.through,
+            "moviecollection_id",
+            "movie_id",
+            [(collection.id, movie_id) for movie_id in movie_ids],
+        )
+        data = {"is_success": True, "data": {"added": len(added)}}
+        return Response(data, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=["patch"], url_path="remove-movies")
+    def remove_movies(self, request, pk=None):
+        """
+        removes movies from the collection without resending the full list
+        """
+        collection = self.get_object()
+        movie_ids = self._movie_ids(request)
+        removed = bulk_unlink(
+            Movie.collections.through,
+            "moviecollection_id",
+            "movie_id",
+            [(collection.id, movie_id) for movie_id in movie_ids],
+        )
+        data = {"is_success": True, "data": {"removed": len(removed)}}
+        return Response(data, status=status.HTTP_200_OK)
+
+    @read_from_replica
+    @cached_response
     def list(self, request):
         queryset = self.filter_queryset(self.get_queryset())
 
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            response = self.get_paginated_response(serializer.data)
+        data, paginated = self.serialize_list(queryset)
+        if paginated:
+            response = self.get_paginated_response(data)
             # formating data as expected
             response.data["is_success"] = True
             response.data["data"] = {
@@ -131,11 +653,10 @@ class CollectionViewset(viewsets.ModelViewSet):
                 "fav_genres": MovieCollection.fav_genres(request.user),
             }
         else:
-            serializer = self.get_serializer(queryset, many=True)
             data = {
                 "is_success": True,
-                data: {
-                    "collections": response.data.pop("results"),
+                "data": {
+                    "collections": data,
                     "fav_genres": MovieCollection.fav_genres(request.user),
                 },
             }
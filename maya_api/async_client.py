@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import time
+import aiohttp
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from moviecollection.metrics import record_upstream, record_upstream_retry
+from .breaker import maya_breaker
+from .client import backoff_seconds, call_plan
+from .exceptions import *
+from .exceptions import BaseException as MayaException
+
+logger = logging.getLogger("maya_logger")
+
+# one pooled session per process (and event loop), see get_session
+_session = None
+_session_loop = None
+# the task closing the session at the shutdown of its loop, the loop only
+# holds a weak reference to it
+_shutdown_task = None
+
+
+def get_session():
+    """
+    Returns the process wide aiohttp session, keep-alive connections in its
+    pool are reused by every AsyncMayaApiClient. Called from a coroutine, the
+    session belongs to the running loop, the session of a previous loop is
+    closed on that loop.
+    """
+    global _session, _session_loop, _shutdown_task
+    loop = asyncio.get_running_loop()
+    if _session_loop is not loop:
+        if _session is not None and not _session.closed:
+            _close_on(_session, _session_loop)
+        _shutdown_task = loop.create_task(_close_at_shutdown())
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=settings.MAYA_SETTINGS.get("POOL_SIZE", 100),
+            keepalive_timeout=settings.MAYA_SETTINGS.get("KEEPALIVE_TIMEOUT", 30),
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            auth=aiohttp.BasicAuth(
+                settings.MAYA_SETTINGS["CLIENT_ID"],
+                settings.MAYA_SETTINGS["CLIENT_SECRET"],
+            ),
+            headers={"content-type": "application/json"},
+        )
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _close_on(session, loop):
+    """
+    schedules closing the session on its own loop, which runs it once the
+    loop runs again. A closed loop has closed it already unless it was shut
+    down without cancelling its tasks, see _close_at_shutdown.
+    """
+    if not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+
+async def _close_at_shutdown():
+    """
+    closes the session of the running loop once the loop cancels its tasks
+    at shutdown, as asyncio.run and asgiref do
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.create_future()
+    except asyncio.CancelledError:
+        if _session_loop is loop:
+            await close_session()
+        raise
+
+
+class AsyncMayaApiClient:
+    """
+    asyncio counterpart of MayaApiClient, same retry configuration and
+    exceptions but requests share the pooled session of the process.
+    """
+
+    def __init__(
+        self,
+        retries=3,
+        backoff_factor=0.3,
+        timeout=10,
+        status_forcelist=None,
+        session=None,
+        base_url=None,
+        breaker=None,
+        **kwargs,
+    ):
+        """
+        params:
+        retries: no of retries in case of failure,
+        backoff_factor: sleep configuration for retrying,
+        status_forcelist: status list to be considered for retrying,
+        session: aiohttp session, defaults to the process wide one,
+        base_url: overrides MAYA_SETTINGS base url e.g. for a local fake server,
+        breaker: circuit breaker guarding the calls, defaults to maya_breaker
+        """
+
+        if status_forcelist is None:
+            status_forcelist = (502, 504)
+
+        self.base_url = base_url or settings.MAYA_SETTINGS["BASE_URL"]
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+        self.timeout = timeout
+        self.session = session
+        self.breaker = breaker or maya_breaker
+
+    def _build_url(self, path):
+        return self.base_url + path
+
+    async def _request(
+        self, method, url, timeout=None, deadline=None, retries=None, **kwargs
+    ):
+        """
+        params:
+        timeout: seconds of every attempt,
+        retries: no of retries of failed attempts, defaults to `self.retries`,
+        deadline: time.monotonic() by which the call gives up, no retry is
+        started which could not finish before it
+        return: (status, json)
+        """
+        session = self.session or get_session()
+        attempt = 0
+        while True:
+            seconds = timeout or self.timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ApiTimeoutException(f"Timeout error for url {url}")
+                seconds = min(seconds, remaining)
+            try:
+                async with session.request(
+                    method, url, timeout=aiohttp.ClientTimeout(total=seconds), **kwargs
+                ) as res:
+                    if res.status in self.status_forcelist:
+                        raise _RetryableStatus(res.status)
+                    return res.status, await res.json(content_type=None)
+
+            except _RetryableStatus as e:
+                error = ResponseException(f"Response Exception for url {url}")
+
+            except asyncio.TimeoutError as e:
+                error = ApiTimeoutException(f"Timeout error for url {url}")
+
+            except aiohttp.ClientConnectionError as e:
+                error = ApiConnectionErrorException(f"Connection error for url {url}")
+
+            except Exception as e:
+                logger.error("api error", exc_info=True)
+                raise ResponseException(f"Response Exception for url {url}")
+
+            attempt += 1
+            backoff = backoff_seconds(attempt, self.backoff_factor)
+            if attempt > (self.retries if retries is None else retries) or (
+                deadline is not None and time.monotonic() + backoff >= deadline
+            ):
+                raise error
+            record_upstream_retry("maya")
+            await asyncio.sleep(backoff)
+
+    async def _hedged_request(
+        self, method, url, timeout, hedge_after, deadline=None, retries=None, **kwargs
+    ):
+        """
+        sends a second identical request when the first one is still
+        pending after `hedge_after` seconds, the first success wins
+        """
+        first = asyncio.ensure_future(
+            self._request(method, url, timeout, deadline, retries, **kwargs)
+        )
+        done, _ = await asyncio.wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+
+        logger.info(f"hedging request for url {url}")
+        second = asyncio.ensure_future(
+            self._request(method, url, timeout, deadline, retries, **kwargs)
+        )
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _get(self, url, params=None):
+
+        if params is None:
+            params = dict()
+
+        endpoint = url[len(self.base_url) :]
+        allowed, probe = await sync_to_async(self.breaker.allow)()
+        if not allowed:
+            raise CircuitOpenException(f"Circuit open for url {url}")
+
+        budget, retries, timeout = call_plan(
+            self.breaker, endpoint, self.retries, self.backoff_factor, self.timeout
+        )
+        hedge_after = self.breaker.hedge_delay(endpoint)
+        start = time.monotonic()
+        deadline = start + budget
+        try:
+            if hedge_after is None:
+                status, data = await self._request(
+                    "GET", url, timeout, deadline, retries, params=params
+                )
+            else:
+                status, data = await self._hedged_request(
+                    "GET", url, timeout, hedge_after, deadline, retries, params=params
+                )
+        except MayaException:
+            elapsed = time.monotonic() - start
+            await sync_to_async(self.breaker.record)(
+                False, elapsed, endpoint, probe=probe
+            )
+            record_upstream("maya", elapsed, ok=False)
+            logger.warning(
+                "maya request failed",
+                extra={"endpoint": endpoint, "seconds": round(elapsed, 4)},
+            )
+            raise
+
+        elapsed = time.monotonic() - start
+        await sync_to_async(self.breaker.record)(
+            status < 500, elapsed, endpoint, probe=probe
+        )
+        record_upstream("maya", elapsed, ok=status < 500)
+        logger.info(
+            "maya request",
+            extra={
+                "endpoint": endpoint,
+                "status": status,
+                "seconds": round(elapsed, 4),
+            },
+        )
+        return data
+
+    async def get_movie_list(self, page=None):
+        """
+        params:
+        page : interger to get specified page number data
+        return:json
+        """
+        params = dict()
+        if page is not None:
+            params["page"] = str(page)
+        return await self._get(self._build_url("movies/"), params=params)
+
+
+class _RetryableStatus(Exception):
+    pass
@@ -0,0 +1,210 @@
+import collections
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_BREAKER_SETTINGS = {
+    # seconds of the window error and slow call rates are computed over
+    "WINDOW": 30,
+    # no of calls in a window before the breaker may open
+    "MIN_CALLS": 20,
+    "ERROR_RATE": 0.5,
+    # share of calls allowed over the latency budget, 0.05 opens on p95
+    "SLOW_RATE": 0.05,
+    # seconds the breaker stays open before a probe call is let through
+    "OPEN_TIMEOUT": 30,
+    # per endpoint latency budgets in seconds of a whole call, retries and
+    # their backoff included, e.g. {"movies/": 2}
+    "LATENCY_BUDGETS": {},
+    # timeouts adapt to FACTOR * p99 of recent calls, within MIN and budget,
+    # None keeps the budget
+    "ADAPTIVE_TIMEOUT_FACTOR": 3,
+    "MIN_TIMEOUT": 0.5,
+    # seconds every attempt of a call gets at least, retries which would
+    # leave less of the budget are not made
+    "MIN_ATTEMPT_TIMEOUT": 1,
+    # seconds after which a hedged request is sent, "p95" to use recent p95
+    "HEDGE_AFTER": None,
+    "SAMPLES": 200,
+}
+
+
+class LatencyTracker:
+    """
+    Process local ring buffer of recent call latencies per endpoint
+    """
+
+    def __init__(self, size=200):
+        self.size = size
+        self._samples = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.size)
+        )
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, latency):
+        with self._lock:
+            self._samples[endpoint].append(latency)
+
+    def percentile(self, endpoint, q):
+        with self._lock:
+            samples = sorted(self._samples[endpoint])
+        # too few samples to say anything about the tail
+        if len(samples) < 20:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker whose state lives in the cache so every process sees it.
+
+    Calls are counted per fixed window together with errors and calls over
+    the endpoint latency budget. Once a window has `MIN_CALLS` calls and
+    either rate crosses its threshold the breaker opens and calls fail fast
+    for `OPEN_TIMEOUT` seconds. After that a single probe call is let
+    through (half open), its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name, **options):
+        config = dict(DEFAULT_BREAKER_SETTINGS)
+        config.update(getattr(settings, "MAYA_BREAKER", {}))
+        config.update(options)
+        self.name = name
+        self.window = config["WINDOW"]
+        self.min_calls = config["MIN_CALLS"]
+        self.error_rate = config["ERROR_RATE"]
+        self.slow_rate = config["SLOW_RATE"]
+        self.open_timeout = config["OPEN_TIMEOUT"]
+        self.budgets = config["LATENCY_BUDGETS"]
+        self.timeout_factor = config["ADAPTIVE_TIMEOUT_FACTOR"]
+        self.min_timeout = config["MIN_TIMEOUT"]
+        self.min_attempt_timeout = config["MIN_ATTEMPT_TIMEOUT"]
+        self.hedge_after = config["HEDGE_AFTER"]
+        self.latencies = LatencyTracker(config["SAMPLES"])
+
+    @property
+    def state_key(self):
+        return f"breaker:{self.name}:state"
+
+    @property
+    def probe_key(self):
+        return f"breaker:{self.name}:probe"
+
+    def _window_keys(self):
+        bucket = int(time.time() // self.window)
+        prefix = f"breaker:{self.name}:{bucket}"
+        return f"{prefix}:calls", f"{prefix}:errors", f"{prefix}:slow"
+
+    def _incr(self, key):
+        cache.add(key, 0, timeout=self.window * 2)
+        return cache.incr(key)
+
+    def budget_for(self, endpoint, default=None):
+        return self.budgets.get(endpoint, default)
+
+    def timeout_for(self, endpoint, default):
+        """
+        return: seconds the next call may take, retries included, adapted to
+        recent latencies and capped by the endpoint budget
+        """
+        budget = self.budget_for(endpoint, default)
+        if self.timeout_factor is None:
+            return budget
+        p99 = self.latencies.percentile(endpoint, 0.99)
+        if p99 is None:
+            return budget
+        return min(budget, max(self.min_timeout, p99 * self.timeout_factor))
+
+    def hedge_delay(self, endpoint):
+        """
+        return: seconds to wait before sending a hedged request, None if off
+        """
+        if self.hedge_after is None:
+            return None
+        if self.hedge_after == "p95":
+            return self.latencies.percentile(endpoint, 0.95)
+        return self.hedge_after
+
+    def state(self):
+        state = cache.get(self.state_key)
+        return state["state"] if state else CLOSED
+
+    def allow(self):
+        """
+        return: (allowed, probe) where probe tells the call is the half open
+        trial whose outcome decides the next state
+        """
+        state = cache.get(self.state_key)
+        if state is None:
+            return True, False
+
+        if (
+            state["state"] == OPEN
+            and time.time() - state["opened_at"] < self.open_timeout
+        ):
+            return False, False
+
+        # one probe at a time, an abandoned probe expires with its key
+        if cache.add(self.probe_key, 1, timeout=self.open_timeout):
+            cache.set(
+                self.state_key,
+                {"state": HALF_OPEN, "opened_at": state["opened_at"]},
+                timeout=None,
+            )
+            return True, True
+        return False, False
+
+    def record(self, success, latency, endpoint, budget=None, probe=False):
+        """
+        params:
+        success: False for connection errors, timeouts and 5xx responses,
+        latency: seconds the call took,
+        endpoint: path relative to the api base url,
+        budget: latency budget used when the endpoint has none configured,
+        probe: value returned by allow for this call
+        """
+        self.latencies.add(endpoint, latency)
+        budget = self.budget_for(endpoint, budget)
+        slow = budget is not None and latency > budget
+
+        if probe:
+            if success and not slow:
+                self.close()
+            else:
+                self.open()
+            return
+
+        calls_key, errors_key, slow_key = self._window_keys()
+        self._incr(calls_key)
+        if not success:
+            self._incr(errors_key)
+        if slow:
+            self._incr(slow_key)
+        if success and not slow:
+            return
+
+        counts = cache.get_many([calls_key, errors_key, slow_key])
+        calls = int(counts.get(calls_key, 0))
+        if calls < self.min_calls:
+            return
+        errors = int(counts.get(errors_key, 0))
+        slow_calls = int(counts.get(slow_key, 0))
+        if errors / calls >= self.error_rate or slow_calls / calls >= self.slow_rate:
+            self.open()
+
+    def open(self):
+        cache.set(
+            self.state_key, {"state": OPEN, "opened_at": time.time()}, timeout=None
+        )
+        cache.delete(self.probe_key)
+
+    def close(self):
+        cache.delete_many([self.state_key, self.probe_key, *self._window_keys()])
+
+
+maya_breaker = CircuitBreaker("maya")
@@ -1,12 +1,82 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from django.conf import settings
+from moviecollection.metrics import record_upstream
+from .breaker import maya_breaker
 from .exceptions import *
+from .exceptions import BaseException as MayaException
 
 logger = logging.getLogger("maya_logger")
 
+# process wide client, see get_client
+_client = None
+# threads running hedged requests
+_hedge_executor = ThreadPoolExecutor(
+    max_workers=settings.MAYA_SETTINGS.get("HEDGE_WORKERS", 16)
+)
+
+
+def backoff_seconds(attempt, backoff_factor):
+    """
+    return: seconds slept before retry no `attempt`, the schedule of urllib3
+    Retry which does not sleep before the first retry and doubles after it
+    """
+    if attempt <= 1:
+        return 0
+    return min(backoff_factor * (2 ** (attempt - 1)), Retry.BACKOFF_MAX)
+
+
+def worst_case_seconds(retries, backoff_factor, timeout):
+    """
+    return: seconds `retries` retries of `timeout` each may take
+    """
+    backoff = sum(
+        backoff_seconds(attempt, backoff_factor) for attempt in range(1, retries + 1)
+    )
+    return (retries + 1) * timeout + backoff
+
+
+def attempt_timeout(budget, retries, backoff_factor):
+    """
+    return: timeout of each attempt so that the first one, `retries` retries
+    and the backoff sleeps in between fit in `budget` seconds
+    """
+    backoff = worst_case_seconds(retries, backoff_factor, 0)
+    return (budget - backoff) / (retries + 1)
+
+
+def retry_plan(budget, retries, backoff_factor, min_attempt):
+    """
+    return: (no of retries, timeout of every attempt) fitting in `budget`
+    seconds, retries which would leave an attempt less than `min_attempt`
+    seconds are dropped, a single attempt gets the whole budget
+    """
+    for planned in range(retries, 0, -1):
+        timeout = attempt_timeout(budget, planned, backoff_factor)
+        if timeout >= min_attempt:
+            return planned, timeout
+    return 0, budget
+
+
+def call_plan(breaker, endpoint, retries, backoff_factor, timeout):
+    """
+    return: (budget, no of retries, timeout of every attempt) of a call to
+    `endpoint`, the budget of `breaker` covers the whole call, backoff
+    included, and an attempt takes `timeout` at most
+    """
+    longest = worst_case_seconds(retries, backoff_factor, timeout)
+    budget = breaker.timeout_for(endpoint, longest)
+    if budget >= longest:
+        return budget, retries, timeout
+    planned, seconds = retry_plan(
+        budget, retries, backoff_factor, min(timeout, breaker.min_attempt_timeout)
+    )
+    return budget, planned, min(seconds, timeout)
+
 
 class ApiHttpClient:
     """
@@ -21,6 +91,7 @@ class ApiHttpClient:
         timeout=10,
         status_forcelist=None,
         session=None,
+        base_url=None,
         **kwargs,
     ):
         """
@@ -28,16 +99,20 @@ class ApiHttpClient:
         retries: no of retries in case of failure, 
         backoff_factor: sleep configuration for retrying, 
         status_forcelist: status list to be considered for retrying, 
-        session: requests session object
+        session: requests session object,
+        base_url: overrides MAYA_SETTINGS base url e.g. for a local fake server
         """
 
         if status_forcelist is None:
             status_forcelist = (502, 504)
 
-        self.base_url = settings.MAYA_SETTINGS["BASE_URL"]
+        self.base_url = base_url or settings.MAYA_SETTINGS["BASE_URL"]
 
         session = session or requests.Session()
         self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
 
         retry = Retry(
             total=retries,
@@ -56,10 +131,47 @@ class ApiHttpClient:
         self.session = session
         self.session.headers.update({"content-type": "application/json"})
 
+    def worst_case_seconds(self):
+        """
+        return: longest a call may take, every attempt timing out and the
+        backoff sleeps of urllib3 Retry in between
+        """
+        return worst_case_seconds(self.retries, self.backoff_factor, self.timeout)
+
 
 class MayaApiClient(ApiHttpClient):
-    def __init__(self, **kwargs):
+    """
+    GETs are retried by the client rather than by urllib3, so that the
+    latency budget of the endpoint bounds the whole call, see _get
+    """
+
+    def __init__(self, breaker=None, **kwargs):
+        """
+        params:
+        breaker: circuit breaker guarding the calls, defaults to maya_breaker
+        """
         super().__init__(**kwargs)
+        self.breaker = breaker or maya_breaker
+        self.session.mount(self.base_url, HTTPAdapter(max_retries=0))
+
+    def call_plan(self, endpoint):
+        """
+        return: (budget, no of retries, timeout of every attempt) of a call
+        to `endpoint`, see call_plan
+        """
+        return call_plan(
+            self.breaker, endpoint, self.retries, self.backoff_factor, self.timeout
+        )
+
+    def worst_case_seconds(self, endpoint=None):
+        """
+        return: longest a call to `endpoint` may take, its latency budget
+        when it has one
+        """
+        budget = self.breaker.budget_for(endpoint)
+        if budget is None:
+            return super().worst_case_seconds()
+        return budget
 
     def _build_url(self, path):
         return self.base_url + path
@@ -82,24 +194,112 @@ class MayaApiClient(ApiHttpClient):
             logger.error("api error", exc_info=True)
             raise ResponseException(f"Response Exception for url {self.base_url}")
 
+    def _send_get(self, url, params, timeout, retries=0, deadline=None):
+        """
+        params:
+        timeout: seconds of every attempt,
+        retries: no of retries of failed attempts,
+        deadline: time.monotonic() by which the call gives up, no retry is
+        started which could not finish before it
+        return: (response, no of retries made)
+        """
+        attempt = 0
+        while True:
+            seconds = timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ApiTimeoutException(f"Timeout error for url {url}")
+                seconds = min(seconds, remaining)
+            try:
+                res = self.session.get(url, params=params, timeout=seconds)
+                if res.status_code not in self.status_forcelist:
+                    return res, attempt
+                error = ResponseException(f"Response Exception for url {url}")
+
+            except requests.exceptions.ConnectionError as e:
+                error = ApiConnectionErrorException(f"Connection error for url {url}")
+
+            except requests.exceptions.Timeout as e:
+                error = ApiTimeoutException(f"Timeout error for url {url}")
+
+            except Exception as e:
+                logger.error("api error", exc_info=True)
+                raise ResponseException(f"Response Exception for url {url}")
+
+            attempt += 1
+            backoff = backoff_seconds(attempt, self.backoff_factor)
+            if attempt > retries or (
+                deadline is not None and time.monotonic() + backoff >= deadline
+            ):
+                raise error
+            time.sleep(backoff)
+
+    def _hedged_get(self, url, params, timeout, hedge_after, retries=0, deadline=None):
+        """
+        sends a second identical request when the first one is still
+        pending after `hedge_after` seconds, the first success wins
+        """
+        args = (url, params, timeout, retries, deadline)
+        first = _hedge_executor.submit(self._send_get, *args)
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+
+        logger.info(f"hedging request for url {url}")
+        second = _hedge_executor.submit(self._send_get, *args)
+        error = None
+        for future in as_completed([first, second]):
+            try:
+                return future.result()
+            except MayaException as e:
+                error = e
+        raise error
+
     def _get(self, url, params=None):
 
         if params is None:
             params = dict()
 
-        try:
-            res = self.session.get(url, params=params, timeout=self.timeout)
-            return res
-
-        except requests.exceptions.ConnectionError as e:
-            raise ApiConnectionErrorException(f"Connection error for url {url}")
+        endpoint = url[len(self.base_url) :]
+        allowed, probe = self.breaker.allow()
+        if not allowed:
+            raise CircuitOpenException(f"Circuit open for url {url}")
 
-        except requests.exceptions.Timeout as e:
-            raise ApiTimeoutException(f"Timeout error for url {url}")
+        budget, retries, timeout = self.call_plan(endpoint)
+        hedge_after = self.breaker.hedge_delay(endpoint)
+        start = time.monotonic()
+        deadline = start + budget
+        try:
+            if hedge_after is None:
+                res, retried = self._send_get(url, params, timeout, retries, deadline)
+            else:
+                res, retried = self._hedged_get(
+                    url, params, timeout, hedge_after, retries, deadline
+                )
+        except MayaException:
+            elapsed = time.monotonic() - start
+            self.breaker.record(False, elapsed, endpoint, probe=probe)
+            record_upstream("maya", elapsed, ok=False)
+            logger.warning(
+                "maya request failed",
+                extra={"endpoint": endpoint, "seconds": round(elapsed, 4)},
+            )
+            raise
 
-        except Exception as e:
-            logger.error("api error", exc_info=True)
-            raise ResponseException(f"Response Exception for url {url}")
+        elapsed = time.monotonic() - start
+        self.breaker.record(res.status_code < 500, elapsed, endpoint, probe=probe)
+        record_upstream("maya", elapsed, ok=res.status_code < 500, retries=retried)
+        logger.info(
+            "maya request",
+            extra={
+                "endpoint": endpoint,
+                "status": res.status_code,
+                "seconds": round(elapsed, 4),
+                "retries": retried,
+            },
+        )
+        return res
 
     def get_movie_list(self, page=None):
 
@@ -113,3 +313,14 @@ class MayaApiClient(ApiHttpClient):
             params["page"] = page
         response = self._get(self._build_url("movies/"), params=params)
         return response.json()
+
+
+def get_client():
+    """
+    Returns the process wide MayaApiClient so the pooled connections of its
+    session are reused across requests.
+    """
+    global _client
+    if _client is None:
+        _client = MayaApiClient()
+    return _client
@@ -12,3 +12,7 @@ class ApiTimeoutException(BaseException):
 
 class ApiConnectionErrorException(BaseException):
     pass
+
+
+class CircuitOpenException(BaseException):
+    pass
@@ -13,4 +13,37 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "moviecollection.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported after django is set up
+from colsapp import async_views
+from maya_api.async_client import close_session
+
+# (method, path) served natively on the event loop, rest goes to django
+ASYNC_ROUTES = {
+    ("GET", "/"): async_views.home_page,
+}
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # closing pooled upstream connections
+            await close_session()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(scope, receive, send)
+
+    if scope["type"] == "http":
+        view = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if view is not None:
+            return await view(scope, receive, send)
+
+    return await django_application(scope, receive, send)
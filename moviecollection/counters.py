@@ -0,0 +1,280 @@
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+import zlib
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_COUNTER_SETTINGS = {
+    "SHARDS": 1,
+    "FLUSH_EVERY": 100,
+    "FLUSH_INTERVAL": 1.0,
+}
+
+
+def redis_client():
+    """
+    return: redis client of the default cache, None when it is not a redis
+    cache (e.g. locmem in tests)
+    """
+    try:
+        from django_redis import get_redis_connection
+
+        return get_redis_connection("default")
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def counter_settings():
+    options = dict(DEFAULT_COUNTER_SETTINGS)
+    options.update(getattr(settings, "REQUEST_COUNTER", {}))
+    return options
+
+
+class Flusher:
+    """
+    Daemon thread which flushes every registered buffer each
+    `flush_interval` seconds of the buffers, the shortest one. Without it an
+    idle process would keep its last increments until the next one comes in.
+    The thread is started on the first `ensure_started` of every process, so
+    forked workers get their own.
+    """
+
+    def __init__(self):
+        self._buffers = weakref.WeakSet()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, buffer):
+        with self._lock:
+            self._buffers.add(buffer)
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name="buffer-flusher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            buffers = list(self._buffers)
+            time.sleep(min((b.flush_interval for b in buffers), default=1.0))
+            for buffer in buffers:
+                try:
+                    buffer.flush()
+                except Exception:
+                    logger.error("background flush failed", exc_info=True)
+
+
+flusher = Flusher()
+
+
+class BufferedWriter:
+    """
+    Base of the process local buffers written to the cache in batches,
+    BatchedCounter, metrics.MetricsStore and traffic.TrafficCounter.
+
+    Subclasses change their buffer under `_lock` and call `_added`, a flush
+    is due once `flush_every` additions are buffered or `flush_interval`
+    seconds have passed since the last flush, whichever is first. The
+    background `flusher` flushes idle buffers. A flush takes the buffer with
+    `_take` and writes it with one redis pipeline in `_write`, or with
+    get/set in `_merge` on caches other than redis.
+    """
+
+    name = "buffer"
+
+    def __init__(self, flush_every=100, flush_interval=1.0):
+        """
+        params:
+        flush_every: no of buffered additions which triggers a flush,
+        flush_interval: max seconds an addition stays in the buffer
+        """
+        self.flush_every = max(int(flush_every), 1)
+        self.flush_interval = flush_interval
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        flusher.register(self)
+        atexit.register(self.flush)
+
+    def _added(self, count=1):
+        """
+        to be called under `_lock` after `count` additions to the buffer
+        return: True if the caller has to flush
+        """
+        flusher.ensure_started()
+        self._pending += count
+        return (
+            self._pending >= self.flush_every
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        )
+
+    def _take(self):
+        """
+        called under `_lock`
+        return: the buffered values, emptying the buffer, None if empty
+        """
+        raise NotImplementedError
+
+    def _write(self, pipe, buffered):
+        raise NotImplementedError
+
+    def _merge(self, buffered):
+        raise NotImplementedError
+
+    def _restore(self, buffered):
+        """
+        called after a failed flush, the values are dropped unless overridden
+        """
+
+    def flush(self):
+        with self._lock:
+            buffered = self._take()
+            self._pending = 0
+            self._last_flush = time.monotonic()
+        if not buffered:
+            return
+
+        try:
+            client = redis_client()
+            if client is None:
+                self._merge(buffered)
+                return
+            # a single round trip for the whole batch
+            pipe = client.pipeline(transaction=False)
+            self._write(pipe, buffered)
+            pipe.execute()
+        except Exception:
+            logger.error("%s flush failed", self.name, exc_info=True)
+            self._restore(buffered)
+
+
+class BatchedCounter(BufferedWriter):
+    """
+    Process local counter which buffers increments in memory and pushes them
+    to the cache with atomic server side increments, see BufferedWriter for
+    when. With `shards` > 1 every process writes to its own shard key so hot
+    keys are spread over several redis slots; `total` sums all of them.
+
+    `reset` starts a new epoch of the counter instead of only deleting its
+    keys. The epoch is the time of the reset in microseconds and every
+    buffered increment is stamped with the time it was made, so a flush
+    drops the increments made before the reset and counts the ones made
+    after it, whichever process buffered them.
+    """
+
+    def __init__(self, key, shards=1, flush_every=100, flush_interval=1.0):
+        """
+        params:
+        key: base cache key of the counter,
+        shards: no of cache keys the counter is spread over,
+        flush_every: no of buffered increments which triggers a flush,
+        flush_interval: max seconds an increment stays in the local buffer
+        """
+        self.key = key
+        self.name = key
+        self.shards = max(int(shards), 1)
+        # microsecond the increments were made -> count
+        self._counts = Counter()
+        super().__init__(flush_every, flush_interval)
+
+    @property
+    def epoch_key(self):
+        return f"{self.key}:epoch"
+
+    def current_epoch(self):
+        return cache.get(self.epoch_key, 0)
+
+    def shard_keys(self, epoch=0):
+        key = self.key if not epoch else f"{self.key}@{epoch}"
+        if self.shards == 1:
+            return [key]
+        return [f"{key}:{shard}" for shard in range(self.shards)]
+
+    def _shard_key(self, epoch):
+        # pinning a process to one shard keeps its flushes on a single key
+        keys = self.shard_keys(epoch)
+        shard = zlib.crc32(str(os.getpid()).encode()) % len(keys)
+        return keys[shard]
+
+    def incr(self, delta=1):
+        made = time.time_ns() // 1000
+        with self._lock:
+            self._counts[made] += delta
+            due = self._added(delta)
+        if due:
+            self.flush()
+
+    def _take(self):
+        counts, self._counts = self._counts, Counter()
+        return counts or None
+
+    def _target(self, buffered):
+        """
+        return: (key the increments made since the current epoch are added
+        to, their count)
+        """
+        epoch = self.current_epoch()
+        count = sum(delta for made, delta in buffered.items() if made >= epoch)
+        return self._shard_key(epoch), count
+
+    def _write(self, pipe, buffered):
+        key, count = self._target(buffered)
+        if count:
+            pipe.incrby(cache.make_key(key), count)
+
+    def _merge(self, buffered):
+        key, count = self._target(buffered)
+        if count:
+            # add is a no-op when the key exists
+            cache.add(key, 0, timeout=None)
+            cache.incr(key, count)
+
+    def _restore(self, buffered):
+        with self._lock:
+            self._counts.update(buffered)
+
+    def total(self):
+        """
+        return: count of the current epoch, approximate until every process
+        flushed, the increments other processes still buffer (at most
+        `flush_interval` seconds of them) are not in it yet
+        """
+        self.flush()
+        values = cache.get_many(self.shard_keys(self.current_epoch())).values()
+        return sum(int(value) for value in values)
+
+    def reset(self):
+        previous = self.current_epoch()
+        epoch = max(time.time_ns() // 1000, previous + 1)
+        cache.set(self.epoch_key, epoch, timeout=None)
+        with self._lock:
+            # every increment buffered here was made before the reset
+            self._counts = Counter()
+            self._pending = 0
+            self._last_flush = time.monotonic()
+        cache.delete_many(self.shard_keys(previous))
+
+
+def _build_request_counter():
+    options = counter_settings()
+    return BatchedCounter(
+        "request_count",
+        shards=options["SHARDS"],
+        flush_every=options["FLUSH_EVERY"],
+        flush_interval=options["FLUSH_INTERVAL"],
+    )
+
+
+request_counter = _build_request_counter()
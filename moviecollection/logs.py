@@ -0,0 +1,233 @@
+"""
+Logging which never blocks the request thread.
+
+QueuedHandler puts records on a bounded in-memory queue and a listener
+thread per handler passes them on to the real handler, so file writes and
+SMTP happen off the request. When the queue is full records are dropped and
+counted, the count is logged once the listener catches up. The listener
+starts with the first record of every process, a worker forked after
+logging was configured gets its own queue and thread. Records carry
+the correlation id of their request (CorrelationIdMiddleware) and are
+written as one JSON object per line by JSONFormatter. Error mails are rate
+limited per error by RateLimitedAdminEmailHandler.
+"""
+
+import contextvars
+import copy
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from django.core.cache import cache
+from django.utils.log import AdminEmailHandler
+from django.utils.module_loading import import_string
+
+# correlation id of the request being served
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+# attributes of every LogRecord, the others are extras passed by the caller
+STANDARD_ATTRIBUTES = set(
+    logging.LogRecord("", logging.INFO, "", 0, "", (), None).__dict__
+) | {"message", "asctime", "request_id"}
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def set_request_id(request_id):
+    """
+    return: token to pass to reset_request_id
+    """
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record with its extras, e.g.
+    logger.info("maya request", extra={"seconds": 0.1})
+    """
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "location": f"{record.filename}:{record.lineno}",
+            "function": record.funcName,
+        }
+        for name, value in record.__dict__.items():
+            if name not in STANDARD_ATTRIBUTES:
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class _Listener(QueueListener):
+    def __init__(self, queue, target, owner):
+        super().__init__(queue, target, respect_handler_level=True)
+        self.owner = owner
+
+    def enqueue_sentinel(self):
+        # waits for room, a full queue must not stop the shutdown
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        super().handle(record)
+        self.owner.report_dropped(record)
+
+
+class QueuedHandler(QueueHandler):
+    """
+    Hands records to `target` on a listener thread, see the module docstring
+
+    LOGGING = {
+        "handlers": {
+            "file": {
+                "class": "moviecollection.logs.QueuedHandler",
+                "target": {"class": "logging.FileHandler", "filename": "info.log"},
+                "formatter": "json",
+            },
+        },
+    }
+    """
+
+    def __init__(self, target, maxsize=10000):
+        """
+        params:
+        target: handler the records are passed to, or dict of its "class"
+        and keyword arguments,
+        maxsize: no of records queued before new ones are dropped
+        """
+        super().__init__(queue.Queue(maxsize))
+        if isinstance(target, dict):
+            options = dict(target)
+            target = import_string(options.pop("class"))(**options)
+        self.target = target
+        self.maxsize = maxsize
+        # enqueue runs on every logging thread, report_dropped on the listener
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        # started by the first enqueue of every process, see ensure_listener
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def ensure_listener(self):
+        """
+        starts the listener of this process, a fork does not copy the thread
+        of the parent, so its queue would never be drained
+        """
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # records of the parent are the parent's, locks copied in
+                # the middle of a put are not safe to use
+                self.queue = queue.Queue(self.maxsize)
+                self.dropped = 0
+                self._dropped_lock = threading.Lock()
+            self.listener = _Listener(self.queue, self.target, self)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def setFormatter(self, fmt):
+        # formatting is the target's job, on the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        """
+        resolves the message now, the arguments may change before the
+        listener gets to it, exc_info is kept for the mail handler
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if getattr(record, "request_id", None) is None:
+            record.request_id = current_request_id()
+        return record
+
+    def enqueue(self, record):
+        self.ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # the listener fell behind, keep the request moving
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def report_dropped(self, record):
+        """
+        logs the no of records dropped since the last report, on the
+        listener thread
+        """
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self.target.handle(
+                logging.makeLogRecord(
+                    {
+                        "name": record.name,
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": f"dropped {dropped} log records, the queue was full",
+                        "dropped": dropped,
+                    }
+                )
+            )
+
+    def close(self):
+        # drains the queue before the target is closed, a listener of the
+        # parent process has no thread here
+        if (
+            self.listener is not None
+            and self._pid == os.getpid()
+            and self.listener._thread is not None
+        ):
+            self.listener.stop()
+        self.target.close()
+        super().close()
+
+
+class RateLimitedAdminEmailHandler(AdminEmailHandler):
+    """
+    Mails an error to the admins at most once per `interval` seconds, across
+    processes through the cache. Errors are told apart by their logger,
+    location and exception type, so an outage of maya sends one mail per
+    failing line rather than one per request.
+    """
+
+    def __init__(self, interval=300, **kwargs):
+        super().__init__(**kwargs)
+        self.interval = interval
+
+    def signature(self, record):
+        exc_type = record.exc_info[0].__name__ if record.exc_info else ""
+        value = f"{record.name}:{record.pathname}:{record.lineno}:{exc_type}"
+        return hashlib.md5(value.encode()).hexdigest()
+
+    def emit(self, record):
+        try:
+            first = cache.add(
+                f"log_mail:{self.signature(record)}", True, timeout=self.interval
+            )
+        except Exception:
+            # mail rather than lose the error when the cache is down
+            first = True
+        if first:
+            super().emit(record)
@@ -0,0 +1,419 @@
+"""
+Per route request metrics in redis, exposed in the Prometheus text format.
+
+MetricsMiddleware times every request and counts its db queries, the
+cache lookups (`record_cache`) and the upstream calls (`record_upstream`)
+made while serving it. The values are added up per route in a process
+local buffer which is flushed to one redis hash per route with a single
+pipeline, every `FLUSH_EVERY` requests or `FLUSH_INTERVAL` seconds.
+
+Lookups and calls made outside of a request, e.g. by background refreshes
+or the ASGI views, are recorded under the "background" route.
+
+With `PROFILE_SLOW_REQUESTS` set, a sampling profiler records the stacks of
+the threads serving requests and writes the folded stacks of requests
+slower than that many seconds to `PROFILE_DIR`, ready for flamegraph.pl or
+speedscope.
+"""
+
+import bisect
+import contextvars
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from .counters import BufferedWriter, redis_client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_SETTINGS = {
+    # upper bounds in seconds of the latency histogram buckets
+    "BUCKETS": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    "FLUSH_EVERY": 100,
+    "FLUSH_INTERVAL": 5.0,
+    # seconds after which a request's stacks are dumped, None disables the
+    # profiler
+    "PROFILE_SLOW_REQUESTS": None,
+    "PROFILE_INTERVAL": 0.005,
+    "PROFILE_DIR": os.path.join(tempfile.gettempdir(), "moviecollection-profiles"),
+}
+
+BACKGROUND = "background"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# values of the request being served
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+def metrics_settings():
+    options = dict(DEFAULT_METRICS_SETTINGS)
+    options.update(getattr(settings, "METRICS", {}))
+    return options
+
+
+def _values():
+    """
+    return: Counter of the current request, or a new one which is added to
+    the background route
+    """
+    values = _current.get()
+    if values is not None:
+        return values, False
+    return Counter(), True
+
+
+def record_cache(name, hit):
+    values, background = _values()
+    values[f"cache:{name}:{'hit' if hit else 'miss'}"] += 1
+    if background:
+        metrics_store.add(BACKGROUND, values)
+
+
+def record_upstream(name, seconds, ok=True, retries=0):
+    values, background = _values()
+    values[f"upstream:{name}:calls"] += 1
+    values[f"upstream:{name}:seconds"] += seconds
+    values[f"upstream:{name}:retries"] += retries
+    if not ok:
+        values[f"upstream:{name}:errors"] += 1
+    if background:
+        metrics_store.add(BACKGROUND, values)
+
+
+def record_upstream_retry(name):
+    values, background = _values()
+    values[f"upstream:{name}:retries"] += 1
+    if background:
+        metrics_store.add(BACKGROUND, values)
+
+
+class RequestMetrics:
+    """
+    values of one request, active from start() to finish()
+    """
+
+    def __init__(self):
+        self.values = Counter()
+        self._token = None
+        self._start = None
+
+    def start(self):
+        self._token = _current.set(self.values)
+        self._start = time.perf_counter()
+
+    def finish(self):
+        """
+        return: seconds since start
+        """
+        _current.reset(self._token)
+        return time.perf_counter() - self._start
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        # connection.execute_wrapper hook
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.values["db_queries"] += 1
+            self.values["db_seconds"] += time.perf_counter() - start
+
+
+class MetricsStore(BufferedWriter):
+    """
+    Per route sums buffered in the process and flushed to redis hashes,
+    `metrics:route:<route>` with every route listed in `metrics:routes`
+    """
+
+    name = "metrics"
+    prefix = "metrics"
+
+    def __init__(self, buckets, flush_every=100, flush_interval=5.0):
+        self.buckets = tuple(sorted(buckets))
+        self._routes = {}
+        super().__init__(flush_every, flush_interval)
+
+    def bucket(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        if index == len(self.buckets):
+            return "+Inf"
+        return str(self.buckets[index])
+
+    def add(self, route, values):
+        # background values, flushed with the requests or by the flusher
+        with self._lock:
+            self._routes.setdefault(route, Counter()).update(values)
+
+    def add_request(self, route, seconds, status_code, values):
+        values["requests"] += 1
+        values["seconds"] += seconds
+        values[f"bucket:{self.bucket(seconds)}"] += 1
+        if status_code >= 500:
+            values["errors"] += 1
+        with self._lock:
+            self._routes.setdefault(route, Counter()).update(values)
+            due = self._added()
+        if due:
+            self.flush()
+
+    def _take(self):
+        routes, self._routes = self._routes, {}
+        return routes
+
+    def _write(self, pipe, pending):
+        for route, values in pending.items():
+            key = f"{self.prefix}:route:{route}"
+            for field, value in values.items():
+                if isinstance(value, float):
+                    pipe.hincrbyfloat(key, field, value)
+                else:
+                    pipe.hincrby(key, field, value)
+            pipe.sadd(f"{self.prefix}:routes", route)
+
+    def _merge(self, pending):
+        """
+        adds the values to the cache with get/set, not atomic across
+        processes, for caches other than redis only
+        """
+        keys = {route: f"{self.prefix}:route:{route}" for route in pending}
+        stored = cache.get_many(list(keys.values()))
+        for route, values in pending.items():
+            stored.setdefault(keys[route], Counter()).update(values)
+        routes = cache.get(f"{self.prefix}:routes", set()) | set(pending)
+        stored[f"{self.prefix}:routes"] = routes
+        cache.set_many(stored, timeout=None)
+
+    def snapshot(self):
+        """
+        return: dict of route -> dict of field -> value
+        """
+        self.flush()
+        client = redis_client()
+        if client is None:
+            routes = sorted(cache.get(f"{self.prefix}:routes", set()))
+            stored = cache.get_many([f"{self.prefix}:route:{r}" for r in routes])
+            return {
+                route: dict(stored.get(f"{self.prefix}:route:{route}", {}))
+                for route in routes
+            }
+
+        routes = sorted(
+            route.decode() for route in client.smembers(f"{self.prefix}:routes")
+        )
+        pipe = client.pipeline(transaction=False)
+        for route in routes:
+            pipe.hgetall(f"{self.prefix}:route:{route}")
+        return {
+            route: {field.decode(): float(value) for field, value in values.items()}
+            for route, values in zip(routes, pipe.execute())
+        }
+
+    def reset(self):
+        with self._lock:
+            self._routes = {}
+            self._pending = 0
+        client = redis_client()
+        if client is None:
+            routes = cache.get(f"{self.prefix}:routes", set())
+            cache.delete_many(
+                [f"{self.prefix}:route:{route}" for route in routes]
+                + [f"{self.prefix}:routes"]
+            )
+            return
+        routes = client.smembers(f"{self.prefix}:routes")
+        client.delete(
+            f"{self.prefix}:routes",
+            *[f"{self.prefix}:route:{route.decode()}" for route in routes],
+        )
+
+    def render(self):
+        """
+        return: the metrics in the Prometheus text format
+        """
+        return render_prometheus(self.snapshot(), self.buckets)
+
+
+# (name, type, help) of the exported families, in output order
+FAMILIES = [
+    ("http_request_duration_seconds", "histogram", "request latency"),
+    ("http_request_errors_total", "counter", "requests answered with a 5xx"),
+    ("db_queries_total", "counter", "db queries run by the requests"),
+    ("db_query_seconds_total", "counter", "time spent in db queries"),
+    ("cache_lookups_total", "counter", "cache lookups by cache and result"),
+    ("upstream_requests_total", "counter", "calls to upstream apis"),
+    ("upstream_request_seconds_total", "counter", "time spent in upstream calls"),
+    ("upstream_retries_total", "counter", "retries of upstream calls"),
+    ("upstream_errors_total", "counter", "failed upstream calls"),
+]
+
+UPSTREAM_FAMILIES = {
+    "calls": "upstream_requests_total",
+    "seconds": "upstream_request_seconds_total",
+    "retries": "upstream_retries_total",
+    "errors": "upstream_errors_total",
+}
+
+
+def _sample(name, labels, value):
+    text = ",".join(
+        '{}="{}"'.format(
+            key,
+            str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, label in labels.items()
+    )
+    value = float(value)
+    value = str(int(value)) if value.is_integer() else repr(value)
+    return f"{name}{{{text}}} {value}"
+
+
+def render_prometheus(snapshot, buckets):
+    samples = {name: [] for name, _, _ in FAMILIES}
+    for route, values in snapshot.items():
+        method, _, view = route.partition(":")
+        labels = {"method": method, "route": view} if view else {"route": route}
+
+        histogram = samples["http_request_duration_seconds"]
+        cumulative = 0
+        for bound in [str(bound) for bound in buckets] + ["+Inf"]:
+            cumulative += values.get(f"bucket:{bound}", 0)
+            histogram.append(
+                _sample(
+                    "http_request_duration_seconds_bucket",
+                    {**labels, "le": bound},
+                    cumulative,
+                )
+            )
+        histogram.append(
+            _sample(
+                "http_request_duration_seconds_sum", labels, values.get("seconds", 0)
+            )
+        )
+        histogram.append(
+            _sample(
+                "http_request_duration_seconds_count", labels, values.get("requests", 0)
+            )
+        )
+        for name, field in [
+            ("http_request_errors_total", "errors"),
+            ("db_queries_total", "db_queries"),
+            ("db_query_seconds_total", "db_seconds"),
+        ]:
+            samples[name].append(_sample(name, labels, values.get(field, 0)))
+
+        for field, value in sorted(values.items()):
+            kind, _, rest = field.partition(":")
+            name, _, stat = rest.rpartition(":")
+            if kind == "cache":
+                samples["cache_lookups_total"].append(
+                    _sample(
+                        "cache_lookups_total",
+                        {**labels, "cache": name, "result": stat},
+                        value,
+                    )
+                )
+            elif kind == "upstream":
+                family = UPSTREAM_FAMILIES[stat]
+                samples[family].append(
+                    _sample(family, {**labels, "upstream": name}, value)
+                )
+
+    lines = []
+    for name, kind, help_text in FAMILIES:
+        if samples[name]:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += samples[name]
+    return "\n".join(lines) + "\n"
+
+
+def fold(frame):
+    """
+    return: the stack of the frame as a flamegraph folded line, root first
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename})".replace(";", ":"))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads serving a request every `interval`
+    seconds from one background thread, the requests themselves run
+    unchanged
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            self._stacks[threading.get_ident()] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="sampling-profiler", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """
+        return: Counter of folded stack -> no of samples of the thread
+        """
+        with self._lock:
+            return self._stacks.pop(threading.get_ident(), Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[fold(frame)] += 1
+
+    @staticmethod
+    def dump(stacks, directory, name):
+        """
+        writes the stacks in the folded format
+        return: path of the file
+        """
+        os.makedirs(directory, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "-", name).strip("-")
+        path = os.path.join(
+            directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{slug}.folded"
+        )
+        with open(path, "w") as output:
+            for stack, count in stacks.most_common():
+                output.write(f"{stack} {count}\n")
+        return path
+
+
+def _build_metrics_store():
+    options = metrics_settings()
+    return MetricsStore(
+        options["BUCKETS"],
+        flush_every=options["FLUSH_EVERY"],
+        flush_interval=options["FLUSH_INTERVAL"],
+    )
+
+
+def _build_profiler():
+    options = metrics_settings()
+    if options["PROFILE_SLOW_REQUESTS"] is None:
+        return None
+    return SamplingProfiler(options["PROFILE_INTERVAL"])
+
+
+metrics_store = _build_metrics_store()
+profiler = _build_profiler()
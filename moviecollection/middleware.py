@@ -1,9 +1,65 @@
 import logging
-from django.core.cache import cache
+import re
+import uuid
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+from .counters import request_counter
+from .logs import reset_request_id, set_request_id
+from .metrics import RequestMetrics, metrics_settings, metrics_store, profiler
+from .routers import check_connections, pin_user, request_wrote, start_request
+from .traffic import traffic_counter
 
 logger = logging.getLogger(__name__)
 
 
+def request_route(request):
+    """
+    return: "<method>:<view name>" of the request, the route metrics and
+    traffic are recorded under
+    """
+    match = getattr(request, "resolver_match", None)
+    view = match.view_name if match is not None else "unmatched"
+    return f"{request.method}:{view}"
+
+
+REQUEST_ID_HEADER = "X-Request-ID"
+VALID_REQUEST_ID = re.compile(r"^[\w.-]{1,64}$")
+
+
+def request_id_from(value):
+    """
+    return: X-Request-ID sent by the proxy when it is a sane one, else a
+    new id
+    """
+    if value and VALID_REQUEST_ID.match(value):
+        return value
+    return uuid.uuid4().hex
+
+
+class CorrelationIdMiddleware:
+    """
+    Tags the log records of a request with its X-Request-ID, taken from the
+    proxy when it sent a sane one, and returns it in the response
+    """
+
+    header = REQUEST_ID_HEADER
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_id = request_id_from(request.headers.get(self.header))
+        token = set_request_id(request_id)
+        try:
+            response = self.get_response(request)
+        finally:
+            reset_request_id(token)
+        response[self.header] = request_id
+        return response
+
+
 class RequestCountMiddleware:
     def __init__(self, get_response):
 
@@ -15,14 +71,82 @@ class RequestCountMiddleware:
         # Code to be executed for each request before
         # the view (and later middleware) are called.
 
-        # getting the current count
-        current_count = cache.get("request_count", 0)
-
-        # setting the updated count
-        cache.set("request_count", current_count + 1)
+        # buffered locally, flushed to the cache in batches
+        request_counter.incr()
         response = self.get_response(request)
 
         # Code to be executed for each request/response after
         # the view is called.
 
+        # DRF sets the user it authenticated on the django request
+        user = getattr(request, "user", None)
+        traffic_counter.record(
+            request_route(request),
+            response.status_code,
+            user.pk if user is not None and user.is_authenticated else None,
+        )
+        return response
+
+
+class ReplicaMiddleware:
+    """
+    Drops dead persistent db connections before the request, and pins the
+    user to the primary after a request which wrote so the replicas do not
+    serve them data older than their write
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        check_connections()
+        start_request()
+        response = self.get_response(request)
+
+        # DRF sets the user it authenticated on the django request
+        user = getattr(request, "user", None)
+        if (
+            settings.REPLICA_DATABASES
+            and user is not None
+            and user.is_authenticated
+            and (request.method not in SAFE_METHODS or request_wrote())
+        ):
+            pin_user(user.pk)
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Records latency, db queries, cache lookups and upstream calls of every
+    request per route in moviecollection.metrics, and dumps the sampled
+    stacks of slow requests when the profiler is on
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = metrics_settings()
+        self.slow = options["PROFILE_SLOW_REQUESTS"]
+        self.profile_dir = options["PROFILE_DIR"]
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(metrics.db_wrapper))
+            if profiler is not None:
+                profiler.start()
+            metrics.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                seconds = metrics.finish()
+                stacks = profiler.stop() if profiler is not None else None
+
+        route = request_route(request)
+        metrics_store.add_request(route, seconds, response.status_code, metrics.values)
+        if stacks and seconds >= self.slow:
+            path = profiler.dump(stacks, self.profile_dir, route)
+            logger.warning(
+                f"slow request {route} took {seconds:.3f}s, stacks in {path}"
+            )
         return response
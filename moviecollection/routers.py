@@ -0,0 +1,121 @@
+import contextvars
+import functools
+import random
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# set inside the views whose reads may go to a replica
+_replica_reads = contextvars.ContextVar("replica_reads", default=False)
+# set once the current request wrote, its later reads stay on the primary
+_wrote = contextvars.ContextVar("wrote", default=False)
+
+
+def pin_key(user_id):
+    return f"db_pin:user:{user_id}"
+
+
+def pin_user(user_id):
+    """
+    sends the user's reads to the primary for REPLICA_PIN_SECONDS, long
+    enough for the replicas to catch up with the user's writes
+    """
+    cache.set(pin_key(user_id), True, timeout=settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user_id):
+    return cache.get(pin_key(user_id)) is not None
+
+
+@contextmanager
+def replica_reads(user_id=None):
+    """
+    reads of the block go to a replica, unless the user is pinned to the
+    primary after a write
+    """
+    allowed = bool(settings.REPLICA_DATABASES) and not (
+        user_id is not None and is_pinned(user_id)
+    )
+    token = _replica_reads.set(allowed)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    reads of the block go to the primary, even within replica_reads
+    """
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def read_from_replica(method):
+    """
+    runs a view method within replica_reads for the request's user
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        with replica_reads(request.user.pk):
+            return method(self, request, *args, **kwargs)
+
+    return wrapper
+
+
+def start_request():
+    _wrote.set(False)
+
+
+def request_wrote():
+    return _wrote.get()
+
+
+class ReplicaRouter:
+    """
+    Reads within replica_reads go to a random replica of REPLICA_DATABASES,
+    everything else to the primary. A write sends the rest of the request
+    to the primary, ReplicaMiddleware then pins the user to it for a while
+    so they read their own writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and not _wrote.get():
+            return random.choice(settings.REPLICA_DATABASES)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def check_connections():
+    """
+    closes persistent connections which the server dropped, checked at most
+    every DB_HEALTH_CHECK_INTERVAL seconds per connection. Django only
+    notices a dead connection once a query failed on it.
+    """
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        checked = getattr(connection, "health_checked_at", None)
+        if checked is not None and now - checked < settings.DB_HEALTH_CHECK_INTERVAL:
+            continue
+        connection.health_checked_at = now
+        if not connection.is_usable():
+            connection.close()
@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     # third party apps
     "rest_framework",
     "rest_framework.authtoken",
@@ -46,6 +47,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so every record of the request carries its id
+    "moviecollection.middleware.CorrelationIdMiddleware",
+    # early, so it times the whole request
+    "moviecollection.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -55,6 +60,7 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     # custom middleware
     "moviecollection.middleware.RequestCountMiddleware",
+    "moviecollection.middleware.ReplicaMiddleware",
 ]
 
 ROOT_URLCONF = "moviecollection.urls"
@@ -90,35 +96,69 @@ DATABASES = {
         "PASSWORD": config("DB_PASSWORD"),
         "HOST": "localhost",
         "PORT": "",
+        # persistent connections, checked by ReplicaMiddleware
+        "CONN_MAX_AGE": config("DB_CONN_MAX_AGE", default=60, cast=int),
     }
 }
 
+# read only replicas of default, e.g. "replica1.local,replica2.local"
+for number, host in enumerate(config("DB_REPLICA_HOSTS", default="", cast=Csv()), 1):
+    DATABASES[f"replica_{number}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "TEST": {"MIRROR": "default"},
+    }
+
+# reads of the movie and collection views go to these, see
+# moviecollection.routers
+REPLICA_DATABASES = [alias for alias in DATABASES if alias != "default"]
+DATABASE_ROUTERS = ["moviecollection.routers.ReplicaRouter"]
+
+# seconds a user reads from the primary after a write, more than the lag of
+# the replicas
+REPLICA_PIN_SECONDS = config("REPLICA_PIN_SECONDS", default=5, cast=int)
+
+# seconds between two checks of a persistent connection
+DB_HEALTH_CHECK_INTERVAL = config("DB_HEALTH_CHECK_INTERVAL", default=10, cast=int)
+
+
+# records are queued and written by a listener thread per handler, so
+# logging never blocks a request, see moviecollection.logs
+LOG_QUEUE_SIZE = config("LOG_QUEUE_SIZE", default=10000, cast=int)
 
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
     "formatters": {
-        "logger_foramatter": {
-            "format": "%(asctime)s, %(levelname)s-[%(filename)s:%(lineno)d]-%(funcName)s= %(message)s",
-            "datefmt": "%Y-%m-%d %H:%M:%S",
-        },
+        "json": {"()": "moviecollection.logs.JSONFormatter"},
     },
     "handlers": {
         "file": {
             "level": "INFO",
-            "class": "logging.FileHandler",
-            "formatter": "logger_foramatter",
-            "filename": "info.log",
+            "class": "moviecollection.logs.QueuedHandler",
+            "target": {"class": "logging.FileHandler", "filename": "info.log"},
+            "maxsize": LOG_QUEUE_SIZE,
+            "formatter": "json",
         },
         "mail_admins": {
             "level": "ERROR",
-            "class": "django.utils.log.AdminEmailHandler",
+            "class": "moviecollection.logs.QueuedHandler",
+            "target": {
+                "class": "moviecollection.logs.RateLimitedAdminEmailHandler",
+                # seconds between two mails of the same error
+                "interval": config("LOG_MAIL_INTERVAL", default=300, cast=int),
+            },
+            "maxsize": LOG_QUEUE_SIZE,
         },
         "maya_log": {
             "level": "INFO",
-            "class": "logging.FileHandler",
-            "formatter": "logger_foramatter",
-            "filename": os.path.join(BASE_DIR, "maya_log.log"),
+            "class": "moviecollection.logs.QueuedHandler",
+            "target": {
+                "class": "logging.FileHandler",
+                "filename": os.path.join(BASE_DIR, "maya_log.log"),
+            },
+            "maxsize": LOG_QUEUE_SIZE,
+            "formatter": "json",
         },
     },
     "loggers": {
@@ -137,6 +177,40 @@ MAYA_SETTINGS = {
     "BASE_URL": config("MAYA_API_URL"),
     "CLIENT_ID": config("MAYA_CLIENT_ID"),
     "CLIENT_SECRET": config("MAYA_SECRET_ID"),
+    # connection pool of the async client shared by the whole process
+    "POOL_SIZE": config("MAYA_POOL_SIZE", default=100, cast=int),
+    "KEEPALIVE_TIMEOUT": config("MAYA_KEEPALIVE_TIMEOUT", default=30, cast=int),
+    "PAGE_SIZE": 10,
+}
+
+# circuit breaker shared by every maya client through the cache
+MAYA_BREAKER = {
+    "WINDOW": 30,
+    "MIN_CALLS": 20,
+    "ERROR_RATE": 0.5,
+    "SLOW_RATE": 0.05,
+    "OPEN_TIMEOUT": 30,
+    # seconds of a whole call, retries included, a call only retries when
+    # every attempt still gets MIN_ATTEMPT_TIMEOUT, 2 seconds make one retry
+    "LATENCY_BUDGETS": {"movies/": 2},
+    "MIN_ATTEMPT_TIMEOUT": 1,
+    # seconds or "p95", hedging is off by default
+    "HEDGE_AFTER": config(
+        "MAYA_HEDGE_AFTER",
+        default=None,
+        cast=lambda value: value if value in (None, "p95") else float(value),
+    ),
+}
+
+# proxy cache of maya responses, all values are in seconds
+MAYA_CACHE = {
+    "TTL": config("MAYA_CACHE_TTL", default=60, cast=int),
+    "STALE_TTL": config("MAYA_CACHE_STALE_TTL", default=600, cast=int),
+    "ERROR_TTL": config("MAYA_CACHE_ERROR_TTL", default=5, cast=int),
+    "LOCK_WAIT": 5,
+    "TTL_JITTER": config("MAYA_CACHE_TTL_JITTER", default=0.1, cast=float),
+    "PREFETCH_PAGES": config("MAYA_CACHE_PREFETCH_PAGES", default=1, cast=int),
+    "PREFETCH_WORKERS": config("MAYA_CACHE_PREFETCH_WORKERS", default=4, cast=int),
 }
 
 
@@ -160,14 +234,90 @@ CACHES = {
     }
 }
 
+# per route request metrics, see moviecollection.metrics. Setting
+# METRICS_PROFILE_SLOW_REQUESTS to a no of seconds dumps the sampled stacks
+# of slower requests.
+METRICS = {
+    "FLUSH_EVERY": config("METRICS_FLUSH_EVERY", default=100, cast=int),
+    "FLUSH_INTERVAL": config("METRICS_FLUSH_INTERVAL", default=5.0, cast=float),
+    "PROFILE_SLOW_REQUESTS": config(
+        "METRICS_PROFILE_SLOW_REQUESTS",
+        default="",
+        cast=lambda value: float(value) if value else None,
+    ),
+}
+
+# request counter is buffered per process and flushed to redis in batches
+REQUEST_COUNTER = {
+    "SHARDS": config("REQUEST_COUNTER_SHARDS", default=1, cast=int),
+    "FLUSH_EVERY": config("REQUEST_COUNTER_FLUSH_EVERY", default=100, cast=int),
+    "FLUSH_INTERVAL": config(
+        "REQUEST_COUNTER_FLUSH_INTERVAL", default=1.0, cast=float
+    ),
+}
+
+# per minute and per hour traffic by endpoint, see moviecollection.traffic
+TRAFFIC = {
+    "RETENTION": {
+        "minute": config("TRAFFIC_MINUTE_RETENTION", default=2 * 24 * 3600, cast=int),
+        "hour": config("TRAFFIC_HOUR_RETENTION", default=90 * 24 * 3600, cast=int),
+    },
+    "FLUSH_EVERY": config("TRAFFIC_FLUSH_EVERY", default=100, cast=int),
+    "FLUSH_INTERVAL": config("TRAFFIC_FLUSH_INTERVAL", default=1.0, cast=float),
+}
+
+# entries in the process local genre name -> id lru
+GENRE_CACHE_SIZE = 1024
+
+# 7 makes new BaseModel ids time ordered (colsapp.ids.uuid7), see the
+# rekey_uuid7 command for existing rows
+PRIMARY_KEY_UUID_VERSION = config("PRIMARY_KEY_UUID_VERSION", default=4, cast=int)
+
+# token -> user snapshots of CachedTokenAuthentication, a process local lru
+# in front of redis
+AUTH_TOKEN_CACHE = {
+    "LOCAL_SIZE": 10000,
+    "LOCAL_TTL": config("AUTH_TOKEN_LOCAL_TTL", default=5, cast=int),
+    "TTL": config("AUTH_TOKEN_TTL", default=300, cast=int),
+}
+
+# cached GET responses of colsapp.response_cache, writes invalidate them
+RESPONSE_CACHE = {
+    "TTL": config("RESPONSE_CACHE_TTL", default=300, cast=int),
+}
+
+# max items accepted by the bulk endpoints in one request
+BULK_MAX_ITEMS = 10000
+
+# collections read per query by the streaming export
+EXPORT_CHUNK_SIZE = config("EXPORT_CHUNK_SIZE", default=1000, cast=int)
+
+# collections written per transaction by the bulk import
+IMPORT_BATCH_SIZE = config("IMPORT_BATCH_SIZE", default=5000, cast=int)
+
+# similar movies kept per movie and their score, cosine or cooccurrence,
+# see colsapp.similarity
+SIMILAR_MOVIES_TOP_K = config("SIMILAR_MOVIES_TOP_K", default=20, cast=int)
+SIMILAR_MOVIES_METRIC = config("SIMILAR_MOVIES_METRIC", default="cosine")
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "colsapp.authentication.CachedTokenAuthentication",
     ],
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 10,
+    # FastJSONRenderer encodes with orjson when installed, the output is the
+    # same as rest_framework.renderers.JSONRenderer's
+    "DEFAULT_RENDERER_CLASSES": [
+        config("JSON_RENDERER", default="colsapp.renderers.FastJSONRenderer"),
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
 }
 
+# list pages of movies and collections built from values() rows instead of
+# the model serializers, see colsapp.row_serializers
+FAST_LIST_SERIALIZATION = config("FAST_LIST_SERIALIZATION", default=True, cast=bool)
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
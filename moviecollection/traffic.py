@@ -0,0 +1,225 @@
+"""
+Traffic counters bucketed by minute and hour.
+
+Every request is counted per endpoint and status class (2xx, 4xx, ...) in
+the minute and the hour it was served, and its user is added to a
+HyperLogLog of each bucket, and to one of the bucket and endpoint, for a
+unique user estimate. Counts are buffered per process
+(counters.BufferedWriter) and written with one redis pipeline per flush,
+every bucket expiring after the retention of its granularity. The
+hour buckets are rolled up at write time, so reading a day of hours does
+not read 1440 minutes.
+"""
+
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from .counters import BufferedWriter, redis_client
+
+MINUTE = "minute"
+HOUR = "hour"
+# seconds of a bucket
+GRANULARITIES = {MINUTE: 60, HOUR: 3600}
+
+DEFAULT_TRAFFIC_SETTINGS = {
+    # seconds buckets are kept
+    "RETENTION": {MINUTE: 2 * 24 * 3600, HOUR: 90 * 24 * 3600},
+    "FLUSH_EVERY": 100,
+    "FLUSH_INTERVAL": 1.0,
+    # max buckets a query reads
+    "MAX_BUCKETS": 1500,
+}
+
+
+def traffic_settings():
+    options = dict(DEFAULT_TRAFFIC_SETTINGS)
+    options.update(getattr(settings, "TRAFFIC", {}))
+    return options
+
+
+def status_class(status_code):
+    return f"{status_code // 100}xx"
+
+
+def bucket_start(timestamp, granularity):
+    size = GRANULARITIES[granularity]
+    return int(timestamp) // size * size
+
+
+class TrafficCounter(BufferedWriter):
+    """
+    Per bucket counts of requests by endpoint and status class, and unique
+    users, see the module docstring
+    """
+
+    name = "traffic"
+    prefix = "traffic"
+
+    def __init__(
+        self, retention=None, flush_every=100, flush_interval=1.0, max_buckets=1500
+    ):
+        self.retention = retention or DEFAULT_TRAFFIC_SETTINGS["RETENTION"]
+        self.max_buckets = max_buckets
+        self._counts = Counter()
+        self._users = {}
+        super().__init__(flush_every, flush_interval)
+
+    def counts_key(self, granularity, start):
+        return f"{self.prefix}:{granularity}:{start}"
+
+    def users_key(self, granularity, start, endpoint=None):
+        key = f"{self.prefix}_users:{granularity}:{start}"
+        return key if endpoint is None else f"{key}:{endpoint}"
+
+    def record(self, endpoint, status_code, user_id=None, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        field = f"{endpoint}|{status_class(status_code)}"
+        with self._lock:
+            for granularity in GRANULARITIES:
+                start = bucket_start(timestamp, granularity)
+                self._counts[(granularity, start, field)] += 1
+                if user_id is None:
+                    continue
+                for name in (None, endpoint):
+                    users = self._users.setdefault((granularity, start, name), set())
+                    users.add(user_id)
+            due = self._added()
+        if due:
+            self.flush()
+
+    def _take(self):
+        if not self._counts and not self._users:
+            return None
+        counts, self._counts = self._counts, Counter()
+        users, self._users = self._users, {}
+        return counts, users
+
+    def _write(self, pipe, buffered):
+        counts, users = buffered
+        keys = {}
+        for (granularity, start, field), count in counts.items():
+            key = self.counts_key(granularity, start)
+            pipe.hincrby(key, field, count)
+            keys[key] = granularity
+        for (granularity, start, endpoint), user_ids in users.items():
+            key = self.users_key(granularity, start, endpoint)
+            pipe.pfadd(key, *user_ids)
+            keys[key] = granularity
+        for key, granularity in keys.items():
+            pipe.expire(key, self.retention[granularity])
+
+    def _merge(self, buffered):
+        """
+        get/set fallback of caches other than redis, exact user sets stand
+        in for the HyperLogLogs
+        """
+        counts, users = buffered
+        for (granularity, start, field), count in counts.items():
+            key = self.counts_key(granularity, start)
+            stored = cache.get(key, Counter())
+            stored[field] += count
+            cache.set(key, stored, timeout=self.retention[granularity])
+        for (granularity, start, endpoint), user_ids in users.items():
+            key = self.users_key(granularity, start, endpoint)
+            cache.set(
+                key,
+                cache.get(key, set()) | user_ids,
+                timeout=self.retention[granularity],
+            )
+
+    def bucket_starts(self, start, end, granularity):
+        """
+        return: starts of the buckets from the one holding `start` to the one
+        holding `end`, timestamps in seconds
+        """
+        size = GRANULARITIES[granularity]
+        first, last = bucket_start(start, granularity), bucket_start(end, granularity)
+        if (last - first) // size + 1 > self.max_buckets:
+            raise ValueError(
+                f"at most {self.max_buckets} {granularity} buckets per query"
+            )
+        return list(range(first, last + 1, size))
+
+    def query(self, start, end, granularity=MINUTE, endpoint=None):
+        """
+        params:
+        start, end: timestamps of the range, both included,
+        endpoint: only count this endpoint ("<method>:<view name>"), its
+        unique users included
+        return: list of buckets, oldest first
+        """
+        self.flush()
+        starts = self.bucket_starts(start, end, granularity)
+        users_keys = [self.users_key(granularity, s, endpoint) for s in starts]
+        client = redis_client()
+        if client is None:
+            stored = cache.get_many(
+                [self.counts_key(granularity, s) for s in starts] + users_keys
+            )
+            counts = [stored.get(self.counts_key(granularity, s), {}) for s in starts]
+            users = [len(stored.get(key, ())) for key in users_keys]
+        else:
+            pipe = client.pipeline(transaction=False)
+            for s in starts:
+                pipe.hgetall(self.counts_key(granularity, s))
+            for key in users_keys:
+                pipe.pfcount(key)
+            results = pipe.execute()
+            counts = [
+                {field.decode(): int(value) for field, value in result.items()}
+                for result in results[: len(starts)]
+            ]
+            users = results[len(starts) :]
+
+        buckets = []
+        for s, fields, unique_users in zip(starts, counts, users):
+            by_endpoint, by_status = Counter(), Counter()
+            for field, count in fields.items():
+                name, _, status = field.rpartition("|")
+                if endpoint is not None and name != endpoint:
+                    continue
+                by_endpoint[name] += count
+                by_status[status] += count
+            buckets.append(
+                {
+                    "start": s,
+                    "requests": sum(by_status.values()),
+                    "by_status": dict(by_status),
+                    "by_endpoint": dict(by_endpoint),
+                    "unique_users": unique_users,
+                }
+            )
+        return buckets
+
+    def delete(self, start, end, granularity):
+        cache_keys = []
+        # the endpoints of a bucket name its per endpoint user keys
+        for bucket in self.query(start, end, granularity):
+            s = bucket["start"]
+            cache_keys += [
+                self.counts_key(granularity, s),
+                self.users_key(granularity, s),
+            ]
+            cache_keys += [
+                self.users_key(granularity, s, endpoint)
+                for endpoint in bucket["by_endpoint"]
+            ]
+        client = redis_client()
+        if client is None:
+            cache.delete_many(cache_keys)
+        else:
+            client.delete(*cache_keys)
+
+
+def _build_traffic_counter():
+    options = traffic_settings()
+    return TrafficCounter(
+        retention=options["RETENTION"],
+        flush_every=options["FLUSH_EVERY"],
+        flush_interval=options["FLUSH_INTERVAL"],
+        max_buckets=options["MAX_BUCKETS"],
+    )
+
+
+traffic_counter = _build_traffic_counter()
@@ -16,15 +16,27 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.authtoken.views import obtain_auth_token
-from colsapp.views import home_page, request_count, reset_request_count, UserCreate
+from colsapp.views import (
+    home_page,
+    maya_cache_stats,
+    metrics,
+    request_count,
+    reset_request_count,
+    UserCreate,
+)
 
 urlpatterns = [
-    path("", home_page),
+    # named so the sync and the ASGI home page record metrics as GET:home
+    path("", home_page, name="home"),
     path("admin/", admin.site.urls),
     path("api/v1/", include("colsapp.urls")),
     # for request count
     path("request-count/", request_count),
     path("request-count/reset/", reset_request_count),
+    # hit ratio and upstream calls of the maya cache
+    path("maya-cache/stats/", maya_cache_stats),
+    # per route latency, db, cache and upstream metrics for prometheus
+    path("metrics/", metrics),
     # for user registration and login
     path("login/", obtain_auth_token),
     path("register/", UserCreate.as_view()),